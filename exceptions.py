@@ -24,3 +24,18 @@ class VerificationAlreadyExists(Exception):
 
 class VerificationItemDoesNotExist(Exception):
   pass
+
+class FacePipelineIsBusy(Exception):
+  pass
+
+class InvalidCursor(Exception):
+  pass
+
+class TimelogBufferIsFull(Exception):
+  pass
+
+class InvalidField(Exception):
+  pass
+
+class ExportFormatUnavailable(Exception):
+  pass
@@ -1,27 +1,100 @@
+import asyncio
+import csv
 import json
-import shutil
-from datetime import timedelta
-from typing import Dict, List
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
 
 import uvicorn
-from fastapi import FastAPI, HTTPException, Depends, File, UploadFile
+from fastapi import FastAPI, HTTPException, Depends, File, UploadFile, Query, Response, Request, Header
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordRequestForm
 from bson import json_util
 
 import settings
 import services.face_recog as face_recog
+import services.face_pool as face_pool
 import services.auth_service as auth
 import services.db_service as db
+import services.async_db_service as adb
 import services.mail_service as mail
+import services.encoding_codec as codec
+import services.streaming as streaming
+import services.tracing_service as tracing
+import services.ingest_service as ingest
+import services.rollup_service as rollup
+import services.archive_service as archive
+import services.export_service as export
+from services.face_gallery import gallery, MappedGallery
+from services.timelog_buffer import buffer as timelog_buffer
+from services.mail_dispatcher import dispatcher as mail_dispatcher
+from services.occupancy import tracker as occupancy
 from models import UserOut, UserIn, Token, TokenData, Room, Timelog
 from exceptions import (CannotReadFace, EmailIsAlreadyTaken, HasMoreThanOneFace, RoomHasDuplicateNumberOrName,
-  UserDoesNotExist, RoomDoesNotExist, FileTypeNotAllowed, VerificationAlreadyExists, VerificationItemDoesNotExist)
+  UserDoesNotExist, RoomDoesNotExist, FileTypeNotAllowed, VerificationAlreadyExists, VerificationItemDoesNotExist,
+  FacePipelineIsBusy, InvalidCursor, TimelogBufferIsFull, InvalidField, ExportFormatUnavailable)
 
 app = FastAPI()
 
 db.initialize_db()
 
-TEMP_FILE = "destination.jpg"
+@app.on_event('startup')
+def connect_async_db():
+  adb.initialize_db()
+
+@app.on_event('shutdown')
+def close_async_db():
+  adb.close_db()
+
+@app.on_event('startup')
+def load_face_gallery():
+  if isinstance(gallery, MappedGallery):
+    count = gallery.open_or_build(db.get_user_encodings)
+  else:
+    count = gallery.load(db.get_user_encodings())
+  print(f"loaded {count} face encodings into gallery")
+
+@app.on_event('startup')
+def rebuild_occupancy():
+  # Startup can run more than once in a process (e.g. tests), and one listener is enough
+  if occupancy.record_many not in db.timelog_listeners:
+    db.timelog_listeners.append(occupancy.record_many)
+  count = occupancy.refresh()
+  print(f"rebuilt occupancy for {count} present users")
+
+@app.on_event('startup')
+def start_face_pool():
+  face_pool.start()
+
+@app.on_event('shutdown')
+def stop_face_pool():
+  face_pool.shutdown()
+
+@app.on_event('startup')
+def start_import_pool():
+  ingest.start()
+
+@app.on_event('shutdown')
+def stop_import_pool():
+  ingest.shutdown()
+
+@app.on_event('startup')
+def start_timelog_buffer():
+  if settings.TIMELOG_WRITE_BEHIND:
+    timelog_buffer.start()
+
+@app.on_event('shutdown')
+def stop_timelog_buffer():
+  timelog_buffer.stop()
+
+@app.on_event('startup')
+def start_mail_dispatcher():
+  mail_dispatcher.start()
+
+@app.on_event('shutdown')
+def stop_mail_dispatcher():
+  mail_dispatcher.stop()
 
 async def verify_image_file_type(file: UploadFile = File(...)):
   if file.content_type not in settings.ALLOWED_MIME_TYPES:
@@ -33,10 +106,35 @@ async def verify_image_file_type(file: UploadFile = File(...)):
 async def root():
   return {'message': "hello world!"}
 
+@app.get('/metrics')
+async def get_metrics():
+  return {
+    'timelog_buffer': timelog_buffer.metrics(),
+    'face_pool': { 'pending': face_pool.pending(), 'cache': face_pool.cache.metrics() },
+    'token_cache': auth.token_cache.metrics(),
+    'user_cache': db.user_cache.metrics(),
+    'mail': mail_dispatcher.metrics(),
+  }
+
 @app.get('/users', response_model=UserOut)
 async def get_users(email: str):
-  user = db.get_user_from_email(email)
-  return user.to_mongo().to_dict()
+  user = await adb.get_user_from_email(email)
+  if not user:
+    raise HTTPException(status_code=404, detail="User not found.")
+
+  return codec.to_api(user)
+
+async def sync_gallery(id: str, email: str, face_encoding: Optional[list]) -> None:
+  # None leaves the enrolled face alone, [] clears it; a mapped gallery rewrites its file, so off the loop
+  if face_encoding is None:
+    return
+  if face_encoding:
+    await run_in_threadpool(gallery.upsert, id, email.replace(' ', '+').strip(), face_encoding)
+  else:
+    await run_in_threadpool(gallery.remove, id)
+
+def add_imported_to_gallery(emails: list) -> None:
+  gallery.upsert_many(db.get_user_encodings(emails))
 
 @app.put('/users')
 async def update_user(email: str, user: UserOut):
@@ -46,28 +144,74 @@ async def update_user(email: str, user: UserOut):
 
   # TODO: add temp check and temp alert
 
-  id = db.update_user(email, user_data)
+  id = await adb.update_user(email, user_data)
+  await sync_gallery(id, email, user.face_encoding)
   return { 'id': id, **user.dict() }
 
 @app.patch('/user-temp')
 async def update_user_temp(email: str, temp: float):
   # TODO: add temp check and temp alert
 
-  id = db.update_user(email, {'temp': temp})
+  id = await adb.update_user(email, {'temp': temp})
   return {'temp': temp}
 
 @app.get('/users/all')
-async def get_users(token_data: TokenData = Depends(auth.get_token_data)):
-  users = db.get_users()
-  return json.loads(users)
+async def get_users(token_data: TokenData = Depends(auth.get_token_data), fields: Optional[str] = None,
+  after: Optional[str] = None, format: str = Query('json', regex='^(json|ndjson)$'),
+  limit: int = Query(settings.USERS_PAGE_LIMIT, ge=1, le=settings.USERS_PAGE_MAX_LIMIT)):
+  try:
+    users = adb.iter_users(fields.split(',') if fields else None, limit, after)
+  except (InvalidField, InvalidCursor) as err:
+    raise HTTPException(status_code=400, detail=str(err))
+
+  if format == 'ndjson':
+    return StreamingResponse(
+      streaming.async_buffered(streaming.async_ndjson(users, json_util.dumps)),
+      media_type="application/x-ndjson"
+    )
+
+  return StreamingResponse(
+    streaming.async_buffered(streaming.async_json_array(users, json_util.dumps)),
+    media_type="application/json"
+  )
+
+async def read_capped_body(request: Request, max_bytes: int) -> bytes:
+  too_large = HTTPException(status_code=413, detail=f"Body is larger than {max_bytes} bytes.")
+  if int(request.headers.get('content-length') or 0) > max_bytes:
+    raise too_large
+
+  # Chunked uploads carry no length up front, so the limit is enforced while reading too
+  body = bytearray()
+  async for chunk in request.stream():
+    body += chunk
+    if len(body) > max_bytes:
+      raise too_large
+  return bytes(body)
+
+@app.post('/users/import')
+async def import_users(request: Request, token_data: TokenData = Depends(auth.get_token_data)):
+  body = await read_capped_body(request, settings.USER_IMPORT_MAX_BYTES)
+  content_type = request.headers.get('content-type', "")
+  try:
+    if 'csv' in content_type:
+      items = list(ingest.parse_csv(body))
+    elif 'ndjson' in content_type:
+      items = ingest.parse_ndjson(body)
+    else:
+      items = ingest.parse_json_array(body)
+  except (ValueError, csv.Error) as err:
+    raise HTTPException(status_code=400, detail=str(err))
+
+  return await run_in_threadpool(ingest.import_users, items, on_enrolled=add_imported_to_gallery)
 
 @app.post('/users/register', response_model=UserOut, status_code=201)
 async def register_user(user: UserIn):
   try:
     user.is_admin = False
     new_user = user.copy()
-    new_user.password = auth.generate_hashed_password(user.password)
-    id = db.create_user(new_user.dict())
+    new_user.password = await auth.generate_hashed_password_async(user.password)
+    id = await adb.create_user(new_user.dict())
+    await sync_gallery(id, new_user.email, new_user.face_encoding or None)
   except EmailIsAlreadyTaken as err:
     raise HTTPException(status_code= 403, detail=str(err))
   except Exception as err:
@@ -81,13 +225,14 @@ async def register_user(user: UserIn):
 
 @app.post('/users/login', response_model=Token)
 async def login(credentials: OAuth2PasswordRequestForm = Depends()):
-  user = auth.authenticate_user(db.get_user_from_email, credentials.username, credentials.password)
+  user = await auth.authenticate_user_async(
+    adb.get_user_from_email, credentials.username, credentials.password, adb.update_user)
   if not user:
     raise HTTPException(status_code=400, detail="Incorrect email or password")
 
   access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
   access_token = auth.create_access_token(
-    data = { 'sub': user.email },
+    data = { 'sub': user['email'] },
     expires_delta = access_token_expires
   )
 
@@ -95,34 +240,36 @@ async def login(credentials: OAuth2PasswordRequestForm = Depends()):
 
 @app.get('/users/me', response_model=UserOut)
 async def get_current_user(token_data: TokenData = Depends(auth.get_token_data)):
-  user = db.get_user_from_email(token_data.username)
+  user = await adb.get_user_from_email(token_data.username)
   if not user:
     raise HTTPException(status_code=404, detail="User not found.")
   
-  return user.to_mongo().to_dict()
+  return codec.to_api(user)
 
 @app.put('/users/me')
 async def update_current_user(user: UserOut, token_data: TokenData = Depends(auth.get_token_data)):
   user_data = user.dict()
   user_data.pop('email')
   user_data.pop('is_admin')
-  id = db.update_user(token_data.username, user_data)
+  id = await adb.update_user(token_data.username, user_data)
+  await sync_gallery(id, token_data.username, user.face_encoding)
   return { 'id': id, **user.dict() }
 
 @app.patch('/users/image-encoding')
-def update_user_encoding(email: str, file: UploadFile = File(...)):
+async def update_user_encoding(email: str, file: UploadFile = File(...)):
   try:
-    with open(TEMP_FILE, "wb") as buffer:
-      shutil.copyfileobj(file.file, buffer)
+    face_encoding = await face_pool.encode_image(await file.read())
 
-    resized_image = face_recog.resize_image(TEMP_FILE)
-    image = face_recog.load_image(resized_image)
-    face_encoding = face_recog.generate_face_encoding(image)
-    
     encoding_data = { 'face_encoding': face_encoding.tolist() }
-    db.update_user(email, encoding_data)
+    id = await adb.update_user(email, encoding_data)
+    # A mapped gallery rewrites its file, so keep that off the event loop
+    await run_in_threadpool(gallery.upsert, id, email.replace(' ', '+').strip(), face_encoding)
   except (HasMoreThanOneFace, CannotReadFace) as err:
     raise HTTPException(status_code=400, detail=str(err))
+  except FacePipelineIsBusy as err:
+    raise HTTPException(status_code=503, detail=str(err))
+  except UserDoesNotExist as err:
+    raise HTTPException(status_code=404, detail=str(err))
   except Exception as err:
     raise HTTPException(status_code=500, detail=str(err))
 
@@ -130,18 +277,55 @@ def update_user_encoding(email: str, file: UploadFile = File(...)):
 
 @app.post('/users/me/image-encoding/compare')
 async def verify_image(email: str, image: UploadFile = Depends(verify_image_file_type)):
-  user = db.get_user_from_email(email)
+  user = await adb.get_user_from_email(email)
+  if not user:
+    raise HTTPException(status_code=404, detail="User not found.")
 
-  uploaded_image = face_recog.load_image(image.file)
-  uploaded_face_encoding = face_recog.generate_face_encoding(uploaded_image)
+  try:
+    uploaded_face_encoding = await face_pool.encode_image(await image.read())
+  except (HasMoreThanOneFace, CannotReadFace) as err:
+    raise HTTPException(status_code=400, detail=str(err))
+  except FacePipelineIsBusy as err:
+    raise HTTPException(status_code=503, detail=str(err))
 
-  is_similar = face_recog.compare_faces(user.face_encoding, uploaded_face_encoding)
+  known_face_encoding = codec.from_document(user)
+  if known_face_encoding is None:
+    raise HTTPException(status_code=400, detail=f"{email} has no enrolled face.")
+
+  is_similar = face_recog.compare_faces(known_face_encoding, uploaded_face_encoding)
   return { 'is_similar': is_similar }
 
+@app.post('/users/identify')
+async def identify_user(k: int = Query(5, ge=1, le=settings.IDENTIFY_MAX_MATCHES), tolerance: float = Query(0.6, gt=0),
+  image: UploadFile = Depends(verify_image_file_type)):
+  try:
+    uploaded_face_encoding = await face_pool.encode_image(await image.read())
+  except (HasMoreThanOneFace, CannotReadFace) as err:
+    raise HTTPException(status_code=400, detail=str(err))
+  except FacePipelineIsBusy as err:
+    raise HTTPException(status_code=503, detail=str(err))
+
+  matches = face_recog.identify_face(gallery, uploaded_face_encoding, k, tolerance)
+  return { 'matches': matches }
+
+@app.get('/users/timelogs')
+def get_user_timelogs(email: str, response: Response, since: Optional[datetime] = None,
+  until: Optional[datetime] = None, cursor: Optional[str] = None,
+  limit: int = Query(settings.TIMELOG_PAGE_LIMIT, ge=1, le=settings.TIMELOG_PAGE_MAX_LIMIT)):
+  try:
+    timelogs, next_cursor = db.get_user_timelogs_page(email, since, until, limit, cursor)
+  except InvalidCursor as err:
+    raise HTTPException(status_code=400, detail=str(err))
+
+  if next_cursor:
+    response.headers['X-Next-Cursor'] = next_cursor
+  return timelogs
+
 @app.delete('/users/{id}')
 async def delete_user(id, token_data: TokenData = Depends(auth.get_token_data)):
   try:
-    db.delete_user(id)
+    await adb.delete_user(id)
+    await run_in_threadpool(gallery.remove, id)
   except UserDoesNotExist as err:
     raise HTTPException(status_code=404, detail=str(err))
   except Exception as err:
@@ -151,11 +335,17 @@ async def delete_user(id, token_data: TokenData = Depends(auth.get_token_data)):
   return response
 
 @app.get('/users/active-symptoms', response_model=List[UserOut])
-async def get_users_with_symptoms():
+async def get_users_with_symptoms(response: Response, after: Optional[str] = None,
+  limit: int = Query(settings.USERS_PAGE_LIMIT, ge=1, le=settings.USERS_PAGE_MAX_LIMIT)):
   try:
-    users = db.get_users_with_symptoms()
+    users, next_cursor = await adb.get_users_with_symptoms_page(limit, after)
+  except InvalidCursor as err:
+    raise HTTPException(status_code=400, detail=str(err))
   except Exception as err:
     raise HTTPException(status_code=500, detail=str(err))
+
+  if next_cursor:
+    response.headers['X-Next-Cursor'] = next_cursor
   return users
 
 @app.get('/rooms')
@@ -192,18 +382,130 @@ def delete_room(room_num: int):
     response = { 'message': f"Room {room_num} deleted." }
   return response
 
+@app.get('/rooms/occupancy')
+def get_rooms_occupancy():
+  return occupancy.counts()
+
+@app.get('/rooms/{room_num}/occupancy')
+def get_room_occupancy(room_num: int):
+  return { 'room_number': room_num, 'occupancy': occupancy.count(room_num) }
+
+@app.get('/rooms/{room_num}/visits')
+async def get_room_visits(room_num: int, since: Optional[datetime] = None, until: Optional[datetime] = None,
+  period: str = Query('day', regex='^(hour|day|week|month)$')):
+  try:
+    await adb.get_room(room_num)
+  except RoomDoesNotExist as err:
+    raise HTTPException(status_code=404, detail=str(err))
+
+  # Start on a period boundary so the first bucket isn't partial
+  since = rollup.period_start(since, period) if since else None
+  rollups = await adb.get_room_rollups(room_num, since, until)
+  return rollup.summarize(rollups, period)
+
 @app.get('/rooms/{room_num}/timelogs')
-def get_room_timelogs(room_num: int):
+def get_room_timelogs(room_num: int, response: Response, since: Optional[datetime] = None,
+  until: Optional[datetime] = None, cursor: Optional[str] = None,
+  limit: int = Query(settings.TIMELOG_PAGE_LIMIT, ge=1, le=settings.TIMELOG_PAGE_MAX_LIMIT)):
   try:
-    timelogs = db.get_timelogs_from_room_number(room_num)
+    timelogs, next_cursor = db.get_room_timelogs_page(room_num, since, until, limit, cursor)
   except RoomDoesNotExist as err:
     raise HTTPException(status_code=404, detail=str(err))
+  except InvalidCursor as err:
+    raise HTTPException(status_code=400, detail=str(err))
+
+  if next_cursor:
+    response.headers['X-Next-Cursor'] = next_cursor
   return timelogs
 
+CHECKIN_USER_FIELDS = {'face_encoding': 1, 'face_encoding_bin': 1, 'face_encoding_version': 1}
+
+async def _timed(timings: dict, stage: str, awaitable):
+  start = time.perf_counter()
+  try:
+    return await awaitable
+  finally:
+    timings[stage] = round((time.perf_counter() - start) * 1000, 1)
+
+@app.post('/checkin')
+async def check_in(email: str, temp: float, room_number: int, image: UploadFile = Depends(verify_image_file_type)):
+  started = time.perf_counter()
+  email = email.replace(' ', '+').strip()
+  timings = {}
+
+  # The user lookup and the face encode don't depend on each other
+  user, uploaded_face_encoding = await asyncio.gather(
+    _timed(timings, 'lookup_ms', adb.get_user_from_email(email, CHECKIN_USER_FIELDS)),
+    _timed(timings, 'encode_ms', face_pool.encode_image(await image.read())),
+    return_exceptions=True,
+  )
+  if isinstance(user, Exception):
+    raise HTTPException(status_code=500, detail=str(user))
+  if not user:
+    raise HTTPException(status_code=404, detail="User not found.")
+  if isinstance(uploaded_face_encoding, (HasMoreThanOneFace, CannotReadFace)):
+    raise HTTPException(status_code=400, detail=str(uploaded_face_encoding))
+  if isinstance(uploaded_face_encoding, FacePipelineIsBusy):
+    raise HTTPException(status_code=503, detail=str(uploaded_face_encoding))
+  if isinstance(uploaded_face_encoding, Exception):
+    raise HTTPException(status_code=500, detail=str(uploaded_face_encoding))
+
+  known_face_encoding = codec.from_document(user)
+  if known_face_encoding is None:
+    raise HTTPException(status_code=400, detail=f"{email} has no enrolled face.")
+
+  face_match = face_recog.compare_faces(known_face_encoding, uploaded_face_encoding)
+  has_fever = temp >= settings.FEVER_THRESHOLD
+  entry_allowed = face_match and not has_fever
+
+  # Nothing is recorded for a face that doesn't match. A buffered timelog is
+  # queued before the temperature is written, so a full buffer turns the
+  # check-in away with nothing recorded. A direct timelog write goes to a
+  # different collection than the temperature, so the two are sent concurrently;
+  # if either fails the other may still have landed and the 500 says so.
+  timelog_id = None
+  if face_match:
+    timelog = {
+      'user_email': email,
+      'room_number': room_number,
+      'timestamp': datetime.utcnow(),
+      'direction': 'entry',
+    }
+    try:
+      if entry_allowed and timelog_buffer.is_running:
+        timelog_id = timelog_buffer.add(timelog)
+      writes = [adb.update_user(email, {'temp': temp})]
+      if entry_allowed and timelog_id is None:
+        writes.append(adb.create_timelog(timelog))
+      results = await _timed(timings, 'write_ms', asyncio.gather(*writes))
+    except TimelogBufferIsFull as err:
+      raise HTTPException(status_code=503, detail=str(err))
+    except Exception as err:
+      raise HTTPException(status_code=500, detail=f"Check-in may be only partly recorded: {err}")
+    if len(results) > 1:
+      timelog_id = results[1]
+
+  timings['total_ms'] = round((time.perf_counter() - started) * 1000, 1)
+  return {
+    'email': email,
+    'room_number': room_number,
+    'temp': temp,
+    'face_match': face_match,
+    'has_fever': has_fever,
+    'entry_allowed': entry_allowed,
+    'timelog_id': timelog_id,
+    'timings': timings,
+  }
+
 @app.post('/timelog', status_code=201)
 def create_timelog(timelog: Timelog):
   try:
-    id = db.create_timelog(timelog.dict())
+    if timelog_buffer.is_running:
+      id = timelog_buffer.add(timelog.dict())
+    else:
+      id = db.create_timelog(timelog.dict())
+  except TimelogBufferIsFull as err:
+    raise HTTPException(status_code=503, detail=str(err))
   except Exception as err:
     raise HTTPException(status_code=500, detail=str(err))
   else:
@@ -213,10 +515,75 @@ def create_timelog(timelog: Timelog):
     }
   return response
 
+@app.post('/timelog/bulk')
+async def create_timelogs(request: Request, idempotency_key: Optional[str] = Header(None)):
+  body = await read_capped_body(request, settings.TIMELOG_BULK_MAX_BYTES)
+  try:
+    if 'ndjson' in request.headers.get('content-type', ""):
+      items = ingest.parse_ndjson(body)
+    else:
+      items = ingest.parse_json_array(body)
+  except ValueError as err:
+    raise HTTPException(status_code=400, detail=str(err))
+
+  return await run_in_threadpool(ingest.ingest_timelogs, items, idempotency_key)
+
 @app.get('/timelog/all', response_model=Dict[int, List[Timelog]])
-async def get_timelogs():
-  timelogs = db.get_timelogs()
-  return json.loads(json_util.dumps(timelogs))
+async def get_timelogs(since: Optional[datetime] = None, until: Optional[datetime] = None,
+  room_number: Optional[List[int]] = Query(None)):
+  timelogs = adb.get_timelogs(since, until, room_number)
+  return StreamingResponse(
+    streaming.async_buffered(streaming.async_json_object_of_arrays(timelogs)),
+    media_type="application/json"
+  )
+
+EXPORT_MEDIA_TYPES = {'csv': "text/csv", 'arrow': "application/vnd.apache.arrow.stream"}
+
+@app.get('/timelog/export')
+def export_timelogs(request: Request, since: Optional[datetime] = None, until: Optional[datetime] = None,
+  room_number: Optional[List[int]] = Query(None), format: str = Query('csv', regex='^(csv|arrow)$'),
+  include_users: bool = False, token_data: TokenData = Depends(auth.get_token_data)):
+  fields = export.columns(include_users)
+  chunks = export.chunked(db.iter_timelogs_for_export(since, until, room_number, settings.TIMELOG_EXPORT_CHUNK_SIZE),
+    settings.TIMELOG_EXPORT_CHUNK_SIZE)
+  if include_users:
+    chunks = export.join_users(chunks, db.get_user_contacts)
+
+  try:
+    body = export.to_arrow(chunks, fields) if format == 'arrow' else export.to_csv(chunks, fields)
+  except ExportFormatUnavailable as err:
+    raise HTTPException(status_code=501, detail=str(err))
+
+  headers = {'Content-Disposition': f'attachment; filename="timelogs.{format}"', 'Vary': "Accept-Encoding"}
+  if export.accepts_gzip(request.headers.get('accept-encoding', '')):
+    body = export.gzipped(body)
+    headers['Content-Encoding'] = "gzip"
+
+  return StreamingResponse(body, media_type=EXPORT_MEDIA_TYPES[format], headers=headers)
+
+@app.get('/timelog/archive')
+def get_archived_timelogs(since: datetime, until: datetime, room_number: Optional[List[int]] = Query(None),
+  token_data: TokenData = Depends(auth.get_token_data)):
+  return StreamingResponse(
+    streaming.buffered(archive.read_range(settings.TIMELOG_ARCHIVE_DIR, since, until, room_number)),
+    media_type="application/x-ndjson"
+  )
+
+@app.get('/tracing/contacts')
+def get_contacts(email: str, since: Optional[datetime] = None, until: Optional[datetime] = None,
+  window_minutes: int = settings.TRACING_WINDOW_MINUTES, token_data: TokenData = Depends(auth.get_token_data)):
+  email = email.replace(' ', '+').strip()
+  until = until or datetime.utcnow()
+  since = since or until - timedelta(days=settings.TRACING_LOOKBACK_DAYS)
+
+  contacts = tracing.trace_contacts(email, since, until, timedelta(minutes=window_minutes))
+  return {
+    'email': email,
+    'since': since,
+    'until': until,
+    'window_minutes': window_minutes,
+    'contacts': contacts,
+  }
 
 @app.post('/verification')
 def send_verification_email(email: str):
@@ -224,7 +591,7 @@ def send_verification_email(email: str):
   try:
     user = db.get_user_from_email(email)
     pk = db.create_verification(email)
-    mail.send_verification_email(email, user.first_name, pk)
+    mail_dispatcher.send(mail.build_verification_email(email, user.first_name, pk))
   except VerificationAlreadyExists as err:
     raise HTTPException(status_code=403, detail=str(err))
 
@@ -0,0 +1,176 @@
+import argparse
+import time
+from datetime import datetime, timedelta
+
+import numpy
+
+import settings
+
+import services.db_service as db
+import services.ingest_service as ingest
+from services.face_gallery import FaceGallery, MappedGallery, QuantizedFaceGallery
+
+def migrate_encodings(args):
+  migrated = db.migrate_face_encodings(args.batch_size)
+  print(f"migrated {migrated} face encodings to binary")
+
+def recompute_symptoms(args):
+  updated = db.recompute_symptoms(args.threshold)
+  print(f"updated has_symptoms on {updated} users")
+
+def rebuild_rollups(args):
+  replayed = db.rebuild_timelog_rollups(args.since, args.batch_size)
+  print(f"rebuilt timelog rollups from {replayed} timelogs")
+
+def archive_timelogs(args):
+  # Whole days only, so the hot collection always starts on a day boundary
+  cutoff = datetime.utcnow() - timedelta(days=args.days)
+  before = cutoff.replace(hour=0, minute=0, second=0, microsecond=0)
+  archived = db.archive_timelogs(before, args.archive_dir, args.batch_size)
+  print(f"archived {archived} timelogs older than {before.date()} to {args.archive_dir}")
+
+def rebuild_gallery(args):
+  count = MappedGallery(args.path).load(db.get_user_encodings())
+  print(f"wrote {count} face encodings to {args.path}")
+
+def check_gallery(args):
+  report = MappedGallery(args.path).check(db.get_user_encodings())
+  print(f"generation {report['generation']}, {report['rows']} rows")
+  for problem in ('missing', 'extra', 'mismatched'):
+    if report[problem]:
+      print(f"{problem}: {', '.join(report[problem])}")
+
+  if report['missing'] or report['extra'] or report['mismatched']:
+    raise SystemExit(1)
+  print("gallery matches the database")
+
+def _bench(search, probes) -> tuple:
+  results, latencies = [], []
+  for probe in probes:
+    start = time.perf_counter()
+    results.append(search(probe))
+    latencies.append((time.perf_counter() - start) * 1000)
+  return results, numpy.percentile(latencies, 50), numpy.percentile(latencies, 95)
+
+def bench_gallery(args):
+  # Synthetic 128-d encodings; each probe is a noisy copy of an enrolled one
+  rng = numpy.random.default_rng(args.seed)
+  encodings = rng.normal(scale=0.1, size=(args.size, 128)).astype(numpy.float32)
+  probes = encodings[rng.integers(0, args.size, args.queries)] + rng.normal(scale=0.02, size=(args.queries, 128))
+  entries = [(str(i), "", encoding) for i, encoding in enumerate(encodings)]
+
+  exact = FaceGallery(capacity=args.size)
+  exact.load(entries)
+  quantized = QuantizedFaceGallery(capacity=args.size, rerank=args.rerank)
+  if args.incremental:
+    # Like a deployment that starts nearly empty and enrolls everyone afterwards
+    quantized.load(entries[:2])
+    for user_id, email, encoding in entries[2:]:
+      quantized.upsert(user_id, email, encoding)
+  else:
+    quantized.load(entries)
+  # What face_recognition.face_distance does: float64 norm over every enrolled encoding
+  float64 = encodings.astype(numpy.float64)
+
+  def brute_force(probe):
+    distances = numpy.linalg.norm(float64 - probe, axis=1)
+    return [str(row) for row in numpy.argsort(distances)[:args.k]]
+
+  backends = [
+    ('face_distance float64', brute_force),
+    ('exact float32', lambda probe: [match['id'] for match in exact.search(probe, args.k)]),
+    (f'quantized int8 (rerank {args.rerank})', lambda probe: [match['id'] for match in quantized.search(probe, args.k)]),
+  ]
+
+  print(f"{args.size} encodings, {args.queries} queries, k={args.k}")
+  expected = None
+  for name, search in backends:
+    results, p50, p95 = _bench(search, probes)
+    expected = expected or results
+    recall = numpy.mean([len(set(found) & set(truth)) / args.k for found, truth in zip(results, expected)])
+    print(f"{name:<30} p50 {p50:8.2f} ms  p95 {p95:8.2f} ms  recall@{args.k} {recall:.4f}")
+
+def import_users(args):
+  with open(args.file, 'rb') as file:
+    body = file.read()
+  items = ingest.parse_csv(body) if args.file.endswith('.csv') else ingest.parse_ndjson(body)
+
+  # Only a shared gallery file can be updated from here; in-memory galleries pick imports up on restart
+  on_enrolled = None
+  if settings.FACE_GALLERY_PATH:
+    gallery = MappedGallery(settings.FACE_GALLERY_PATH)
+    on_enrolled = lambda emails: gallery.upsert_many(db.get_user_encodings(emails))
+
+  ingest.start()
+  try:
+    report = ingest.import_users(items, args.chunk_size, on_enrolled=on_enrolled)
+  finally:
+    ingest.shutdown()
+  for duplicate in report['duplicates']:
+    print(f"row {duplicate['index']}: {duplicate['error']}")
+  for error in report['errors']:
+    print(f"row {error['index']}: {error['error']}")
+  print(f"imported {report['inserted']} of {report['received']} users "
+    f"({len(report['duplicates'])} duplicates, {len(report['errors'])} errors)")
+
+def main():
+  parser = argparse.ArgumentParser(description="IQTrace maintenance commands")
+  commands = parser.add_subparsers(dest='command', required=True)
+
+  migrate_parser = commands.add_parser('migrate-encodings',
+    help="convert face_encoding float lists to the binary format")
+  migrate_parser.add_argument('--batch-size', type=int, default=500)
+  migrate_parser.set_defaults(func=migrate_encodings)
+
+  symptoms_parser = commands.add_parser('recompute-symptoms',
+    help="rebuild the has_symptoms flag, e.g. after changing FEVER_THRESHOLD")
+  symptoms_parser.add_argument('--threshold', type=float, default=None)
+  symptoms_parser.set_defaults(func=recompute_symptoms)
+
+  rollups_parser = commands.add_parser('rebuild-rollups',
+    help="recompute the closed hourly per-room timelog rollups from the logs still in the database")
+  rollups_parser.add_argument('--since', type=datetime.fromisoformat, default=None,
+    help="only rebuild hours from this ISO timestamp on")
+  rollups_parser.add_argument('--batch-size', type=int, default=5000)
+  rollups_parser.set_defaults(func=rebuild_rollups)
+
+  archive_parser = commands.add_parser('archive-timelogs',
+    help="move timelogs past the retention horizon into gzip archive files")
+  archive_parser.add_argument('--days', type=int, default=settings.TIMELOG_RETENTION_DAYS)
+  archive_parser.add_argument('--archive-dir', default=settings.TIMELOG_ARCHIVE_DIR)
+  archive_parser.add_argument('--batch-size', type=int, default=1000)
+  archive_parser.set_defaults(func=archive_timelogs)
+
+  rebuild_gallery_parser = commands.add_parser('rebuild-gallery',
+    help="rewrite the shared face gallery file from the database")
+  rebuild_gallery_parser.add_argument('--path', default=settings.FACE_GALLERY_PATH, required=not settings.FACE_GALLERY_PATH)
+  rebuild_gallery_parser.set_defaults(func=rebuild_gallery)
+
+  check_gallery_parser = commands.add_parser('check-gallery',
+    help="compare the shared face gallery file with the database")
+  check_gallery_parser.add_argument('--path', default=settings.FACE_GALLERY_PATH, required=not settings.FACE_GALLERY_PATH)
+  check_gallery_parser.set_defaults(func=check_gallery)
+
+  bench_parser = commands.add_parser('bench-gallery',
+    help="compare recall and latency of the gallery search backends on synthetic encodings")
+  bench_parser.add_argument('--size', type=int, default=100000)
+  bench_parser.add_argument('--queries', type=int, default=200)
+  bench_parser.add_argument('--k', type=int, default=5)
+  bench_parser.add_argument('--rerank', type=int, default=settings.FACE_GALLERY_RERANK)
+  bench_parser.add_argument('--seed', type=int, default=24)
+  bench_parser.add_argument('--incremental', action='store_true',
+    help="fill the quantized gallery through upserts after loading two rows")
+  bench_parser.set_defaults(func=bench_gallery)
+
+  import_parser = commands.add_parser('import-users',
+    help="register users in bulk from a .csv or .ndjson file")
+  import_parser.add_argument('file')
+  import_parser.add_argument('--chunk-size', type=int, default=settings.USER_IMPORT_CHUNK_SIZE)
+  import_parser.set_defaults(func=import_users)
+
+  args = parser.parse_args()
+  db.initialize_db()
+  args.func(args)
+
+if __name__ == "__main__":
+  main()
@@ -1,5 +1,5 @@
 from datetime import date, datetime
-from typing import Optional
+from typing import Literal, Optional
 
 from pydantic import BaseModel
 
@@ -30,6 +30,7 @@ class Timelog(BaseModel):
   user_email: str
   room_number: int
   timestamp: datetime
+  direction: Optional[Literal['entry', 'exit']] = None
 
 class Token(BaseModel):
   access_token: str
@@ -1,5 +1,9 @@
+from datetime import datetime
+
 from mongoengine import (Document, StringField, BooleanField,
-  DateField, DateTimeField, IntField, FloatField, ListField)
+  DateField, DateTimeField, IntField, FloatField, ListField, BinaryField)
+
+import settings
 
 class User(Document):
   email = StringField(required=True, unique=True)
@@ -12,14 +16,46 @@ class User(Document):
   address = StringField(required=True)
   survey = ListField()
   face_encoding = ListField()
+  face_encoding_bin = BinaryField(max_bytes=512)
+  face_encoding_version = IntField()
   temp = FloatField()
   is_verified = BooleanField(default=False)
   last_survey_date = DateField()
+  has_symptoms = BooleanField(default=False)
+
+  meta = {
+    'indexes': [
+      # Only flagged users are ever listed, and pages are keyed on _id
+      {'fields': ('has_symptoms', '_id'), 'partialFilterExpression': {'has_symptoms': True}},
+    ]
+  }
 
 class Timelog(Document):
   user_email = StringField(required=True)
   room_number = IntField(required=True)
   timestamp = DateTimeField(required=True)
+  direction = StringField(choices=('entry', 'exit'))
+
+  meta = {
+    'indexes': [
+      # _id is the keyset tie-breaker, so pages are read in index order without a sort
+      ('room_number', 'timestamp', '_id'),
+      ('user_email', 'timestamp', '_id'),
+      'timestamp',
+    ]
+  }
+
+class TimelogRollup(Document):
+  room_number = IntField(required=True)
+  hour = DateTimeField(required=True)
+  visits = IntField(default=0)
+  users = ListField(StringField())
+
+  meta = {
+    'indexes': [
+      {'fields': ('room_number', 'hour'), 'unique': True},
+    ]
+  }
 
 class Room(Document):
   number = IntField(required=True, unique=True)
@@ -33,3 +69,10 @@ class Room(Document):
 
 class Verification(Document):
   email = StringField(required=True, unique=True)
+  created_at = DateTimeField(default=datetime.utcnow)
+
+  meta = {
+    'indexes': [
+      {'fields': ['created_at'], 'expireAfterSeconds': settings.VERIFICATION_TTL_HOURS * 3600},
+    ]
+  }
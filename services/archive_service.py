@@ -0,0 +1,115 @@
+import gzip
+import json
+import os
+import re
+import tempfile
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Iterable, Iterator, List
+
+# Archived timelogs live in one gzip NDJSON file per room per day:
+#   <root>/YYYY/MM/DD/room-<number>.ndjson.gz
+# with naive UTC timestamps, sorted by timestamp within each file.
+
+_ROOM_FILE = re.compile(r'^room-(-?\d+)\.ndjson\.gz$')
+
+def _utc(timestamp: datetime) -> datetime:
+  if timestamp.tzinfo is not None:
+    return timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+  return timestamp
+
+def day_dir(root: str, day: date) -> str:
+  return os.path.join(root, f"{day:%Y}", f"{day:%m}", f"{day:%d}")
+
+def archive_path(root: str, room_number: int, day: date) -> str:
+  return os.path.join(day_dir(root, day), f"room-{room_number}.ndjson.gz")
+
+def to_record(timelog: dict) -> dict:
+  record = {
+    '_id': str(timelog['_id']),
+    'user_email': timelog['user_email'],
+    'room_number': timelog['room_number'],
+    'timestamp': _utc(timelog['timestamp']).isoformat(),
+  }
+  if timelog.get('direction'):
+    record['direction'] = timelog['direction']
+  return record
+
+def _read_lines(path: str) -> Iterator[str]:
+  with gzip.open(path, 'rt', encoding='utf-8') as file:
+    yield from file
+
+def write_day(root: str, room_number: int, day: date, timelogs: Iterable[dict]) -> int:
+  """Merges timelogs into the room's file for that day and returns how many records it holds.
+
+  Records are keyed by _id, so re-archiving logs that were written but not yet
+  deleted (an interrupted run) doesn't duplicate them. The file is replaced
+  atomically, so readers never see a partial archive.
+  """
+  path = archive_path(root, room_number, day)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+
+  records = {}
+  if os.path.exists(path):
+    for line in _read_lines(path):
+      record = json.loads(line)
+      records[record['_id']] = record
+  for timelog in timelogs:
+    record = to_record(timelog)
+    records[record['_id']] = record
+
+  ordered = sorted(records.values(), key=lambda record: (datetime.fromisoformat(record['timestamp']), record['_id']))
+  fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+  try:
+    with os.fdopen(fd, 'wb') as raw:
+      with gzip.GzipFile(fileobj=raw, mode='wb') as file:
+        for record in ordered:
+          file.write(f"{json.dumps(record)}\n".encode('utf-8'))
+      # The caller deletes the database copies next, so the file must survive a crash first
+      raw.flush()
+      os.fsync(raw.fileno())
+    os.replace(tmp_path, path)
+  except BaseException:
+    os.unlink(tmp_path)
+    raise
+
+  _fsync_dirs(root, os.path.dirname(path))
+  return len(ordered)
+
+def _fsync_dirs(root: str, directory: str) -> None:
+  # The rename and any day/month/year directories just created only persist once their parents are synced
+  root = os.path.abspath(root)
+  directory = os.path.abspath(directory)
+  while True:
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+      os.fsync(fd)
+    finally:
+      os.close(fd)
+    if directory == root or os.path.dirname(directory) == directory:
+      return
+    directory = os.path.dirname(directory)
+
+def _room_files(root: str, day: date, room_numbers: List[int] = None) -> list:
+  directory = day_dir(root, day)
+  if not os.path.isdir(directory):
+    return []
+  if room_numbers:
+    paths = [archive_path(root, room, day) for room in sorted(set(room_numbers))]
+    return [path for path in paths if os.path.exists(path)]
+
+  rooms = sorted(int(match.group(1)) for match in map(_ROOM_FILE.match, os.listdir(directory)) if match)
+  return [archive_path(root, room, day) for room in rooms]
+
+def read_range(root: str, since: datetime, until: datetime, room_numbers: List[int] = None) -> Iterator[str]:
+  """Yields archived timelogs in [since, until) as NDJSON lines, day by day and room by room."""
+  since, until = _utc(since), _utc(until)
+  day = since.date()
+  while datetime.combine(day, time()) < until:
+    day_start = datetime.combine(day, time())
+    # Days entirely inside the range are passed through without parsing
+    whole_day = since <= day_start and day_start + timedelta(days=1) <= until
+    for path in _room_files(root, day, room_numbers):
+      for line in _read_lines(path):
+        if whole_day or since <= datetime.fromisoformat(json.loads(line)['timestamp']) < until:
+          yield line
+    day += timedelta(days=1)
@@ -0,0 +1,307 @@
+from datetime import datetime
+
+from bson import ObjectId, json_util
+from bson.errors import InvalidId
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+from motor.motor_asyncio import AsyncIOMotorClient
+from mongoengine.queryset.transform import update as transform_update
+
+import settings
+import services.db_service as db
+import services.encoding_codec as codec
+import services.rollup_service as rollup
+from schemas import User, Room, Timelog, TimelogRollup, Verification
+from exceptions import (EmailIsAlreadyTaken, RoomDoesNotExist,
+  RoomHasDuplicateNumberOrName, UserDoesNotExist,
+  VerificationAlreadyExists, VerificationItemDoesNotExist, InvalidCursor, InvalidField)
+
+# Same functions as db_service, awaited on motor so async endpoints don't block the event loop.
+# Documents come back as plain dicts instead of mongoengine documents.
+
+_client = None
+_db = None
+
+def initialize_db(client=None) -> None:
+  global _client, _db
+  _client = client or AsyncIOMotorClient(
+    settings.MONGO_URI,
+    maxPoolSize=settings.MONGO_MAX_POOL_SIZE,
+    minPoolSize=settings.MONGO_MIN_POOL_SIZE,
+    maxIdleTimeMS=settings.MONGO_MAX_IDLE_TIME_MS,
+    waitQueueTimeoutMS=settings.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+  )
+  _db = _client[settings.MONGO_DB]
+
+def close_db() -> None:
+  global _client, _db
+  if _client is not None:
+    _client.close()
+  _client = _db = None
+
+def _collection(document):
+  return _db[document._get_collection_name()]
+
+def _normalize_email(email: str) -> str:
+  return email.replace(' ', '+').strip()
+
+async def create_user(user) -> str:
+  user = db._prepare_new_user(user)
+  new_user = User(**user)
+  new_user.validate()
+  try:
+    result = await _collection(User).insert_one(new_user.to_mongo().to_dict())
+  except DuplicateKeyError:
+    raise EmailIsAlreadyTaken(f"{user['email']} is aleady taken")
+  return str(result.inserted_id)
+
+async def get_user_from_email(email: str, projection: dict = None) -> dict:
+  email = _normalize_email(email)
+  if projection is None:
+    user = db.user_cache.get(email)
+    if user is not None:
+      # Callers reshape the document (codec.to_api), so hand out copies
+      return dict(user)
+
+  user = await _collection(User).find_one({'email': email}, projection)
+  if user is not None and projection is None:
+    db.user_cache.set(email, dict(user))
+  return user
+
+async def get_user_id_from_email(email) -> str:
+  user = await get_user_from_email(email, {'_id': 1})
+  return str(user['_id'])
+
+async def get_user_encodings():
+  projection = {'email': 1, 'face_encoding': 1, 'face_encoding_bin': 1, 'face_encoding_version': 1}
+  async for user in _collection(User).find(db.ENROLLED_QUERY, projection):
+    yield (str(user['_id']), user['email'], codec.from_document(user))
+
+async def get_users() -> str:
+  return json_util.dumps(await _collection(User).find().to_list(None))
+
+USER_HIDDEN_FIELDS = ['password', 'face_encoding', 'face_encoding_bin', 'face_encoding_version']
+USER_SELECTABLE_FIELDS = set(User._fields) - {'id', 'password', 'face_encoding_bin', 'face_encoding_version'}
+
+def _user_projection(fields: list = None) -> dict:
+  if not fields:
+    return {field: 0 for field in USER_HIDDEN_FIELDS}
+
+  invalid = set(fields) - USER_SELECTABLE_FIELDS
+  if invalid:
+    raise InvalidField(f"Unknown or hidden user fields: {', '.join(sorted(invalid))}.")
+
+  projection = {field: 1 for field in fields}
+  if 'face_encoding' in fields:
+    projection.update({'face_encoding_bin': 1, 'face_encoding_version': 1})
+  return projection
+
+def iter_users(fields: list = None, limit: int = None, after: str = None):
+  # Validates eagerly so bad arguments fail before a streamed response has started
+  projection = _user_projection(fields)
+  query = {}
+  if after:
+    try:
+      query['_id'] = {'$gt': ObjectId(after)}
+    except InvalidId:
+      raise InvalidCursor(f"Cursor {after} is invalid.")
+
+  users = _collection(User).find(query, projection).sort('_id', 1)
+  if limit:
+    users = users.limit(limit)
+
+  include_encoding = bool(fields) and 'face_encoding' in fields
+
+  async def stream():
+    async for user in users:
+      yield codec.to_api(user) if include_encoding else user
+
+  return stream()
+
+async def get_users_with_symptoms(limit: int = None, after: str = None) -> list:
+  users = _collection(User) \
+    .find(db._symptomatic_users_query(after), db.SYMPTOMATIC_USER_FIELDS) \
+    .sort('_id', 1)
+  if limit:
+    users = users.limit(limit)
+
+  return await users.to_list(None)
+
+async def get_users_with_symptoms_page(limit: int, after: str = None) -> tuple:
+  return db._symptomatic_users_page(await get_users_with_symptoms(limit + 1, after), limit)
+
+async def delete_user(id) -> None:
+  try:
+    user = await _collection(User).find_one_and_delete({'_id': ObjectId(id)}, projection={'email': 1})
+  except InvalidId:
+    user = None
+  if user is None:
+    raise UserDoesNotExist(f"User {id} does not exist.")
+  db.user_cache.pop(user['email'])
+
+async def update_user(email: str, user_data) -> str:
+  email = _normalize_email(email)
+  update = transform_update(User, **db._encode_face_encoding(user_data))
+  db.user_cache.pop(email)
+  user_db = await _collection(User).find_one_and_update(
+    {'email': email},
+    update,
+    projection={'survey': 1, 'temp': 1, 'has_symptoms': 1},
+    return_document=ReturnDocument.AFTER,
+  )
+  if user_db is None:
+    raise UserDoesNotExist(f"User {email} does not exist.")
+
+  if db.touches_symptoms(user_data):
+    symptoms_update = db.symptoms_flag_update(user_db)
+    if symptoms_update:
+      await _collection(User).update_one(*symptoms_update)
+  # Dropped again in case a concurrent read cached the pre-update document
+  db.user_cache.pop(email)
+  return str(user_db['_id'])
+
+async def create_room(room) -> str:
+  new_room = Room(**room)
+  new_room.validate()
+  try:
+    result = await _collection(Room).insert_one(new_room.to_mongo().to_dict())
+  except DuplicateKeyError:
+    raise RoomHasDuplicateNumberOrName(
+      f"Room number {room['number']} or {room['name']} is already taken.")
+  return str(result.inserted_id)
+
+async def get_rooms() -> str:
+  return json_util.dumps(await _collection(Room).find().to_list(None))
+
+async def get_room(room_num) -> dict:
+  room = await _collection(Room).find_one({'number': room_num})
+  if room is None:
+    raise RoomDoesNotExist(f"Room {room_num} does not exist.")
+  return room
+
+async def delete_room(room_num) -> None:
+  result = await _collection(Room).delete_one({'number': room_num})
+  if result.deleted_count == 0:
+    raise RoomDoesNotExist(f"Room {room_num} does not exist.")
+
+async def _next(iterator, default=None):
+  # Builtin anext() only exists from Python 3.10
+  try:
+    return await iterator.__anext__()
+  except StopAsyncIteration:
+    return default
+
+async def _room_logs(state: dict, room: int):
+  while state['head'] is not None and state['head']['room_number'] == room:
+    yield state['head']
+    state['head'] = await _next(state['logs'])
+
+async def get_timelogs(since: datetime = None, until: datetime = None, room_numbers: list = None):
+  room_query = {'number': {'$in': room_numbers}} if room_numbers else {}
+  rooms = [room['number'] async for room in
+    _collection(Room).find(room_query, {'_id': 0, 'number': 1}).sort('number', 1)]
+
+  match = {'room_number': {'$in': rooms}}
+  if since or until:
+    match['timestamp'] = db._timestamp_range(since, until)
+
+  logs = _collection(Timelog).aggregate(db._timelogs_pipeline(match), allowDiskUse=True).__aiter__()
+  state = {'logs': logs, 'head': await _next(logs)}
+  for room in rooms:
+    # Skip whatever the caller left unread of the previous room
+    while state['head'] is not None and state['head']['room_number'] < room:
+      state['head'] = await _next(logs)
+    yield room, _room_logs(state, room)
+
+async def update_timelog_rollups(documents: list) -> None:
+  updates = rollup.rollup_updates(documents)
+  if not updates:
+    return
+  try:
+    await _collection(TimelogRollup).bulk_write(updates, ordered=False)
+  except PyMongoError as err:
+    print(f"failed to update timelog rollups: {err}")
+
+async def _timelogs_written(documents: list) -> None:
+  if documents:
+    await update_timelog_rollups(documents)
+    db.notify_timelogs(documents)
+
+async def create_timelog(timelog) -> str:
+  new_timelog = Timelog(**timelog)
+  new_timelog.validate()
+  document = new_timelog.to_mongo().to_dict()
+  result = await _collection(Timelog).insert_one(document)
+  await _timelogs_written([document])
+  return str(result.inserted_id)
+
+async def insert_timelogs(timelogs: list) -> tuple:
+  documents = [Timelog(**timelog).to_mongo().to_dict() for timelog in timelogs]
+  try:
+    result = await _collection(Timelog).insert_many(documents, ordered=False)
+  except BulkWriteError as err:
+    errors = [(error['index'], error['code'], error['errmsg']) for error in err.details['writeErrors']]
+    await _timelogs_written(db.written_timelogs(documents, errors))
+    return err.details['nInserted'], errors
+  await _timelogs_written(documents)
+  return len(result.inserted_ids), []
+
+async def get_room_rollups(room_num: int, since: datetime = None, until: datetime = None) -> list:
+  return await _collection(TimelogRollup) \
+    .find(db._rollup_query(room_num, since, until), db.ROLLUP_FIELDS) \
+    .sort('hour', 1) \
+    .to_list(None)
+
+async def _page_timelogs(query: dict, since: datetime = None, until: datetime = None,
+  limit: int = None, cursor: str = None) -> tuple:
+  timelogs_query = _collection(Timelog) \
+    .find(db._timelog_page_query(query, since, until, cursor), db.TIMELOG_FIELDS) \
+    .sort(db.TIMELOG_PAGE_SORT)
+  if limit:
+    timelogs_query = timelogs_query.limit(limit + 1)
+
+  return db._timelog_page(await timelogs_query.to_list(None), limit)
+
+async def get_timelogs_from_room_number(room_num: int, since: datetime = None, until: datetime = None,
+  limit: int = None, cursor: str = None) -> list:
+  return (await get_room_timelogs_page(room_num, since, until, limit, cursor))[0]
+
+async def get_room_timelogs_page(room_num: int, since: datetime = None, until: datetime = None,
+  limit: int = None, cursor: str = None) -> tuple:
+  await get_room(room_num)
+  return await _page_timelogs({'room_number': room_num}, since, until, limit, cursor)
+
+async def get_user_timelogs_page(email: str, since: datetime = None, until: datetime = None,
+  limit: int = None, cursor: str = None) -> tuple:
+  return await _page_timelogs({'user_email': _normalize_email(email)}, since, until, limit, cursor)
+
+async def get_user_timelogs(email: str, since: datetime = None, until: datetime = None) -> list:
+  query = {'user_email': _normalize_email(email)}
+  if since or until:
+    query['timestamp'] = db._timestamp_range(since, until)
+
+  return await _collection(Timelog) \
+    .find(query, {'_id': 0, **db.TIMELOG_FIELDS}) \
+    .sort('timestamp', 1) \
+    .to_list(None)
+
+def iter_room_window_timelogs(windows: list, exclude_email: str = None):
+  return _collection(Timelog) \
+    .find(db._room_windows_query(windows, exclude_email), {'_id': 0, **db.TIMELOG_FIELDS}) \
+    .sort([('room_number', 1), ('timestamp', 1)])
+
+async def create_verification(email: str) -> str:
+  try:
+    result = await _collection(Verification).insert_one(Verification(email=email).to_mongo().to_dict())
+  except DuplicateKeyError:
+    raise VerificationAlreadyExists("Verification already exists")
+  return str(result.inserted_id)
+
+async def delete_verification(pk: str) -> str:
+  try:
+    verification = await _collection(Verification).find_one_and_delete({'_id': ObjectId(pk)})
+  except InvalidId:
+    verification = None
+  if verification is None:
+    raise VerificationItemDoesNotExist("Email may already be verified.")
+  return verification['email']
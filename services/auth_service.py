@@ -1,3 +1,6 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Optional
 
@@ -10,15 +13,37 @@ from fastapi.security import OAuth2PasswordBearer
 
 import settings
 from models import TokenData
+from services.cache import LRUCache
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="users/login")
 
-def generate_hashed_password(password: str):
-  return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+token_cache = LRUCache(settings.TOKEN_CACHE_SIZE, settings.TOKEN_CACHE_TTL_SECONDS)
+
+# bcrypt releases the GIL, so a few threads are enough to keep hashing off the event loop
+_bcrypt_executor = ThreadPoolExecutor(max_workers=settings.BCRYPT_MAX_WORKERS, thread_name_prefix="bcrypt")
+
+def generate_hashed_password(password: str, rounds: int = None) -> str:
+  salt = bcrypt.gensalt(rounds or settings.BCRYPT_ROUNDS)
+  return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
 
 def verify_password(password: str, hashed_password: str):
   return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
 
+def get_hash_rounds(hashed_password: str) -> int:
+  # Modular crypt format: $2b$<rounds>$<salt + hash>
+  return int(hashed_password.split('$')[2])
+
+def password_needs_rehash(hashed_password: str) -> bool:
+  return get_hash_rounds(hashed_password) != settings.BCRYPT_ROUNDS
+
+async def generate_hashed_password_async(password: str, rounds: int = None) -> str:
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(_bcrypt_executor, generate_hashed_password, password, rounds)
+
+async def verify_password_async(password: str, hashed_password: str) -> bool:
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(_bcrypt_executor, verify_password, password, hashed_password)
+
 def authenticate_user(get_user_func, username, password):
   user = get_user_func(username)
   if not user:
@@ -30,6 +55,25 @@ def authenticate_user(get_user_func, username, password):
   
   return user
 
+async def authenticate_user_async(get_user_func, username, password, update_user_func=None):
+  user = await get_user_func(username)
+  if not user:
+    return False
+
+  is_correct_pwd = await verify_password_async(password, user['password'])
+  if not is_correct_pwd:
+    return False
+
+  if update_user_func and password_needs_rehash(user['password']):
+    # The plain password is only available at login, so this is where the work factor catches up
+    try:
+      hashed_password = await generate_hashed_password_async(password)
+      await update_user_func(user['email'], {'password': hashed_password})
+    except Exception as err:
+      print(f"password rehash for {user['email']} failed: {err}")
+
+  return user
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
   to_encode = data.copy()
 
@@ -49,6 +93,10 @@ async def get_token_data(token: str = Depends(oauth2_scheme)):
     headers = { 'WWW-Authenticate': "Bearer" }
   )
 
+  token_data = token_cache.get(token)
+  if token_data is not None:
+    return token_data
+
   try:
     payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
     username: str = payload.get('sub')
@@ -57,5 +105,9 @@ async def get_token_data(token: str = Depends(oauth2_scheme)):
     token_data = TokenData(username=username)
   except JWTError:
     raise credentials_exception
+
+  # Never keep a token around past its own expiry
+  expires_in = payload['exp'] - time.time() if 'exp' in payload else settings.TOKEN_CACHE_TTL_SECONDS
+  token_cache.set(token, token_data, ttl=expires_in)
   
   return token_data
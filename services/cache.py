@@ -0,0 +1,85 @@
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+class LRUCache:
+  """Bounded LRU cache whose entries also expire after a TTL.
+
+  A `ttl` of 0 disables the cache: nothing is stored and every lookup misses.
+  With `maxbytes` set, entries are also evicted once their combined
+  `sizeof` goes over it.
+  """
+
+  def __init__(self, maxsize: int, ttl: float, maxbytes: int = 0, sizeof=None):
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.maxbytes = maxbytes
+    self.sizeof = sizeof
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+    self._bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def __len__(self) -> int:
+    return len(self._entries)
+
+  def get(self, key, default=None):
+    with self._lock:
+      entry = self._entries.get(key, _MISSING)
+      if entry is not _MISSING and entry[1] <= time.monotonic():
+        self._remove(key)
+        entry = _MISSING
+
+      if entry is _MISSING:
+        self.misses += 1
+        return default
+
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return entry[0]
+
+  def _remove(self, key) -> None:
+    self._bytes -= self._entries.pop(key)[2]
+
+  def set(self, key, value, ttl: float = None) -> None:
+    ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+    if ttl <= 0 or self.maxsize <= 0:
+      return
+
+    size = self.sizeof(value) if self.sizeof else 0
+    if self.maxbytes and size > self.maxbytes:
+      return
+
+    with self._lock:
+      if key in self._entries:
+        self._remove(key)
+      self._entries[key] = (value, time.monotonic() + ttl, size)
+      self._bytes += size
+      while len(self._entries) > self.maxsize or (self.maxbytes and self._bytes > self.maxbytes):
+        self._remove(next(iter(self._entries)))
+        self.evictions += 1
+
+  def pop(self, key) -> None:
+    with self._lock:
+      if key in self._entries:
+        self._remove(key)
+
+  def clear(self) -> None:
+    with self._lock:
+      self._entries.clear()
+      self._bytes = 0
+
+  def metrics(self) -> dict:
+    lookups = self.hits + self.misses
+    return {
+      'size': len(self._entries),
+      'bytes': self._bytes,
+      'hits': self.hits,
+      'misses': self.misses,
+      'evictions': self.evictions,
+      'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+    }
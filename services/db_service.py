@@ -1,18 +1,79 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+from itertools import groupby
+from operator import itemgetter
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
 from mongoengine import connect
-from mongoengine.queryset.visitor import Q
 from mongoengine.errors import NotUniqueError, DoesNotExist
 
-from schemas import User, Room, Timelog, Verification
+import settings
+import services.encoding_codec as codec
+import services.rollup_service as rollup
+import services.archive_service as archive
+from services.cache import LRUCache
+from schemas import User, Room, Timelog, TimelogRollup, Verification
 from exceptions import (EmailIsAlreadyTaken, RoomDoesNotExist,
   RoomHasDuplicateNumberOrName, UserDoesNotExist, 
-  VerificationAlreadyExists, VerificationItemDoesNotExist)
+  VerificationAlreadyExists, VerificationItemDoesNotExist, InvalidCursor)
+
 
+# Read by async_db_service.get_user_from_email; every write path below invalidates it
+user_cache = LRUCache(settings.USER_CACHE_SIZE, settings.USER_CACHE_TTL_SECONDS)
 
 def initialize_db() -> None:
   print("initializing db...")
-  connect("iqtrace")
+  connect(
+    settings.MONGO_DB,
+    host=settings.MONGO_URI,
+    maxPoolSize=settings.MONGO_MAX_POOL_SIZE,
+    minPoolSize=settings.MONGO_MIN_POOL_SIZE,
+    maxIdleTimeMS=settings.MONGO_MAX_IDLE_TIME_MS,
+    waitQueueTimeoutMS=settings.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+  )
+
+def _encode_face_encoding(user_data: dict) -> dict:
+  if 'face_encoding' not in user_data:
+    return user_data
+
+  user_data = user_data.copy()
+  encoding = user_data.pop('face_encoding')
+  if encoding is None:
+    return user_data
+
+  if len(encoding) > 0:
+    user_data.update(codec.to_fields(encoding))
+  else:
+    user_data.update({'unset__face_encoding_bin': True, 'unset__face_encoding_version': True})
+  user_data['unset__face_encoding'] = True
+  return user_data
+
+def compute_has_symptoms(survey, temp, threshold: float = None) -> bool:
+  threshold = settings.FEVER_THRESHOLD if threshold is None else threshold
+  return bool(survey) or (temp is not None and temp >= threshold)
+
+def touches_symptoms(user_data: dict) -> bool:
+  return 'survey' in user_data or 'temp' in user_data
+
+def symptoms_flag_update(user: dict):
+  # Guarded on the values the flag was computed from, so a racing write to survey/temp can't be overwritten
+  has_symptoms = compute_has_symptoms(user.get('survey'), user.get('temp'))
+  if has_symptoms == user.get('has_symptoms', False):
+    return None
+
+  query = {'_id': user['_id'], 'survey': user.get('survey'), 'temp': user.get('temp')}
+  return query, {'$set': {'has_symptoms': has_symptoms}}
+
+def _prepare_new_user(user: dict) -> dict:
+  user = {key: value for key, value in _encode_face_encoding(user).items() if not key.startswith('unset__')}
+  user['has_symptoms'] = compute_has_symptoms(user.get('survey'), user.get('temp'))
+  return user
 
 def create_user(user) -> str:
+  user = _prepare_new_user(user)
   new_user = User(**user)
   try:
     new_user.save()
@@ -20,6 +81,23 @@ def create_user(user) -> str:
     raise EmailIsAlreadyTaken(f"{user['email']} is aleady taken")
   return str(new_user.pk)
 
+def validate_new_user(user: dict) -> None:
+  User(**_prepare_new_user(user)).validate()
+
+def insert_users(users: list) -> tuple:
+  documents = []
+  for user in users:
+    new_user = User(**_prepare_new_user(user))
+    new_user.validate()
+    documents.append(new_user.to_mongo().to_dict())
+
+  try:
+    result = User._get_collection().insert_many(documents, ordered=False)
+  except BulkWriteError as err:
+    errors = [(error['index'], error['code'], error['errmsg']) for error in err.details['writeErrors']]
+    return err.details['nInserted'], errors
+  return len(result.inserted_ids), []
+
 def get_user_from_email(email: str) -> User:
   email = email.replace(' ', '+').strip()
   try:
@@ -32,36 +110,113 @@ def get_user_id_from_email(email) -> str:
   user = get_user_from_email(email)
   return str(user.pk)
 
+ENROLLED_QUERY = {
+  '$or': [
+    {'face_encoding_bin': {'$exists': True}},
+    {'face_encoding.0': {'$exists': True}},
+  ]
+}
+
+def get_user_encodings(emails: list = None):
+  query = {**ENROLLED_QUERY, 'email': {'$in': emails}} if emails is not None else ENROLLED_QUERY
+  users = User.objects(__raw__=query) \
+    .only('email', 'face_encoding', 'face_encoding_bin', 'face_encoding_version')
+  for user in users:
+    yield (str(user.pk), user.email, codec.from_document(user))
+
 def get_users() -> str:
   return User.objects.to_json()
 
-def get_users_with_symptoms() -> str:
-  query = {}
-  query2 = {}
-  query['survey__exists'] = True
-  query['survey__not__size'] = 0
-  query2['temp__exists'] = True
-  query2['temp__gte'] = 38.0
-  queried_users = User.objects(Q(**query) | Q(**query2))
+def symptoms_query(threshold: float = None) -> dict:
+  threshold = settings.FEVER_THRESHOLD if threshold is None else threshold
+  return {
+    '$or': [
+      {'survey': {'$exists': True, '$not': {'$size': 0}}},
+      {'temp': {'$exists': True, '$gte': threshold}},
+    ]
+  }
+
+SYMPTOMATIC_USER_FIELDS = {'password': 0, 'face_encoding': 0, 'face_encoding_bin': 0, 'face_encoding_version': 0}
+
+def _symptomatic_users_query(after: str = None) -> dict:
+  query = {'has_symptoms': True}
+  if after:
+    try:
+      query['_id'] = {'$gt': ObjectId(after)}
+    except InvalidId:
+      raise InvalidCursor(f"Cursor {after} is invalid.")
+  return query
 
-  users = []
-  for user in queried_users:
-    users.append(user.to_mongo().to_dict())
+def get_users_with_symptoms(limit: int = None, after: str = None) -> list:
+  users = User._get_collection() \
+    .find(_symptomatic_users_query(after), SYMPTOMATIC_USER_FIELDS) \
+    .sort('_id', 1)
+  if limit:
+    users = users.limit(limit)
 
-  return users
+  return list(users)
+
+def _symptomatic_users_page(users: list, limit: int) -> tuple:
+  # Fetched with limit + 1, like timelog pages, so a cursor is only handed out when more users exist
+  next_cursor = None
+  if len(users) > limit:
+    users = users[:limit]
+    next_cursor = str(users[-1]['_id'])
+  return users, next_cursor
+
+def get_users_with_symptoms_page(limit: int, after: str = None) -> tuple:
+  return _symptomatic_users_page(get_users_with_symptoms(limit + 1, after), limit)
+
+def recompute_symptoms(threshold: float = None) -> int:
+  collection = User._get_collection()
+  query = symptoms_query(threshold)
+  flagged = collection.update_many({'$and': [query, {'has_symptoms': {'$ne': True}}]},
+    {'$set': {'has_symptoms': True}})
+  cleared = collection.update_many({'$nor': [query], 'has_symptoms': {'$ne': False}},
+    {'$set': {'has_symptoms': False}})
+  return flagged.modified_count + cleared.modified_count
 
 def delete_user(id) -> None:
   try:
-    User.objects.get(id=id).delete()
+    user = User.objects.get(id=id)
   except DoesNotExist:
     raise UserDoesNotExist(f"User {id} does not exist.")
+  user.delete()
+  user_cache.pop(user.email)
 
 def update_user(email:str, user_data) -> str:
   email = email.replace(' ', '+').strip()
   user_db = get_user_from_email(email)
-  user_db.update(**user_data)
+  user_db.update(**_encode_face_encoding(user_data))
+  if touches_symptoms(user_data):
+    collection = User._get_collection()
+    update = symptoms_flag_update(collection.find_one({'_id': user_db.pk}, {'survey': 1, 'temp': 1, 'has_symptoms': 1}))
+    if update:
+      collection.update_one(*update)
+  user_cache.pop(email)
   return str(user_db.pk)
 
+def migrate_face_encodings(batch_size: int = 500) -> int:
+  collection = User._get_collection()
+  legacy_users = collection.find({'face_encoding.0': {'$exists': True}}, {'face_encoding': 1}) \
+    .batch_size(batch_size)
+
+  migrated = 0
+  batch = []
+  for user in legacy_users:
+    batch.append(UpdateOne(
+      {'_id': user['_id']},
+      {'$set': codec.to_fields(user['face_encoding']), '$unset': {'face_encoding': ""}}
+    ))
+    if len(batch) == batch_size:
+      migrated += collection.bulk_write(batch, ordered=False).modified_count
+      batch = []
+
+  if batch:
+    migrated += collection.bulk_write(batch, ordered=False).modified_count
+
+  return migrated
+
 def create_room(room) -> str:
   new_room = Room(**room)
   try:
@@ -83,38 +238,313 @@ def get_room(room_num):
 def delete_room(room_num) -> None:
   get_room(room_num).delete()
 
-def get_timelogs() -> list:
+def _timestamp_range(since: datetime = None, until: datetime = None) -> dict:
+  timestamp = {}
+  if since:
+    timestamp['$gte'] = since
+  if until:
+    timestamp['$lt'] = until
+  return timestamp
+
+def _timelogs_pipeline(match: dict) -> list:
+  return [
+    {'$match': match},
+    {'$sort': {'room_number': 1, 'timestamp': 1}},
+    {'$project': {
+      '_id': 0,
+      'user_email': 1,
+      'room_number': 1,
+      'timestamp': {'$dateToString': {'format': "%Y-%m-%dT%H:%M:%S", 'date': "$timestamp"}},
+      'direction': 1,
+    }},
+  ]
+
+def get_timelogs(since: datetime = None, until: datetime = None, room_numbers: list = None):
   rooms = Room.objects
+  if room_numbers:
+    rooms = rooms(number__in=room_numbers)
+  rooms = list(rooms.order_by('number').scalar('number'))
+
+  match = {'room_number': {'$in': rooms}}
+  if since or until:
+    match['timestamp'] = _timestamp_range(since, until)
 
-  timelogs = {}
+  # One pass over the collection, sorted by room so rooms can be streamed one after another
+  logs = Timelog._get_collection().aggregate(_timelogs_pipeline(match), allowDiskUse=True)
+
+  logs_by_room = groupby(logs, key=itemgetter('room_number'))
+  group = next(logs_by_room, None)
   for room in rooms:
-    room_timelogs = Timelog.objects(room_number=room.number)
+    if group is not None and group[0] == room:
+      yield room, group[1]
+      group = next(logs_by_room, None)
+    else:
+      yield room, iter(())
+
+# Called with the list of timelog documents after every successful write
+timelog_listeners = []
 
-    timelogs_list = []
-    for room_timelog in room_timelogs:
-      log = room_timelog.to_mongo().to_dict()
-      log['timestamp'] = log['timestamp'].strftime("%Y-%m-%dT%H:%M:%S")
-      timelogs_list.append(log)
+def written_timelogs(documents: list, errors: list = ()) -> list:
+  failed = {error[0] for error in errors}
+  return [document for i, document in enumerate(documents) if i not in failed]
 
-    timelogs[room.number] = timelogs_list
-  
-  return timelogs
+def notify_timelogs(documents: list) -> None:
+  for listener in timelog_listeners:
+    try:
+      listener(documents)
+    except Exception as err:
+      print(f"timelog listener {listener} failed: {err}")
 
+def update_timelog_rollups(documents: list) -> None:
+  updates = rollup.rollup_updates(documents)
+  if not updates:
+    return
+  try:
+    TimelogRollup._get_collection().bulk_write(updates, ordered=False)
+  except PyMongoError as err:
+    # The logs themselves are already written; rebuild-rollups repairs the drift
+    print(f"failed to update timelog rollups: {err}")
+
+def _timelogs_written(documents: list) -> None:
+  if documents:
+    update_timelog_rollups(documents)
+    notify_timelogs(documents)
 
 def create_timelog(timelog) -> str:
   new_timelog = Timelog(**timelog)
   new_timelog.save()
+  _timelogs_written([new_timelog.to_mongo().to_dict()])
   return str(new_timelog.pk)
 
-def get_timelogs_from_room_number(room_num: int) -> list:
+DUPLICATE_KEY_ERROR = 11000
+
+def insert_timelogs(timelogs: list) -> tuple:
+  # Unordered so one bad document doesn't stop the rest of the chunk from being written
+  documents = [Timelog(**timelog).to_mongo().to_dict() for timelog in timelogs]
+  try:
+    result = Timelog._get_collection().insert_many(documents, ordered=False)
+  except BulkWriteError as err:
+    errors = [(error['index'], error['code'], error['errmsg']) for error in err.details['writeErrors']]
+    _timelogs_written(written_timelogs(documents, errors))
+    return err.details['nInserted'], errors
+  _timelogs_written(documents)
+  return len(result.inserted_ids), []
+
+def _rebuild_range(since: datetime = None):
+  oldest = Timelog._get_collection().find_one({}, {'timestamp': 1}, sort=[('timestamp', 1)])
+  if oldest is None:
+    return None
+
+  # Archiving moves whole days, so hours before the oldest hot log's day live only in the archive
+  start = rollup.period_start(oldest['timestamp'], 'day')
+  if since:
+    start = max(start, rollup.hour_bucket(since))
+  # The open hour is still taking live writes, so it's left to the incremental updates
+  until = rollup.hour_bucket(datetime.utcnow())
+  return (start, until) if start < until else None
+
+def rebuild_timelog_rollups(since: datetime = None, batch_size: int = 5000) -> int:
+  """Recomputes the hourly rollups for the closed hours still held in the timelog collection.
+
+  Archived days and the open hour are left alone. The rollups are built in a
+  staging collection and then copied over the live ones, so readers never see
+  the range empty and live inserts aren't counted twice.
+  """
+  hours = _rebuild_range(since)
+  if hours is None:
+    return 0
+
+  live = TimelogRollup._get_collection()
+  staging = live.database[f"{live.name}_rebuild"]
+  staging.drop()
+
+  timelogs = Timelog._get_collection() \
+    .find({'timestamp': _timestamp_range(*hours)}, {'_id': 0, **TIMELOG_FIELDS}) \
+    .batch_size(batch_size)
+
+  replayed = 0
+  batch = []
+  for timelog in timelogs:
+    batch.append(timelog)
+    if len(batch) == batch_size:
+      staging.bulk_write(rollup.rollup_updates(batch), ordered=False)
+      replayed += len(batch)
+      batch = []
+
+  if batch:
+    staging.bulk_write(rollup.rollup_updates(batch), ordered=False)
+    replayed += len(batch)
+
+  # Each rollup is replaced whole, so readers see either the old or the rebuilt count
+  rebuilt = set()
+  swaps = []
+  for doc in staging.find({}, {'_id': 0}).batch_size(batch_size):
+    rebuilt.add((doc['room_number'], doc['hour']))
+    swaps.append(ReplaceOne({'room_number': doc['room_number'], 'hour': doc['hour']}, doc, upsert=True))
+    if len(swaps) == batch_size:
+      live.bulk_write(swaps, ordered=False)
+      swaps = []
+
+  if swaps:
+    live.bulk_write(swaps, ordered=False)
+
+  stale = [
+    doc['_id'] for doc in live.find({'hour': _timestamp_range(*hours)}, {'room_number': 1, 'hour': 1})
+    if (doc['room_number'], doc['hour']) not in rebuilt
+  ]
+  for i in range(0, len(stale), batch_size):
+    live.delete_many({'_id': {'$in': stale[i:i + batch_size]}})
+
+  staging.drop()
+  return replayed
+
+ROLLUP_FIELDS = {'_id': 0, 'room_number': 1, 'hour': 1, 'visits': 1, 'users': 1}
+
+def _rollup_query(room_num: int, since: datetime = None, until: datetime = None) -> dict:
+  query = {'room_number': room_num}
+  if since or until:
+    query['hour'] = _timestamp_range(since, until)
+  return query
+
+def get_room_rollups(room_num: int, since: datetime = None, until: datetime = None) -> list:
+  return list(TimelogRollup._get_collection()
+    .find(_rollup_query(room_num, since, until), ROLLUP_FIELDS)
+    .sort('hour', 1))
+
+def _encode_timelog_cursor(timelog: dict) -> str:
+  token = f"{timelog['timestamp'].isoformat()}|{timelog['_id']}"
+  return urlsafe_b64encode(token.encode('utf-8')).decode('ascii')
+
+def _decode_timelog_cursor(cursor: str) -> tuple:
+  try:
+    timestamp, id = urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('|')
+    return datetime.fromisoformat(timestamp), ObjectId(id)
+  except (ValueError, InvalidId):
+    raise InvalidCursor(f"Cursor {cursor} is invalid.")
+
+TIMELOG_FIELDS = {'user_email': 1, 'room_number': 1, 'timestamp': 1, 'direction': 1}
+TIMELOG_PAGE_SORT = [('timestamp', 1), ('_id', 1)]
+
+def _timelog_page_query(query: dict, since: datetime = None, until: datetime = None,
+  cursor: str = None) -> dict:
+  query = query.copy()
+  if since or until:
+    query['timestamp'] = _timestamp_range(since, until)
+  if cursor:
+    # Keyset on (timestamp, _id): resumes right after the last log of the previous page
+    timestamp, id = _decode_timelog_cursor(cursor)
+    query['$or'] = [
+      {'timestamp': {'$gt': timestamp}},
+      {'timestamp': timestamp, '_id': {'$gt': id}},
+    ]
+  return query
+
+def _timelog_page(timelogs: list, limit: int = None) -> tuple:
+  # Pages are fetched with limit + 1 so a next cursor is only handed out when more logs exist
+  next_cursor = None
+  if limit and len(timelogs) > limit:
+    timelogs = timelogs[:limit]
+    next_cursor = _encode_timelog_cursor(timelogs[-1])
+
+  for timelog in timelogs:
+    timelog.pop('_id')
+
+  return timelogs, next_cursor
+
+def _page_timelogs(query: dict, since: datetime = None, until: datetime = None,
+  limit: int = None, cursor: str = None) -> tuple:
+  timelogs_query = Timelog._get_collection() \
+    .find(_timelog_page_query(query, since, until, cursor), TIMELOG_FIELDS) \
+    .sort(TIMELOG_PAGE_SORT)
+  if limit:
+    timelogs_query = timelogs_query.limit(limit + 1)
+
+  return _timelog_page(list(timelogs_query), limit)
+
+def get_timelogs_from_room_number(room_num: int, since: datetime = None, until: datetime = None,
+  limit: int = None, cursor: str = None) -> list:
+  return get_room_timelogs_page(room_num, since, until, limit, cursor)[0]
+
+def get_room_timelogs_page(room_num: int, since: datetime = None, until: datetime = None,
+  limit: int = None, cursor: str = None) -> tuple:
   get_room(room_num)
-  timelogs_query = Timelog.objects(room_number=room_num).exclude('id').all()
-  
-  timelogs = []
-  for timelog in timelogs_query:
-    timelogs.append(timelog.to_mongo().to_dict())
-  
-  return timelogs
+  return _page_timelogs({'room_number': room_num}, since, until, limit, cursor)
+
+def get_user_timelogs_page(email: str, since: datetime = None, until: datetime = None,
+  limit: int = None, cursor: str = None) -> tuple:
+  email = email.replace(' ', '+').strip()
+  return _page_timelogs({'user_email': email}, since, until, limit, cursor)
+
+def get_user_timelogs(email: str, since: datetime = None, until: datetime = None) -> list:
+  query = {'user_email': email.replace(' ', '+').strip()}
+  if since or until:
+    query['timestamp'] = _timestamp_range(since, until)
+
+  return list(Timelog._get_collection()
+    .find(query, {'_id': 0, **TIMELOG_FIELDS})
+    .sort('timestamp', 1))
+
+def get_recent_timelogs(since: datetime):
+  return Timelog._get_collection() \
+    .find({'timestamp': {'$gte': since}}, {'_id': 0, **TIMELOG_FIELDS}) \
+    .sort('timestamp', 1)
+
+def _room_windows_query(windows: list, exclude_email: str = None) -> dict:
+  # One (room_number, timestamp) range per window, so each branch of the $or is an index range scan
+  query = {'$or': [
+    {'room_number': room, 'timestamp': {'$gte': start, '$lte': end}}
+    for room, start, end in windows
+  ]}
+  if exclude_email:
+    query['user_email'] = {'$ne': exclude_email.replace(' ', '+').strip()}
+  return query
+
+def iter_room_window_timelogs(windows: list, exclude_email: str = None):
+  """Yields the logs inside any of the (room_number, start, end) windows, sorted by room and time."""
+  return Timelog._get_collection() \
+    .find(_room_windows_query(windows, exclude_email), {'_id': 0, **TIMELOG_FIELDS}) \
+    .sort([('room_number', 1), ('timestamp', 1)])
+
+def iter_timelogs_for_export(since: datetime = None, until: datetime = None, room_numbers: list = None,
+  batch_size: int = 1000):
+  query = {}
+  if room_numbers:
+    query['room_number'] = {'$in': room_numbers}
+  if since or until:
+    query['timestamp'] = _timestamp_range(since, until)
+
+  return Timelog._get_collection() \
+    .find(query, {'_id': 0, **TIMELOG_FIELDS}) \
+    .sort('timestamp', 1) \
+    .batch_size(batch_size)
+
+def get_user_contacts(emails: list) -> dict:
+  users = User._get_collection().find({'email': {'$in': emails}},
+    {'_id': 0, 'email': 1, 'first_name': 1, 'last_name': 1, 'contact_number': 1})
+  return {user['email']: user for user in users}
+
+def archive_timelogs(before: datetime, archive_dir: str, batch_size: int = 1000) -> int:
+  collection = Timelog._get_collection()
+  query = {'timestamp': {'$lt': before}}
+
+  archived = 0
+  for room in sorted(collection.distinct('room_number', query)):
+    timelogs = collection \
+      .find({'room_number': room, **query}, TIMELOG_FIELDS) \
+      .sort('timestamp', 1) \
+      .batch_size(batch_size)
+
+    for day, day_timelogs in groupby(timelogs, key=lambda timelog: timelog['timestamp'].date()):
+      day_timelogs = list(day_timelogs)
+      archive.write_day(archive_dir, room, day, day_timelogs)
+
+      # Only deleted once the day's file is safely on disk
+      ids = [timelog['_id'] for timelog in day_timelogs]
+      for i in range(0, len(ids), batch_size):
+        collection.delete_many({'_id': {'$in': ids[i:i + batch_size]}})
+      archived += len(ids)
+
+  return archived
 
 def create_verification(email: str) -> str:
   try:
@@ -0,0 +1,48 @@
+from typing import Optional
+
+import numpy
+from bson.binary import Binary
+
+# Version 1: 128 little-endian float32 values, 512 bytes
+ENCODING_VERSION = 1
+ENCODING_DTYPE = numpy.dtype('<f4')
+ENCODING_BYTES = 128 * ENCODING_DTYPE.itemsize
+
+def pack(encoding) -> Binary:
+  data = numpy.asarray(encoding, dtype=ENCODING_DTYPE).tobytes()
+  if len(data) != ENCODING_BYTES:
+    raise ValueError(f"Face encoding must be {ENCODING_BYTES} bytes, got {len(data)}.")
+  return Binary(data)
+
+def unpack(data: bytes, version: int = ENCODING_VERSION) -> numpy.ndarray:
+  if version != ENCODING_VERSION:
+    raise ValueError(f"Unknown face encoding version {version}.")
+  # Read-only view over the BSON bytes, nothing is copied
+  return numpy.frombuffer(data, dtype=ENCODING_DTYPE)
+
+def to_fields(encoding) -> dict:
+  return {
+    'face_encoding_bin': pack(encoding),
+    'face_encoding_version': ENCODING_VERSION,
+  }
+
+def from_document(user) -> Optional[numpy.ndarray]:
+  get = user.get if isinstance(user, dict) else lambda field: getattr(user, field, None)
+
+  data = get('face_encoding_bin')
+  if data:
+    return unpack(data, get('face_encoding_version') or ENCODING_VERSION)
+
+  # Users enrolled before the binary format still carry a list of floats
+  legacy = get('face_encoding')
+  if legacy:
+    return numpy.asarray(legacy, dtype=ENCODING_DTYPE)
+
+  return None
+
+def to_api(user: dict) -> dict:
+  encoding = from_document(user)
+  user.pop('face_encoding_bin', None)
+  user.pop('face_encoding_version', None)
+  user['face_encoding'] = encoding.tolist() if encoding is not None else None
+  return user
@@ -0,0 +1,123 @@
+import csv
+import io
+import zlib
+from typing import Callable, Iterable, Iterator, List
+
+try:
+  import pyarrow
+except ImportError:
+  pyarrow = None
+
+from exceptions import ExportFormatUnavailable
+
+TIMELOG_COLUMNS = ['timestamp', 'room_number', 'user_email', 'direction']
+USER_COLUMNS = ['first_name', 'last_name', 'contact_number']
+
+def columns(include_users: bool) -> List[str]:
+  return TIMELOG_COLUMNS + USER_COLUMNS if include_users else list(TIMELOG_COLUMNS)
+
+def chunked(items: Iterable, size: int) -> Iterator[list]:
+  chunk = []
+  for item in items:
+    chunk.append(item)
+    if len(chunk) == size:
+      yield chunk
+      chunk = []
+
+  if chunk:
+    yield chunk
+
+def join_users(chunks: Iterable[list], get_users: Callable[[list], dict]) -> Iterator[list]:
+  # One user lookup per chunk, only for the emails that appear in it
+  for chunk in chunks:
+    users = get_users(sorted({timelog['user_email'] for timelog in chunk}))
+    for timelog in chunk:
+      user = users.get(timelog['user_email'], {})
+      for column in USER_COLUMNS:
+        timelog[column] = user.get(column)
+    yield chunk
+
+def to_csv(chunks: Iterable[list], fields: List[str]) -> Iterator[bytes]:
+  buffer = io.StringIO()
+  writer = csv.DictWriter(buffer, fields, extrasaction='ignore')
+  writer.writeheader()
+  for chunk in chunks:
+    writer.writerows({**timelog, 'timestamp': timelog['timestamp'].isoformat()} for timelog in chunk)
+    yield buffer.getvalue().encode('utf-8')
+    buffer.seek(0)
+    buffer.truncate()
+
+  if buffer.tell():
+    yield buffer.getvalue().encode('utf-8')
+
+def arrow_schema(fields: List[str]):
+  types = {
+    'timestamp': pyarrow.timestamp('ms'),
+    'room_number': pyarrow.int64(),
+  }
+  return pyarrow.schema([(field, types.get(field, pyarrow.string())) for field in fields])
+
+class _Drain:
+  # Minimal writable file so the IPC writer's output can be handed out after every batch
+  closed = False
+
+  def __init__(self):
+    self.parts = []
+
+  def write(self, data) -> int:
+    self.parts.append(bytes(data))
+    return len(data)
+
+  def flush(self) -> None:
+    pass
+
+  def take(self) -> bytes:
+    data = b"".join(self.parts)
+    self.parts = []
+    return data
+
+def to_arrow(chunks: Iterable[list], fields: List[str]) -> Iterator[bytes]:
+  """Writes each chunk as one record batch of an Arrow IPC stream."""
+  # Checked before the generator starts so the caller can still send an error response
+  if pyarrow is None:
+    raise ExportFormatUnavailable("Arrow export needs the pyarrow package.")
+  return _arrow_batches(chunks, fields)
+
+def _arrow_batches(chunks: Iterable[list], fields: List[str]) -> Iterator[bytes]:
+  schema = arrow_schema(fields)
+  drain = _Drain()
+  with pyarrow.ipc.new_stream(drain, schema) as writer:
+    for chunk in chunks:
+      batch = pyarrow.record_batch([[timelog.get(field) for timelog in chunk] for field in fields], schema=schema)
+      writer.write_batch(batch)
+      yield drain.take()
+  yield drain.take()
+
+def accepts_gzip(accept_encoding: str) -> bool:
+  """Reads an Accept-Encoding header, honouring q-values (so `gzip;q=0` refuses gzip)."""
+  weights = {}
+  for coding in accept_encoding.split(','):
+    name, *params = [part.strip() for part in coding.split(';')]
+    weight = 1.0
+    for param in params:
+      key, _, value = param.partition('=')
+      if key.strip().lower() == 'q':
+        try:
+          weight = float(value)
+        except ValueError:
+          weight = 0.0
+    if name:
+      weights[name.lower()] = weight
+
+  for name in ('gzip', 'x-gzip', '*'):
+    if name in weights:
+      return weights[name] > 0
+  return False
+
+def gzipped(parts: Iterable[bytes], level: int = 6) -> Iterator[bytes]:
+  compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  for part in parts:
+    data = compressor.compress(part)
+    if data:
+      yield data
+  yield compressor.flush()
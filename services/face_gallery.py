@@ -0,0 +1,456 @@
+import fcntl
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Callable, Iterable, List, Tuple
+
+import numpy
+
+import settings
+
+ENCODING_SIZE = 128
+
+def _ranked(distances: numpy.ndarray, rows: numpy.ndarray, ids: list, emails: list, k: int) -> List[dict]:
+  # distances[i] belongs to rows[i]
+  k = min(k, len(rows))
+  top = numpy.argpartition(distances, k - 1)[:k]
+  top = top[numpy.argsort(distances[top])]
+
+  return [
+    { 'id': ids[rows[i]], 'email': emails[rows[i]], 'distance': float(distances[i]) }
+    for i in top
+  ]
+
+def _top_k(matrix, sq_norms, ids: list, emails: list, encoding, k: int) -> List[dict]:
+  count = len(ids)
+  if count == 0:
+    return []
+
+  # ||a - b||^2 = ||a||^2 - 2a.b + ||b||^2, one matrix-vector product for the whole gallery
+  probe = numpy.asarray(encoding, dtype=numpy.float32)
+  sq_distances = sq_norms[:count] - 2 * (matrix[:count] @ probe) + numpy.dot(probe, probe)
+  distances = numpy.sqrt(numpy.maximum(sq_distances, 0))
+  return _ranked(distances, numpy.arange(count), ids, emails, k)
+
+class FaceGallery:
+  """Every enrolled face encoding in one contiguous float32 matrix.
+
+  Rows are kept packed: removing a user moves the last row into the freed
+  slot, so a search is always a single pass over `matrix[:count]`.
+  """
+
+  # Per-row arrays, grown and compacted together
+  _row_arrays = ('_matrix', '_sq_norms')
+
+  def __init__(self, capacity: int = 1024):
+    self._lock = threading.Lock()
+    self._matrix = numpy.zeros((capacity, ENCODING_SIZE), dtype=numpy.float32)
+    self._sq_norms = numpy.zeros(capacity, dtype=numpy.float32)
+    self._ids: List[str] = []
+    self._emails: List[str] = []
+    self._rows = {}
+
+  def __len__(self) -> int:
+    return len(self._ids)
+
+  def __contains__(self, user_id: str) -> bool:
+    return user_id in self._rows
+
+  def _grow(self) -> None:
+    capacity = max(1, self._matrix.shape[0]) * 2
+    count = len(self._ids)
+    for name in self._row_arrays:
+      old = getattr(self, name)
+      new = numpy.zeros((capacity, *old.shape[1:]), dtype=old.dtype)
+      new[:count] = old[:count]
+      setattr(self, name, new)
+
+  def _set_row(self, row: int, encoding) -> None:
+    self._matrix[row] = numpy.asarray(encoding, dtype=numpy.float32)
+    self._sq_norms[row] = numpy.dot(self._matrix[row], self._matrix[row])
+
+  def _put(self, user_id: str, email: str, encoding) -> None:
+    row = self._rows.get(user_id)
+    if row is None:
+      if len(self._ids) == self._matrix.shape[0]:
+        self._grow()
+      row = len(self._ids)
+      self._rows[user_id] = row
+      self._ids.append(user_id)
+      self._emails.append(email)
+    else:
+      self._emails[row] = email
+
+    self._set_row(row, encoding)
+
+  def upsert(self, user_id: str, email: str, encoding) -> None:
+    with self._lock:
+      self._put(user_id, email, encoding)
+
+  def upsert_many(self, entries: Iterable[Tuple[str, str, list]]) -> None:
+    with self._lock:
+      for user_id, email, encoding in entries:
+        self._put(user_id, email, encoding)
+
+  def load(self, entries: Iterable[Tuple[str, str, list]]) -> int:
+    with self._lock:
+      for user_id, email, encoding in entries:
+        self._put(user_id, email, encoding)
+      return len(self._ids)
+
+  def remove(self, user_id: str) -> bool:
+    with self._lock:
+      row = self._rows.pop(user_id, None)
+      if row is None:
+        return False
+
+      last = len(self._ids) - 1
+      if row != last:
+        for name in self._row_arrays:
+          array = getattr(self, name)
+          array[row] = array[last]
+        self._ids[row] = self._ids[last]
+        self._emails[row] = self._emails[last]
+        self._rows[self._ids[row]] = row
+
+      self._ids.pop()
+      self._emails.pop()
+      return True
+
+  def search(self, encoding, k: int = 5) -> List[dict]:
+    with self._lock:
+      return _top_k(self._matrix, self._sq_norms, self._ids, self._emails, encoding, k)
+
+class QuantizedFaceGallery(FaceGallery):
+  """FaceGallery with an int8 copy of the matrix for a coarse first pass.
+
+  Each dimension is stored as `offset + scale * code` with an int8 code, so
+  the scan reads a quarter of the bytes of the float32 matrix. The `rerank`
+  best coarse candidates are then re-scored exactly in float32. Offsets and
+  scales are fitted on `load`, and refitted by `upsert` once the gallery has
+  doubled since the last fit or a new encoding falls outside the fitted range.
+  """
+
+  _row_arrays = FaceGallery._row_arrays + ('_codes', '_code_sq_norms')
+
+  # Rows converted to float32 at a time during the coarse scan; small enough to stay in cache
+  BLOCK_SIZE = 1024
+
+  def __init__(self, capacity: int = 1024, rerank: int = 64):
+    super().__init__(capacity)
+    self.rerank = rerank
+    self._codes = numpy.zeros((capacity, ENCODING_SIZE), dtype=numpy.int8)
+    self._code_sq_norms = numpy.zeros(capacity, dtype=numpy.float32)
+    # Until fitted, cover [-1, 1], which holds any dlib encoding
+    self._offset = numpy.zeros(ENCODING_SIZE, dtype=numpy.float32)
+    self._scale = numpy.full(ENCODING_SIZE, 1 / 127, dtype=numpy.float32)
+    self._fitted_count = 0
+    # Reused by every search (they run under the lock) so the scan never allocates
+    self._block = numpy.empty((self.BLOCK_SIZE, ENCODING_SIZE), dtype=numpy.float32)
+
+  def _quantize(self, encodings: numpy.ndarray) -> numpy.ndarray:
+    return numpy.clip(numpy.rint((encodings - self._offset) / self._scale), -127, 127).astype(numpy.int8)
+
+  def _set_codes(self, rows) -> None:
+    self._codes[rows] = self._quantize(self._matrix[rows])
+    scaled = self._codes[rows].astype(numpy.float32) * self._scale
+    self._code_sq_norms[rows] = numpy.einsum('...i,...i->...', scaled, scaled)
+
+  def _set_row(self, row: int, encoding) -> None:
+    super()._set_row(row, encoding)
+    self._set_codes(row)
+
+  def _fit(self) -> None:
+    count = len(self._ids)
+    if count == 0:
+      return
+    low = self._matrix[:count].min(axis=0)
+    high = self._matrix[:count].max(axis=0)
+    self._offset = (low + high) / 2
+    self._scale = numpy.maximum((high - low) / 2 / 127, 1e-8).astype(numpy.float32)
+    self._set_codes(slice(0, count))
+    self._fitted_count = count
+
+  def _out_of_range(self, rows) -> bool:
+    return bool(numpy.abs((self._matrix[rows] - self._offset) / self._scale).max() > 127.5)
+
+  def _refit_if_needed(self, rows) -> None:
+    # A range fitted on a few rows would clip most later enrollments; doubling keeps refits amortized
+    if len(self._ids) >= 2 * self._fitted_count or self._out_of_range(rows):
+      self._fit()
+
+  def load(self, entries: Iterable[Tuple[str, str, list]]) -> int:
+    count = super().load(entries)
+    with self._lock:
+      self._fit()
+    return count
+
+  def upsert(self, user_id: str, email: str, encoding) -> None:
+    with self._lock:
+      self._put(user_id, email, encoding)
+      self._refit_if_needed(self._rows[user_id])
+
+  def upsert_many(self, entries: Iterable[Tuple[str, str, list]]) -> None:
+    with self._lock:
+      rows = []
+      for user_id, email, encoding in entries:
+        self._put(user_id, email, encoding)
+        rows.append(self._rows[user_id])
+      if rows:
+        self._refit_if_needed(rows)
+
+  def _coarse_sq_distances(self, probe: numpy.ndarray, count: int) -> numpy.ndarray:
+    # ||q - (o + s*c)||^2 minus the constant ||q - o||^2 term
+    weights = (probe - self._offset) * self._scale * -2
+    sq_distances = numpy.empty(count, dtype=numpy.float32)
+    for start in range(0, count, self.BLOCK_SIZE):
+      end = min(start + self.BLOCK_SIZE, count)
+      block = self._block[:end - start]
+      block[...] = self._codes[start:end]
+      numpy.matmul(block, weights, out=sq_distances[start:end])
+    sq_distances += self._code_sq_norms[:count]
+    return sq_distances
+
+  def search(self, encoding, k: int = 5) -> List[dict]:
+    probe = numpy.asarray(encoding, dtype=numpy.float32)
+
+    with self._lock:
+      count = len(self._ids)
+      candidates = max(self.rerank, k)
+      if count <= candidates:
+        return _top_k(self._matrix, self._sq_norms, self._ids, self._emails, probe, k)
+
+      coarse = self._coarse_sq_distances(probe, count)
+      rows = numpy.argpartition(coarse, candidates - 1)[:candidates]
+      sq_distances = self._sq_norms[rows] - 2 * (self._matrix[rows] @ probe) + numpy.dot(probe, probe)
+      distances = numpy.sqrt(numpy.maximum(sq_distances, 0))
+      return _ranked(distances, rows, self._ids, self._emails, k)
+
+# Mapped gallery file layout, little-endian:
+#   64 byte header: magic, encoding size, generation, row count, index size
+#   row count x ENCODING_SIZE float32 encodings
+#   row count float32 squared norms
+#   JSON index {"ids": [...], "emails": [...]} in row order
+_MAGIC = b'IQFG'
+_HEADER = struct.Struct('<4sIQQQ')
+_HEADER_SIZE = 64
+
+class _MappedView:
+  def __init__(self, path: str):
+    with open(path, 'rb') as file:
+      stat = os.fstat(file.fileno())
+      self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, size, self.generation, count, index_size = _HEADER.unpack_from(self._mmap)
+    if magic != _MAGIC or size != ENCODING_SIZE:
+      raise ValueError(f"{path} is not a face gallery file.")
+
+    self.key = (stat.st_dev, stat.st_ino)
+    self.matrix = numpy.frombuffer(self._mmap, '<f4', count * ENCODING_SIZE, _HEADER_SIZE) \
+      .reshape(count, ENCODING_SIZE)
+    norms_offset = _HEADER_SIZE + self.matrix.nbytes
+    self.sq_norms = numpy.frombuffer(self._mmap, '<f4', count, norms_offset)
+    index_offset = norms_offset + self.sq_norms.nbytes
+    index = json.loads(self._mmap[index_offset:index_offset + index_size])
+    self.ids = index['ids']
+    self.emails = index['emails']
+    self.rows = {user_id: row for row, user_id in enumerate(self.ids)}
+
+def _collect(entries: Iterable[Tuple[str, str, list]], ids: list, emails: list) -> numpy.ndarray:
+  rows = []
+  for user_id, email, encoding in entries:
+    ids.append(user_id)
+    emails.append(email)
+    rows.append(numpy.asarray(encoding, dtype=numpy.float32))
+  return numpy.array(rows, dtype=numpy.float32).reshape(len(rows), ENCODING_SIZE)
+
+def _write_gallery(path: str, generation: int, matrix: numpy.ndarray, ids: list, emails: list) -> None:
+  matrix = numpy.ascontiguousarray(matrix, dtype='<f4').reshape(len(ids), ENCODING_SIZE)
+  sq_norms = numpy.einsum('ij,ij->i', matrix, matrix).astype('<f4')
+  index = json.dumps({'ids': ids, 'emails': emails}).encode('utf-8')
+
+  fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+  try:
+    with os.fdopen(fd, 'wb') as file:
+      file.write(_HEADER.pack(_MAGIC, ENCODING_SIZE, generation, len(ids), len(index)).ljust(_HEADER_SIZE, b'\0'))
+      file.write(matrix.tobytes())
+      file.write(sq_norms.tobytes())
+      file.write(index)
+      file.flush()
+      os.fsync(file.fileno())
+    # Readers still holding the old file keep a valid mapping of it until they remap
+    os.replace(tmp_path, path)
+  except BaseException:
+    os.unlink(tmp_path)
+    raise
+
+class MappedGallery:
+  """The gallery as a memory-mapped file shared by every worker process.
+
+  Searches run directly on the read-only mapping. Writers take an exclusive
+  flock, write the next generation to a temp file and os.replace it; each
+  reader notices the new inode on its next call and remaps. Every write
+  rewrites the whole file, which is fine for enrollment-rate updates.
+  """
+
+  def __init__(self, path: str):
+    self.path = path
+    self._lock = threading.Lock()
+    self._view = None
+
+  @contextmanager
+  def _write_lock(self):
+    with open(f"{self.path}.lock", 'a') as lock_file:
+      fcntl.flock(lock_file, fcntl.LOCK_EX)
+      try:
+        yield
+      finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+  def _current(self) -> _MappedView:
+    stat = os.stat(self.path)
+    with self._lock:
+      if self._view is None or self._view.key != (stat.st_dev, stat.st_ino):
+        self._view = _MappedView(self.path)
+      return self._view
+
+  @property
+  def generation(self) -> int:
+    return self._current().generation if os.path.exists(self.path) else 0
+
+  def __len__(self) -> int:
+    return len(self._current().ids)
+
+  def __contains__(self, user_id: str) -> bool:
+    return user_id in self._current().rows
+
+  def _rewrite(self, change: Callable) -> None:
+    with self._write_lock():
+      if os.path.exists(self.path):
+        view = self._current()
+        matrix, ids, emails, generation = numpy.array(view.matrix), list(view.ids), list(view.emails), view.generation
+      else:
+        matrix, ids, emails, generation = numpy.zeros((0, ENCODING_SIZE), dtype=numpy.float32), [], [], 0
+
+      matrix = change(matrix, ids, emails)
+      if matrix is not None:
+        _write_gallery(self.path, generation + 1, matrix, ids, emails)
+
+  def upsert(self, user_id: str, email: str, encoding) -> None:
+    self.upsert_many([(user_id, email, encoding)])
+
+  def upsert_many(self, entries: Iterable[Tuple[str, str, list]]) -> None:
+    """Applies every entry in one rewrite of the file."""
+    entries = list(entries)
+
+    def change(matrix, ids, emails):
+      if not entries:
+        return None
+      rows = {user_id: row for row, user_id in enumerate(ids)}
+      added = []
+      for user_id, email, encoding in entries:
+        encoding_row = numpy.asarray(encoding, dtype=numpy.float32).reshape(ENCODING_SIZE)
+        row = rows.get(user_id)
+        if row is not None and row >= len(matrix):
+          # Added earlier in this same batch
+          added[row - len(matrix)] = encoding_row
+          emails[row] = email
+        elif row is not None:
+          matrix[row] = encoding_row
+          emails[row] = email
+        else:
+          rows[user_id] = len(ids)
+          ids.append(user_id)
+          emails.append(email)
+          added.append(encoding_row)
+      return numpy.vstack([matrix, *added]) if added else matrix
+
+    self._rewrite(change)
+
+  def remove(self, user_id: str) -> bool:
+    removed = []
+
+    def change(matrix, ids, emails):
+      if user_id not in ids:
+        return None
+      row = ids.index(user_id)
+      del ids[row], emails[row]
+      removed.append(row)
+      return numpy.delete(matrix, row, axis=0)
+
+    self._rewrite(change)
+    return bool(removed)
+
+  def load(self, entries: Iterable[Tuple[str, str, list]]) -> int:
+    """Replaces the whole gallery with `entries` as a new generation."""
+    def change(matrix, ids, emails):
+      ids.clear()
+      emails.clear()
+      return _collect(entries, ids, emails)
+
+    self._rewrite(change)
+    return len(self)
+
+  def open_or_build(self, get_entries: Callable[[], Iterable[Tuple[str, str, list]]]) -> int:
+    """Maps the file, rebuilding it first if it is missing, unreadable or out of date with `get_entries()`.
+
+    A file left by an earlier deployment can miss enrollments made while no
+    worker was running. Workers start one at a time under the write lock, so
+    only the first one to find the file out of date rewrites it.
+    """
+    with self._write_lock():
+      entries = list(get_entries())
+      generation = 0
+      if os.path.exists(self.path):
+        try:
+          report = self.check(entries)
+        except (ValueError, struct.error) as err:
+          print(f"rebuilding unreadable face gallery {self.path}: {err}")
+        else:
+          if not (report['missing'] or report['extra'] or report['mismatched']):
+            return report['rows']
+          generation = report['generation']
+          print(f"rebuilding stale face gallery {self.path}: {len(report['missing'])} missing, "
+            f"{len(report['extra'])} extra, {len(report['mismatched'])} mismatched")
+
+      ids, emails = [], []
+      _write_gallery(self.path, generation + 1, _collect(entries, ids, emails), ids, emails)
+    return len(self)
+
+  def search(self, encoding, k: int = 5) -> List[dict]:
+    view = self._current()
+    return _top_k(view.matrix, view.sq_norms, view.ids, view.emails, encoding, k)
+
+  def check(self, entries: Iterable[Tuple[str, str, list]], tolerance: float = 1e-6) -> dict:
+    """Compares the mapped file against `entries` (normally the database)."""
+    view = self._current()
+    missing, mismatched, seen = [], [], set()
+    for user_id, email, encoding in entries:
+      seen.add(user_id)
+      row = view.rows.get(user_id)
+      if row is None:
+        missing.append(user_id)
+      elif view.emails[row] != email or \
+        not numpy.allclose(view.matrix[row], numpy.asarray(encoding, dtype=numpy.float32), atol=tolerance):
+        mismatched.append(user_id)
+
+    return {
+      'generation': view.generation,
+      'rows': len(view.ids),
+      'missing': missing,
+      'extra': [user_id for user_id in view.ids if user_id not in seen],
+      'mismatched': mismatched,
+    }
+
+def _make_gallery():
+  if settings.FACE_GALLERY_PATH:
+    return MappedGallery(settings.FACE_GALLERY_PATH)
+  if settings.FACE_GALLERY_BACKEND == 'quantized':
+    return QuantizedFaceGallery(rerank=settings.FACE_GALLERY_RERANK)
+  return FaceGallery()
+
+gallery = _make_gallery()
@@ -0,0 +1,91 @@
+import asyncio
+import hashlib
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import settings
+import services.face_recog as face_recog
+from services.cache import LRUCache
+from exceptions import FacePipelineIsBusy, CannotReadFace, HasMoreThanOneFace
+
+_executor = None
+_pending = 0
+_pending_lock = threading.Lock()
+
+# Outcomes that depend only on the image bytes, so they are as cacheable as an encoding
+CACHED_ERRORS = (CannotReadFace, HasMoreThanOneFace)
+
+# Rough per-entry cost of the key, tuple and OrderedDict slot on top of the encoding itself
+_ENTRY_OVERHEAD = 256
+
+def _entry_size(value) -> int:
+  return getattr(value, 'nbytes', 0) + _ENTRY_OVERHEAD
+
+# Keyed by a hash of the uploaded bytes; kiosks and retrying clients resend identical images
+cache = LRUCache(settings.FACE_CACHE_SIZE, settings.FACE_CACHE_TTL_SECONDS,
+  settings.FACE_CACHE_MAX_BYTES, _entry_size)
+
+def _ping() -> bool:
+  return True
+
+def start(workers: int = settings.FACE_POOL_WORKERS) -> None:
+  global _executor
+  if _executor is not None or workers <= 0:
+    return
+
+  # spawn instead of fork so workers don't inherit the event loop or open mongo sockets
+  _executor = ProcessPoolExecutor(
+    max_workers=workers,
+    mp_context=multiprocessing.get_context('spawn'),
+    initializer=face_recog.warm_up,
+  )
+
+  # Workers are started lazily; submitting one task per worker gets them all loaded up front
+  for future in [_executor.submit(_ping) for _ in range(workers)]:
+    future.result()
+
+def shutdown() -> None:
+  global _executor
+  if _executor is not None:
+    _executor.shutdown(wait=True)
+    _executor = None
+
+def pending() -> int:
+  return _pending
+
+async def run(func, *args, max_queue: int = settings.FACE_POOL_MAX_QUEUE):
+  global _pending
+  with _pending_lock:
+    if _pending >= max_queue:
+      raise FacePipelineIsBusy("Face pipeline is busy. Try again later.")
+    _pending += 1
+
+  try:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, func, *args)
+  finally:
+    with _pending_lock:
+      _pending -= 1
+
+def image_key(data: bytes) -> bytes:
+  return hashlib.blake2b(data, digest_size=16).digest()
+
+async def encode_image(data: bytes):
+  key = image_key(data)
+  cached = cache.get(key)
+  if isinstance(cached, CACHED_ERRORS):
+    raise type(cached)(*cached.args)
+  if cached is not None:
+    return cached
+
+  try:
+    encoding = await run(face_recog.encode_image, data)
+  except CACHED_ERRORS as err:
+    cache.set(key, err)
+    raise
+
+  # Shared between callers from now on, so nobody may modify it in place
+  encoding.setflags(write=False)
+  cache.set(key, encoding)
+  return encoding
@@ -1,23 +1,68 @@
+import io
+from typing import NamedTuple
+
 import numpy
 
 import face_recognition as fr
-from PIL import Image
+from PIL import Image, ImageOps
 
+import settings
 from exceptions import CannotReadFace, HasMoreThanOneFace
 
+class FaceProfile(NamedTuple):
+  detector: str
+  upsample: int
+  num_jitters: int
+  landmark_model: str
+  max_decode_size: int
+  detect_size: int
+
+PROFILE = FaceProfile(
+  detector=settings.FACE_DETECTOR_MODEL,
+  upsample=settings.FACE_UPSAMPLE,
+  num_jitters=settings.FACE_NUM_JITTERS,
+  landmark_model=settings.FACE_LANDMARK_MODEL,
+  max_decode_size=settings.FACE_MAX_DECODE_SIZE,
+  detect_size=settings.FACE_DETECT_SIZE,
+)
+
 def load_image(image_path: str):
   return fr.load_image_file(image_path)
 
-def generate_face_encoding(image) -> numpy.ndarray:
-  encodings = fr.face_encodings(image)
-  
-  if len(encodings) > 1:
-    raise HasMoreThanOneFace(
-      f"{image} has been detected to have more than one face.")
-  elif len(encodings) == 0:
+def _scale_box(box: tuple, scale: float, height: int, width: int) -> tuple:
+  top, right, bottom, left = box
+  return (
+    max(0, int(top * scale)),
+    min(width, int(round(right * scale))),
+    min(height, int(round(bottom * scale))),
+    max(0, int(left * scale)),
+  )
+
+def detect_faces(image: numpy.ndarray, profile: FaceProfile = PROFILE) -> list:
+  # Detection is the slow step and doesn't need full resolution, so it runs on a
+  # smaller copy; the boxes are mapped back for landmarks and encoding.
+  height, width = image.shape[:2]
+  scale = min(1.0, profile.detect_size / max(height, width)) if profile.detect_size else 1.0
+  if scale < 1.0:
+    small_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    small = numpy.asarray(Image.fromarray(image).resize(small_size, Image.BILINEAR))
+  else:
+    small = image
+
+  boxes = fr.face_locations(small, number_of_times_to_upsample=profile.upsample, model=profile.detector)
+  if scale == 1.0:
+    return boxes
+  return [_scale_box(box, 1 / scale, height, width) for box in boxes]
+
+def generate_face_encoding(image, profile: FaceProfile = PROFILE) -> numpy.ndarray:
+  locations = detect_faces(image, profile)
+
+  if len(locations) > 1:
+    raise HasMoreThanOneFace("Image has been detected to have more than one face.")
+  elif len(locations) == 0:
     raise CannotReadFace(f"Can't read face in image.")
-  
-  return encodings[0]
+
+  return fr.face_encodings(image, locations, num_jitters=profile.num_jitters, model=profile.landmark_model)[0]
 
 def compare_faces(known_encoding: list, unknown_encoding: list, tolerance: float = 0.6) -> bool:
   distance = fr.face_distance([numpy.array(known_encoding)], unknown_encoding)[0]
@@ -30,14 +75,30 @@ def compare_faces(known_encoding: list, unknown_encoding: list, tolerance: float
   else:
     return False
 
-def resize_image(image_name: str, max_size: tuple = (500, 500)) -> str:
-  image = Image.open(image_name)
-  image.thumbnail(max_size)
-  width, height = image.size
+def identify_face(gallery, unknown_encoding, k: int = 5, tolerance: float = 0.6) -> list:
+  matches = gallery.search(unknown_encoding, k)
+  for match in matches:
+    match['is_match'] = match['distance'] <= tolerance
 
-  if height < width:
-    image = image.rotate(90, expand=True)
+  return matches
 
-  image.save("resized.jpg")
-  return "resized.jpg"
+def warm_up(profile: FaceProfile = PROFILE) -> None:
+  # Runs the detector and encoder once so the dlib models are loaded before the first real request
+  blank = numpy.zeros((32, 32, 3), dtype=numpy.uint8)
+  fr.face_locations(blank, number_of_times_to_upsample=0, model=profile.detector)
+  fr.face_encodings(blank, [(0, 32, 32, 0)], model=profile.landmark_model)
 
+def decode_image(data: bytes) -> Image.Image:
+  return Image.open(io.BytesIO(data))
+
+def encode_image(data: bytes, profile: FaceProfile = PROFILE) -> numpy.ndarray:
+  max_size = (profile.max_decode_size, profile.max_decode_size)
+  image = resize_image(decode_image(data), max_size)
+  return generate_face_encoding(numpy.asarray(image.convert('RGB')), profile)
+
+def resize_image(image: Image.Image, max_size: tuple = (500, 500)) -> Image.Image:
+  # thumbnail() lets JPEG decode straight at a reduced scale instead of full resolution
+  image.thumbnail(max_size)
+  # Phones store portrait shots sideways with an EXIF orientation tag; frames without one
+  # (kiosk webcams) are already upright, whatever their aspect ratio
+  return ImageOps.exif_transpose(image)
@@ -0,0 +1,169 @@
+import csv
+import io
+import json
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import partial
+from hashlib import blake2b
+from itertools import islice
+from typing import Callable, Iterable, Iterator, Optional
+
+from bson import ObjectId
+from mongoengine.errors import ValidationError as DocumentValidationError
+from pydantic import ValidationError
+
+import settings
+import services.db_service as db
+import services.auth_service as auth
+from models import Timelog, UserIn
+
+_hash_executor = None
+
+def parse_json_array(body: bytes) -> Iterator:
+  items = json.loads(body)
+  if not isinstance(items, list):
+    raise ValueError("Body must be a JSON array of timelogs.")
+  return iter(items)
+
+def parse_ndjson(body: bytes) -> Iterator:
+  for line in body.splitlines():
+    if not line.strip():
+      continue
+    try:
+      yield json.loads(line)
+    except ValueError as err:
+      yield err
+
+def parse_csv(body: bytes) -> Iterator:
+  # Empty cells are left out so optional fields fall back to their defaults
+  for row in csv.DictReader(io.StringIO(body.decode('utf-8-sig'))):
+    yield {key: value for key, value in row.items() if key and value not in (None, "")}
+
+def timelog_id(idempotency_key: str, index: int, timestamp) -> ObjectId:
+  # Same key and position always map to the same _id, so a replayed batch only hits duplicate keys
+  digest = blake2b(f"{idempotency_key}:{index}".encode('utf-8'), digest_size=8).digest()
+  return ObjectId(ObjectId.from_datetime(timestamp).binary[:4] + digest)
+
+def _validate(items: Iterable, idempotency_key: Optional[str], errors: list) -> Iterator:
+  for index, item in enumerate(items):
+    if isinstance(item, Exception):
+      errors.append({'index': index, 'error': f"Invalid JSON: {item}"})
+      continue
+
+    try:
+      timelog = Timelog.parse_obj(item).dict()
+    except ValidationError as err:
+      errors.append({'index': index, 'error': err.errors()})
+      continue
+
+    if idempotency_key:
+      timelog['id'] = timelog_id(idempotency_key, index, timelog['timestamp'])
+    yield index, timelog
+
+def ingest_timelogs(items: Iterable, idempotency_key: Optional[str] = None,
+  chunk_size: int = settings.TIMELOG_BULK_CHUNK_SIZE) -> dict:
+  report = {'received': 0, 'inserted': 0, 'duplicates': 0, 'errors': []}
+  validated = _validate(items, idempotency_key, report['errors'])
+
+  while True:
+    chunk = list(islice(validated, chunk_size))
+    if not chunk:
+      break
+
+    inserted, write_errors = db.insert_timelogs([timelog for _, timelog in chunk])
+    report['inserted'] += inserted
+    for position, code, message in write_errors:
+      if code == db.DUPLICATE_KEY_ERROR:
+        report['duplicates'] += 1
+      else:
+        report['errors'].append({'index': chunk[position][0], 'error': message})
+
+  report['received'] = report['inserted'] + report['duplicates'] + len(report['errors'])
+  report['errors'].sort(key=lambda error: error['index'])
+  return report
+
+def _validate_users(items: Iterable, errors: list) -> Iterator:
+  for index, item in enumerate(items):
+    if isinstance(item, Exception):
+      errors.append({'index': index, 'error': f"Invalid JSON: {item}"})
+      continue
+
+    try:
+      user = UserIn.parse_obj(item)
+    except ValidationError as err:
+      errors.append({'index': index, 'error': err.errors()})
+      continue
+
+    # Same as /users/register: imported accounts are never admins
+    user.is_admin = False
+    user = user.dict()
+
+    # The document has limits of its own (e.g. name lengths); one bad row mustn't sink its chunk
+    try:
+      db.validate_new_user(user)
+    except DocumentValidationError as err:
+      errors.append({'index': index, 'error': err.to_dict()})
+      continue
+    yield index, user
+
+def start(workers: int = settings.USER_IMPORT_HASH_WORKERS) -> None:
+  global _hash_executor
+  if _hash_executor is not None or workers <= 0:
+    return
+
+  # bcrypt dominates an import; a pool of its own keeps it from starving logins on the bcrypt threads
+  _hash_executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+def shutdown() -> None:
+  global _hash_executor
+  if _hash_executor is not None:
+    _hash_executor.shutdown(wait=True)
+    _hash_executor = None
+
+def _import_chunks(validated: Iterator, report: dict, chunk_size: int, hash_executor: Optional[Executor],
+  rounds: int, on_enrolled: Optional[Callable[[list], None]]) -> None:
+  hash_password = partial(auth.generate_hashed_password, rounds=rounds)
+  # Without a pool (not started, or no workers configured) passwords are hashed on the calling thread
+  hash_many = hash_executor.map if hash_executor is not None else map
+  while True:
+    chunk = list(islice(validated, chunk_size))
+    if not chunk:
+      break
+
+    passwords = [user['password'] for _, user in chunk]
+    for (_, user), hashed_password in zip(chunk, hash_many(hash_password, passwords)):
+      user['password'] = hashed_password
+
+    inserted, write_errors = db.insert_users([user for _, user in chunk])
+    report['inserted'] += inserted
+    for position, code, message in write_errors:
+      index, user = chunk[position]
+      if code == db.DUPLICATE_KEY_ERROR:
+        report['duplicates'].append({'index': index, 'email': user['email'], 'error': f"{user['email']} is already taken"})
+      else:
+        report['errors'].append({'index': index, 'error': message})
+
+    if on_enrolled is not None:
+      failed = {position for position, _, _ in write_errors}
+      enrolled = [user['email'] for position, (_, user) in enumerate(chunk)
+        if position not in failed and user.get('face_encoding')]
+      if enrolled:
+        on_enrolled(enrolled)
+
+def import_users(items: Iterable, chunk_size: int = settings.USER_IMPORT_CHUNK_SIZE,
+  hash_executor: Executor = None, rounds: int = None, on_enrolled: Callable[[list], None] = None) -> dict:
+  """Registers users in bulk; a bad or duplicate row is reported without stopping the rest.
+
+  Passwords are hashed on hash_executor, or else on the pool shared by every
+  import, so concurrent imports don't each spawn workers of their own.
+  `on_enrolled` gets the emails of each chunk's inserted users that came
+  with a face encoding.
+  """
+  report = {'received': 0, 'inserted': 0, 'duplicates': [], 'errors': []}
+  validated = _validate_users(items, report['errors'])
+  _import_chunks(validated, report, chunk_size, hash_executor or _hash_executor, rounds, on_enrolled)
+
+  report['received'] = report['inserted'] + len(report['duplicates']) + len(report['errors'])
+  report['errors'].sort(key=lambda error: error['index'])
+  report['duplicates'].sort(key=lambda duplicate: duplicate['index'])
+  return report
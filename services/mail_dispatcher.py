@@ -0,0 +1,211 @@
+import email
+import heapq
+import itertools
+import os
+import queue
+import smtplib
+import threading
+import time
+from email.message import Message
+
+import settings
+import services.mail_service as mail
+
+class MailDispatcher:
+  """Background sender that reuses one authenticated SMTP connection.
+
+  Messages are queued by `send` and written out in batches by a worker
+  thread. Failed messages are retried with exponential backoff, and the
+  connection is closed after `idle_timeout` seconds without mail. Messages
+  still waiting for a retry at shutdown are written to `spool_dir` and queued
+  again by the next start().
+  """
+
+  def __init__(self, connect_func=mail.connect_smtp, batch_size: int = 20, max_retries: int = 5,
+    backoff: float = 2.0, max_backoff: float = 300.0, idle_timeout: float = 60.0, spool_dir: str = None):
+    self.connect_func = connect_func
+    self.batch_size = batch_size
+    self.max_retries = max_retries
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.idle_timeout = idle_timeout
+    self.spool_dir = spool_dir
+
+    self._queue = queue.Queue()
+    self._retries = []
+    self._sequence = itertools.count()
+    self._server = None
+    self._last_used = 0.0
+    self._thread = None
+    self._stopping = threading.Event()
+
+    self.sent = 0
+    self.failed = 0
+    self.retried = 0
+    self.spooled = 0
+    self.connections = 0
+
+  @property
+  def is_running(self) -> bool:
+    return self._thread is not None
+
+  def start(self) -> None:
+    if self._thread is not None:
+      return
+    self._unspool()
+    self._stopping.clear()
+    self._thread = threading.Thread(target=self._run, name="mail-dispatcher", daemon=True)
+    self._thread.start()
+
+  def stop(self, timeout: float = 10.0) -> None:
+    if self._thread is None:
+      return
+    self._stopping.set()
+    self._queue.put(None)
+    self._thread.join(timeout)
+    self._thread = None
+    self._close()
+    self._spool()
+
+  def _spool(self) -> None:
+    # Everything queued was attempted before the worker exited; what's left is waiting out a backoff
+    messages = [message for _, _, message, _ in self._retries]
+    self._retries = []
+    while True:
+      try:
+        item = self._queue.get_nowait()
+      except queue.Empty:
+        break
+      if item is not None:
+        messages.append(item[0])
+    if not messages:
+      return
+    if not self.spool_dir:
+      print(f"mail dispatcher dropped {len(messages)} unsent messages at shutdown")
+      return
+
+    os.makedirs(self.spool_dir, exist_ok=True)
+    for message in messages:
+      path = os.path.join(self.spool_dir, f"{time.time_ns()}-{next(self._sequence)}.eml")
+      with open(path, 'wb') as file:
+        file.write(message.as_bytes())
+    self.spooled += len(messages)
+    print(f"mail dispatcher spooled {len(messages)} unsent messages to {self.spool_dir}")
+
+  def _unspool(self) -> None:
+    if not self.spool_dir or not os.path.isdir(self.spool_dir):
+      return
+
+    for name in sorted(os.listdir(self.spool_dir)):
+      if not name.endswith('.eml'):
+        continue
+      path = os.path.join(self.spool_dir, name)
+      with open(path, 'rb') as file:
+        self.send(email.message_from_binary_file(file))
+      os.remove(path)
+
+  def send(self, message: Message) -> None:
+    self._queue.put((message, 0))
+
+  def _next_timeout(self) -> float:
+    if self._retries:
+      return max(0.0, self._retries[0][0] - time.monotonic())
+    return self.idle_timeout if self._server is not None else None
+
+  def _take_batch(self) -> list:
+    batch = []
+    while self._retries and self._retries[0][0] <= time.monotonic() and len(batch) < self.batch_size:
+      _, _, message, attempts = heapq.heappop(self._retries)
+      batch.append((message, attempts))
+
+    if not batch:
+      try:
+        item = self._queue.get(timeout=self._next_timeout())
+      except queue.Empty:
+        return batch
+      if item is None:
+        return batch
+      batch.append(item)
+
+    while len(batch) < self.batch_size:
+      try:
+        item = self._queue.get_nowait()
+      except queue.Empty:
+        break
+      if item is None:
+        self._queue.put(None)
+        break
+      batch.append(item)
+
+    return batch
+
+  def _run(self) -> None:
+    while True:
+      batch = self._take_batch()
+      if batch:
+        self._send_batch(batch)
+      elif self._stopping.is_set() and self._queue.empty():
+        return
+      elif self._server is not None and time.monotonic() - self._last_used >= self.idle_timeout:
+        self._close()
+
+  def _connection(self):
+    if self._server is None:
+      self._server = self.connect_func()
+      self.connections += 1
+    return self._server
+
+  def _close(self) -> None:
+    if self._server is not None:
+      try:
+        self._server.quit()
+      except Exception:
+        pass
+      self._server = None
+
+  def _send_batch(self, batch: list) -> None:
+    for message, attempts in batch:
+      try:
+        self._connection().sendmail(message['From'], message['To'], message.as_string())
+        self._last_used = time.monotonic()
+        self.sent += 1
+      except smtplib.SMTPRecipientsRefused as err:
+        self.failed += 1
+        print(f"mail to {message['To']} refused: {err}")
+      except Exception as err:
+        # The connection may be what broke, so the next attempt starts from a fresh one.
+        # Anything unexpected is retried the same way, so it can't take the worker thread down.
+        if not isinstance(err, (smtplib.SMTPException, OSError)):
+          print(f"unexpected error sending mail to {message['To']}: {err!r}")
+        self._close()
+        self._retry(message, attempts, err)
+
+  def _retry(self, message: Message, attempts: int, err: Exception) -> None:
+    if attempts >= self.max_retries:
+      self.failed += 1
+      print(f"giving up on mail to {message['To']} after {attempts + 1} attempts: {err}")
+      return
+
+    delay = min(self.backoff * 2 ** attempts, self.max_backoff)
+    heapq.heappush(self._retries, (time.monotonic() + delay, next(self._sequence), message, attempts + 1))
+    self.retried += 1
+
+  def metrics(self) -> dict:
+    return {
+      'enabled': self.is_running,
+      'queued': self._queue.qsize(),
+      'retrying': len(self._retries),
+      'sent': self.sent,
+      'failed': self.failed,
+      'retried': self.retried,
+      'spooled': self.spooled,
+      'connections': self.connections,
+    }
+
+dispatcher = MailDispatcher(
+  batch_size=settings.MAIL_BATCH_SIZE,
+  max_retries=settings.MAIL_MAX_RETRIES,
+  backoff=settings.MAIL_RETRY_BACKOFF_SECONDS,
+  idle_timeout=settings.MAIL_IDLE_TIMEOUT_SECONDS,
+  spool_dir=settings.MAIL_SPOOL_DIR,
+)
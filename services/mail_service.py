@@ -2,7 +2,7 @@ import smtplib, ssl
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
-from settings import (SMTP_PORT, SMTP_SERVER, 
+from settings import (SMTP_PORT, SMTP_SERVER, SMTP_USE_SSL,
   SENDER_EMAIL, EMAIL_PASSWORD, API_URL)
 
 def _getMessage(name: str, verification_id: str) -> tuple:
@@ -44,7 +44,7 @@ def _getMessage(name: str, verification_id: str) -> tuple:
 
   return (text, html)
 
-def send_verification_email(receiver_email: str, name: str, verification_id: str):
+def build_verification_email(receiver_email: str, name: str, verification_id: str) -> MIMEMultipart:
   message = MIMEMultipart("alternative")
   message["Subject"] = "IQTrace Email Verification"
   message["From"] = SENDER_EMAIL
@@ -56,8 +56,21 @@ def send_verification_email(receiver_email: str, name: str, verification_id: str
 
   message.attach(text_mime)
   message.attach(html_mime)
+  return message
+
+def connect_smtp(host: str = SMTP_SERVER, port: int = SMTP_PORT, use_ssl: bool = SMTP_USE_SSL):
+  if use_ssl:
+    context = ssl.create_default_context()
+    server = smtplib.SMTP_SSL(host, port, context=context)
+  else:
+    server = smtplib.SMTP(host, port)
 
-  context = ssl.create_default_context()
-  with smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT, context=context) as server:
+  if EMAIL_PASSWORD:
     server.login(SENDER_EMAIL, EMAIL_PASSWORD)
+  return server
+
+def send_verification_email(receiver_email: str, name: str, verification_id: str):
+  message = build_verification_email(receiver_email, name, verification_id)
+
+  with connect_smtp() as server:
     server.sendmail(SENDER_EMAIL, receiver_email, msg=message.as_string())
@@ -0,0 +1,139 @@
+import heapq
+import itertools
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Iterable
+
+import settings
+import services.db_service as db
+
+def _utc(timestamp: datetime) -> datetime:
+  if timestamp.tzinfo is not None:
+    return timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+  return timestamp
+
+class OccupancyTracker:
+  """Live per-room head counts kept up to date from timelog writes.
+
+  An entry puts the user in that room (and takes them out of any other),
+  an exit takes them out, and anyone not seen for `dwell_timeout` is
+  assumed to have left. Counts are plain dict lookups; expiry is applied
+  lazily from a heap ordered by expiry time.
+
+  Writes only reach the tracker of the process that made them. With more
+  than one worker, `load_func` (recent timelogs since a given time) and a
+  `refresh_interval` make each tracker rebuild itself from the database at
+  most that many seconds apart, so counts lag other workers' writes by no
+  more than the interval.
+  """
+
+  def __init__(self, dwell_timeout: timedelta, refresh_interval: float = 0.0,
+    load_func: Callable[[datetime], Iterable[dict]] = None):
+    self.dwell_timeout = dwell_timeout
+    self.refresh_interval = refresh_interval
+    self._load = load_func
+    self._refreshed_at = None
+    self._lock = threading.Lock()
+    self._presence = {}
+    self._rooms = {}
+    self._expiries = []
+    self._sequence = itertools.count()
+
+  def _leave(self, email: str) -> None:
+    room, _, _ = self._presence.pop(email)
+    occupants = self._rooms[room]
+    occupants.discard(email)
+    if not occupants:
+      del self._rooms[room]
+
+  def _record(self, email: str, room: int, timestamp: datetime, direction: str = None) -> None:
+    timestamp = _utc(timestamp)
+    current = self._presence.get(email)
+    if current is not None and timestamp < current[1]:
+      # Late-arriving log older than what we already know about this user
+      return
+
+    if current is not None:
+      self._leave(email)
+    if direction == 'exit':
+      return
+
+    expires_at = timestamp + self.dwell_timeout
+    self._presence[email] = (room, timestamp, expires_at)
+    self._rooms.setdefault(room, set()).add(email)
+    heapq.heappush(self._expiries, (expires_at, next(self._sequence), email))
+
+  def _compact(self) -> None:
+    # Every log pushes an expiry, but only each user's latest one matters; without
+    # queries to pop them the heap would otherwise grow with every write
+    if len(self._expiries) <= 2 * len(self._presence) + 64:
+      return
+    self._expiries = [(expires_at, next(self._sequence), email)
+      for email, (_, _, expires_at) in self._presence.items()]
+    heapq.heapify(self._expiries)
+
+  def _expire(self, now: datetime) -> None:
+    while self._expiries and self._expiries[0][0] <= now:
+      expires_at, _, email = heapq.heappop(self._expiries)
+      current = self._presence.get(email)
+      if current is not None and current[2] == expires_at:
+        self._leave(email)
+
+  def record(self, email: str, room: int, timestamp: datetime, direction: str = None) -> None:
+    with self._lock:
+      self._record(email, room, timestamp, direction)
+      self._compact()
+
+  def record_many(self, timelogs: Iterable[dict]) -> None:
+    with self._lock:
+      for timelog in timelogs:
+        self._record(timelog['user_email'], timelog['room_number'], timelog['timestamp'], timelog.get('direction'))
+      self._compact()
+
+  def rebuild(self, timelogs: Iterable[dict]) -> int:
+    # Read before taking the lock so counts aren't held up by the query
+    timelogs = list(timelogs)
+    with self._lock:
+      self._presence.clear()
+      self._rooms.clear()
+      self._expiries.clear()
+      for timelog in timelogs:
+        self._record(timelog['user_email'], timelog['room_number'], timelog['timestamp'], timelog.get('direction'))
+      return len(self._presence)
+
+  def refresh(self) -> int:
+    with self._lock:
+      self._refreshed_at = time.monotonic()
+    if self._load is None:
+      return len(self._presence)
+    return self.rebuild(self._load(datetime.utcnow() - self.dwell_timeout))
+
+  def _refresh_if_stale(self) -> None:
+    if self._load is None or self.refresh_interval <= 0:
+      return
+    with self._lock:
+      stale = self._refreshed_at is None or time.monotonic() - self._refreshed_at >= self.refresh_interval
+      if stale:
+        # Claimed up front so concurrent readers don't all hit the database at once
+        self._refreshed_at = time.monotonic()
+    if stale:
+      self.rebuild(self._load(datetime.utcnow() - self.dwell_timeout))
+
+  def count(self, room: int, now: datetime = None) -> int:
+    self._refresh_if_stale()
+    with self._lock:
+      self._expire(now or datetime.utcnow())
+      return len(self._rooms.get(room, ()))
+
+  def counts(self, now: datetime = None) -> dict:
+    self._refresh_if_stale()
+    with self._lock:
+      self._expire(now or datetime.utcnow())
+      return {room: len(occupants) for room, occupants in self._rooms.items()}
+
+tracker = OccupancyTracker(
+  timedelta(minutes=settings.OCCUPANCY_DWELL_MINUTES),
+  refresh_interval=settings.OCCUPANCY_REFRESH_SECONDS,
+  load_func=db.get_recent_timelogs,
+)
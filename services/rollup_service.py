@@ -0,0 +1,69 @@
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Iterable
+
+from pymongo import UpdateOne
+
+PERIODS = ('hour', 'day', 'week', 'month')
+
+def hour_bucket(timestamp: datetime) -> datetime:
+  if timestamp.tzinfo is not None:
+    timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+  return timestamp.replace(minute=0, second=0, microsecond=0)
+
+def period_start(timestamp: datetime, period: str) -> datetime:
+  hour = hour_bucket(timestamp)
+  if period == 'hour':
+    return hour
+  day = hour.replace(hour=0)
+  if period == 'day':
+    return day
+  if period == 'week':
+    return day - timedelta(days=day.weekday())
+  return day.replace(day=1)
+
+def rollup_updates(timelogs: Iterable[dict]) -> list:
+  # One upsert per (room, hour) touched, however many logs landed in it
+  buckets = defaultdict(lambda: [0, set()])
+  for timelog in timelogs:
+    # Leaving a room isn't a visit; logs without a direction predate it and count as entries
+    if timelog.get('direction') == 'exit':
+      continue
+    bucket = buckets[(timelog['room_number'], hour_bucket(timelog['timestamp']))]
+    bucket[0] += 1
+    bucket[1].add(timelog['user_email'])
+
+  return [
+    UpdateOne(
+      {'room_number': room, 'hour': hour},
+      {'$inc': {'visits': visits}, '$addToSet': {'users': {'$each': sorted(users)}}},
+      upsert=True
+    )
+    for (room, hour), (visits, users) in buckets.items()
+  ]
+
+def summarize(rollups: Iterable[dict], period: str) -> list:
+  """Folds hourly rollups (sorted by hour) into day, week or month buckets."""
+  buckets = {}
+  for rollup in rollups:
+    start = period_start(rollup['hour'], period)
+    bucket = buckets.get(start)
+    if bucket is None:
+      bucket = buckets[start] = {'start': start, 'visits': 0, 'users': set(), 'peak_hour': None, 'peak_visits': 0}
+
+    bucket['visits'] += rollup['visits']
+    bucket['users'].update(rollup['users'])
+    if rollup['visits'] > bucket['peak_visits']:
+      bucket['peak_hour'] = rollup['hour']
+      bucket['peak_visits'] = rollup['visits']
+
+  return [
+    {
+      'start': bucket['start'],
+      'visits': bucket['visits'],
+      'unique_users': len(bucket['users']),
+      'peak_hour': bucket['peak_hour'],
+      'peak_visits': bucket['peak_visits'],
+    }
+    for bucket in buckets.values()
+  ]
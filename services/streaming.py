@@ -0,0 +1,67 @@
+import json
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator, Tuple
+
+CHUNK_SIZE = 64 * 1024
+
+def buffered(parts: Iterable[str], chunk_size: int = CHUNK_SIZE) -> Iterator[str]:
+  # Coalesces many small JSON fragments so each write to the socket carries a useful amount of data
+  buffer = []
+  size = 0
+  for part in parts:
+    buffer.append(part)
+    size += len(part)
+    if size >= chunk_size:
+      yield "".join(buffer)
+      buffer = []
+      size = 0
+
+  if buffer:
+    yield "".join(buffer)
+
+def json_object_of_arrays(groups: Iterable[Tuple[object, Iterable[dict]]]) -> Iterator[str]:
+  yield "{"
+  for i, (key, items) in enumerate(groups):
+    yield f'{"," if i else ""}{json.dumps(str(key))}:['
+    for j, item in enumerate(items):
+      yield f'{"," if j else ""}{json.dumps(item)}'
+    yield "]"
+  yield "}"
+
+async def async_buffered(parts: AsyncIterable[str], chunk_size: int = CHUNK_SIZE) -> AsyncIterator[str]:
+  buffer = []
+  size = 0
+  async for part in parts:
+    buffer.append(part)
+    size += len(part)
+    if size >= chunk_size:
+      yield "".join(buffer)
+      buffer = []
+      size = 0
+
+  if buffer:
+    yield "".join(buffer)
+
+async def async_json_object_of_arrays(groups: AsyncIterable[Tuple[object, AsyncIterable[dict]]]) -> AsyncIterator[str]:
+  yield "{"
+  i = 0
+  async for key, items in groups:
+    yield f'{"," if i else ""}{json.dumps(str(key))}:['
+    j = 0
+    async for item in items:
+      yield f'{"," if j else ""}{json.dumps(item)}'
+      j += 1
+    yield "]"
+    i += 1
+  yield "}"
+
+async def async_json_array(items: AsyncIterable, dumps=json.dumps) -> AsyncIterator[str]:
+  yield "["
+  i = 0
+  async for item in items:
+    yield f'{"," if i else ""}{dumps(item)}'
+    i += 1
+  yield "]"
+
+async def async_ndjson(items: AsyncIterable, dumps=json.dumps) -> AsyncIterator[str]:
+  async for item in items:
+    yield f"{dumps(item)}\n"
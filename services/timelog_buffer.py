@@ -0,0 +1,179 @@
+import os
+import threading
+import time
+
+from bson import ObjectId, json_util
+
+import settings
+import services.db_service as db
+from exceptions import TimelogBufferIsFull
+
+class TimelogBuffer:
+  """Write-behind queue for single timelog writes, flushed with insert_many.
+
+  A flush happens once `flush_size` logs are waiting or `flush_interval`
+  seconds after the last one, whichever comes first. Logs that still can't be
+  written at shutdown are appended to `spill_path` and queued again by the
+  next start().
+  """
+
+  def __init__(self, flush_size: int, flush_interval: float, max_size: int, insert_func=db.insert_timelogs,
+    spill_path: str = None, shutdown_retries: int = 3):
+    self.flush_size = flush_size
+    self.flush_interval = flush_interval
+    self.max_size = max_size
+    self.spill_path = spill_path
+    self.shutdown_retries = shutdown_retries
+    self._insert = insert_func
+    self._pending = []
+    self._condition = threading.Condition()
+    self._flush_lock = threading.Lock()
+    self._thread = None
+    self._stopping = False
+
+    self._flushes = 0
+    self._failed_flushes = 0
+    self._flushed = 0
+    self._duplicates = 0
+    self._rejected = 0
+    self._spilled = 0
+    self._last_flush_ms = 0.0
+    self._max_flush_ms = 0.0
+    self._total_flush_ms = 0.0
+
+  @property
+  def is_running(self) -> bool:
+    return self._thread is not None
+
+  def __len__(self) -> int:
+    return len(self._pending)
+
+  def start(self) -> None:
+    if self._thread is not None:
+      return
+    self._restore()
+    self._stopping = False
+    self._thread = threading.Thread(target=self._run, name="timelog-buffer", daemon=True)
+    self._thread.start()
+
+  def stop(self) -> None:
+    if self._thread is None:
+      return
+    with self._condition:
+      self._stopping = True
+      self._condition.notify()
+    self._thread.join()
+    self._thread = None
+
+    for attempt in range(self.shutdown_retries):
+      if attempt:
+        time.sleep(self.flush_interval)
+      self.flush()
+      if not self._pending:
+        return
+    self._spill()
+
+  def _spill(self) -> None:
+    with self._condition:
+      batch, self._pending = self._pending, []
+    if not batch:
+      return
+    if not self.spill_path:
+      print(f"timelog buffer dropped {len(batch)} unflushed logs at shutdown")
+      return
+
+    # Appended, so logs spilled by an earlier run that never restarted aren't overwritten
+    with open(self.spill_path, 'a', encoding='utf-8') as file:
+      for timelog in batch:
+        file.write(f"{json_util.dumps(timelog)}\n")
+      file.flush()
+      os.fsync(file.fileno())
+    self._spilled += len(batch)
+    print(f"timelog buffer spilled {len(batch)} unflushed logs to {self.spill_path}")
+
+  def _restore(self) -> None:
+    if not self.spill_path or not os.path.exists(self.spill_path):
+      return
+
+    options = json_util.JSONOptions(tz_aware=False)
+    with open(self.spill_path, encoding='utf-8') as file:
+      timelogs = [json_util.loads(line, json_options=options) for line in file if line.strip()]
+    # Spilled logs keep their ids, so any that did reach mongo only come back as duplicates
+    with self._condition:
+      self._pending = timelogs + self._pending
+    os.remove(self.spill_path)
+    print(f"timelog buffer restored {len(timelogs)} spilled logs from {self.spill_path}")
+
+  def add(self, timelog: dict) -> str:
+    timelog = {**timelog, 'id': ObjectId()}
+    with self._condition:
+      if len(self._pending) >= self.max_size:
+        raise TimelogBufferIsFull("Timelog buffer is full. Try again later.")
+      self._pending.append(timelog)
+      if len(self._pending) >= self.flush_size:
+        self._condition.notify()
+    return str(timelog['id'])
+
+  def _run(self) -> None:
+    while True:
+      with self._condition:
+        if not self._stopping and len(self._pending) < self.flush_size:
+          self._condition.wait(self.flush_interval)
+        if self._stopping:
+          return
+      self.flush()
+
+  def flush(self) -> int:
+    with self._flush_lock:
+      with self._condition:
+        batch, self._pending = self._pending, []
+      if not batch:
+        return 0
+
+      started = time.perf_counter()
+      try:
+        inserted, write_errors = self._insert(batch)
+      except Exception as err:
+        # Keep the logs for the next attempt rather than dropping them
+        with self._condition:
+          self._pending = batch + self._pending
+        self._failed_flushes += 1
+        print(f"timelog buffer flush failed: {err}")
+        return 0
+
+      # Duplicates are logs a failed flush had already written; anything else was rejected by mongo
+      rejected = [(index, message) for index, code, message in write_errors if code != db.DUPLICATE_KEY_ERROR]
+      self._duplicates += len(write_errors) - len(rejected)
+      self._rejected += len(rejected)
+      for index, message in rejected:
+        print(f"timelog buffer dropped {batch[index]['id']}: {message}")
+
+      elapsed_ms = (time.perf_counter() - started) * 1000
+      self._flushes += 1
+      self._flushed += inserted
+      self._last_flush_ms = elapsed_ms
+      self._max_flush_ms = max(self._max_flush_ms, elapsed_ms)
+      self._total_flush_ms += elapsed_ms
+      return inserted
+
+  def metrics(self) -> dict:
+    return {
+      'enabled': self.is_running,
+      'depth': len(self._pending),
+      'flushes': self._flushes,
+      'failed_flushes': self._failed_flushes,
+      'flushed': self._flushed,
+      'duplicates': self._duplicates,
+      'rejected': self._rejected,
+      'spilled': self._spilled,
+      'last_flush_ms': round(self._last_flush_ms, 3),
+      'avg_flush_ms': round(self._total_flush_ms / self._flushes, 3) if self._flushes else 0.0,
+      'max_flush_ms': round(self._max_flush_ms, 3),
+    }
+
+buffer = TimelogBuffer(
+  flush_size=settings.TIMELOG_FLUSH_SIZE,
+  flush_interval=settings.TIMELOG_FLUSH_INTERVAL_MS / 1000,
+  max_size=settings.TIMELOG_BUFFER_MAX_SIZE,
+  spill_path=settings.TIMELOG_SPILL_PATH,
+)
@@ -0,0 +1,76 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+from itertools import groupby
+from operator import itemgetter
+
+import services.db_service as db
+
+def find_contacts(index_logs, room_logs, window: timedelta) -> list:
+  # index_logs: the index case's logs; room_logs: everyone else's, sorted by (room_number, timestamp)
+  index_times = defaultdict(list)
+  for log in index_logs:
+    index_times[log['room_number']].append(log['timestamp'])
+  for times in index_times.values():
+    times.sort()
+
+  contacts = {}
+  for room, logs in groupby(room_logs, key=itemgetter('room_number')):
+    times = index_times.get(room)
+    if not times:
+      continue
+
+    # Both sides are time-sorted, so the earliest index check-in still in range only ever moves forward
+    i = 0
+    for log in logs:
+      timestamp = log['timestamp']
+      while i < len(times) and times[i] < timestamp - window:
+        i += 1
+      if i == len(times):
+        break
+      if times[i] > timestamp + window:
+        continue
+
+      contact = contacts.get(log['user_email'])
+      if contact is None:
+        contact = contacts[log['user_email']] = {
+          'user_email': log['user_email'],
+          'overlaps': 0,
+          'rooms': set(),
+          'first_contact': timestamp,
+          'last_contact': timestamp,
+        }
+      contact['overlaps'] += 1
+      contact['rooms'].add(room)
+      contact['first_contact'] = min(contact['first_contact'], timestamp)
+      contact['last_contact'] = max(contact['last_contact'], timestamp)
+
+  for contact in contacts.values():
+    contact['rooms'] = sorted(contact['rooms'])
+
+  return sorted(contacts.values(), key=lambda contact: (-contact['overlaps'], contact['user_email']))
+
+def visit_windows(index_logs, window: timedelta) -> list:
+  """Merges each index check-in's +/- window into non-overlapping (room_number, start, end) ranges."""
+  windows = []
+  logs = sorted(index_logs, key=itemgetter('room_number', 'timestamp'))
+  for room, room_logs in groupby(logs, key=itemgetter('room_number')):
+    start = end = None
+    for log in room_logs:
+      if end is not None and log['timestamp'] - window <= end:
+        end = log['timestamp'] + window
+        continue
+      if end is not None:
+        windows.append((room, start, end))
+      start, end = log['timestamp'] - window, log['timestamp'] + window
+    windows.append((room, start, end))
+
+  return windows
+
+def trace_contacts(email: str, since: datetime, until: datetime, window: timedelta) -> list:
+  index_logs = db.get_user_timelogs(email, since, until)
+  if not index_logs:
+    return []
+
+  # The query only narrows the scan to the visits; the sweep still decides which logs overlap
+  room_logs = db.iter_room_window_timelogs(visit_windows(index_logs, window), exclude_email=email)
+  return find_contacts(index_logs, room_logs, window)
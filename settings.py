@@ -14,5 +14,82 @@ SMTP_PORT = int(os.environ.get("SMTP_PORT"))
 SMTP_SERVER = os.environ.get("SMTP_SERVER")
 SENDER_EMAIL = os.environ.get("SENDER_EMAIL")
 EMAIL_PASSWORD = os.environ.get("SENDER_EMAIL_PASSWORD")
+SMTP_USE_SSL = os.environ.get("SMTP_USE_SSL", "true").lower() == "true"
+MAIL_BATCH_SIZE = int(os.environ.get("MAIL_BATCH_SIZE", 20))
+MAIL_MAX_RETRIES = int(os.environ.get("MAIL_MAX_RETRIES", 5))
+MAIL_RETRY_BACKOFF_SECONDS = float(os.environ.get("MAIL_RETRY_BACKOFF_SECONDS", 2))
+MAIL_IDLE_TIMEOUT_SECONDS = float(os.environ.get("MAIL_IDLE_TIMEOUT_SECONDS", 60))
+MAIL_SPOOL_DIR = os.environ.get("MAIL_SPOOL_DIR", "mail-spool")
+
+MONGO_URI = os.environ.get("MONGO_URI", "mongodb://localhost:27017")
+MONGO_DB = os.environ.get("MONGO_DB", "iqtrace")
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", 100))
+MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", 10))
+MONGO_MAX_IDLE_TIME_MS = int(os.environ.get("MONGO_MAX_IDLE_TIME_MS", 60000))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", 5000))
 
 ALLOWED_MIME_TYPES = ["image/png", "image/jpeg"]
+
+FACE_POOL_WORKERS = int(os.environ.get("FACE_POOL_WORKERS", os.cpu_count() or 1))
+FACE_POOL_MAX_QUEUE = int(os.environ.get("FACE_POOL_MAX_QUEUE", 32))
+
+FACE_DETECTOR_MODEL = os.environ.get("FACE_DETECTOR_MODEL", "hog")
+FACE_UPSAMPLE = int(os.environ.get("FACE_UPSAMPLE", 1))
+FACE_NUM_JITTERS = int(os.environ.get("FACE_NUM_JITTERS", 1))
+FACE_LANDMARK_MODEL = os.environ.get("FACE_LANDMARK_MODEL", "large")
+FACE_MAX_DECODE_SIZE = int(os.environ.get("FACE_MAX_DECODE_SIZE", 500))
+FACE_DETECT_SIZE = int(os.environ.get("FACE_DETECT_SIZE", 250))
+
+# When set, workers share one memory-mapped gallery file instead of each keeping its own copy
+FACE_GALLERY_PATH = os.environ.get("FACE_GALLERY_PATH", "")
+
+# exact: float32 brute force; quantized: int8 scan, then exact re-ranking of the best FACE_GALLERY_RERANK
+FACE_GALLERY_BACKEND = os.environ.get("FACE_GALLERY_BACKEND", "exact")
+FACE_GALLERY_RERANK = int(os.environ.get("FACE_GALLERY_RERANK", 64))
+IDENTIFY_MAX_MATCHES = int(os.environ.get("IDENTIFY_MAX_MATCHES", 50))
+
+FACE_CACHE_SIZE = int(os.environ.get("FACE_CACHE_SIZE", 4096))
+FACE_CACHE_TTL_SECONDS = int(os.environ.get("FACE_CACHE_TTL_SECONDS", 600))
+FACE_CACHE_MAX_BYTES = int(os.environ.get("FACE_CACHE_MAX_BYTES", 8 * 1024 * 1024))
+
+TRACING_WINDOW_MINUTES = int(os.environ.get("TRACING_WINDOW_MINUTES", 15))
+TRACING_LOOKBACK_DAYS = int(os.environ.get("TRACING_LOOKBACK_DAYS", 14))
+
+TIMELOG_PAGE_LIMIT = int(os.environ.get("TIMELOG_PAGE_LIMIT", 100))
+TIMELOG_PAGE_MAX_LIMIT = int(os.environ.get("TIMELOG_PAGE_MAX_LIMIT", 1000))
+
+TIMELOG_BULK_CHUNK_SIZE = int(os.environ.get("TIMELOG_BULK_CHUNK_SIZE", 1000))
+TIMELOG_BULK_MAX_BYTES = int(os.environ.get("TIMELOG_BULK_MAX_BYTES", 16 * 1024 * 1024))
+
+TIMELOG_WRITE_BEHIND = os.environ.get("TIMELOG_WRITE_BEHIND", "false").lower() == "true"
+TIMELOG_FLUSH_SIZE = int(os.environ.get("TIMELOG_FLUSH_SIZE", 500))
+TIMELOG_FLUSH_INTERVAL_MS = int(os.environ.get("TIMELOG_FLUSH_INTERVAL_MS", 200))
+TIMELOG_BUFFER_MAX_SIZE = int(os.environ.get("TIMELOG_BUFFER_MAX_SIZE", 50000))
+TIMELOG_SPILL_PATH = os.environ.get("TIMELOG_SPILL_PATH", "timelog-spill.ndjson")
+
+USERS_PAGE_LIMIT = int(os.environ.get("USERS_PAGE_LIMIT", 100))
+USERS_PAGE_MAX_LIMIT = int(os.environ.get("USERS_PAGE_MAX_LIMIT", 1000))
+
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", 12))
+BCRYPT_MAX_WORKERS = int(os.environ.get("BCRYPT_MAX_WORKERS", 4))
+
+USER_IMPORT_CHUNK_SIZE = int(os.environ.get("USER_IMPORT_CHUNK_SIZE", 500))
+USER_IMPORT_HASH_WORKERS = int(os.environ.get("USER_IMPORT_HASH_WORKERS", os.cpu_count() or 1))
+USER_IMPORT_MAX_BYTES = int(os.environ.get("USER_IMPORT_MAX_BYTES", 16 * 1024 * 1024))
+
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", 10000))
+TOKEN_CACHE_TTL_SECONDS = int(os.environ.get("TOKEN_CACHE_TTL_SECONDS", 300))
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL_SECONDS = int(os.environ.get("USER_CACHE_TTL_SECONDS", 0))
+
+FEVER_THRESHOLD = float(os.environ.get("FEVER_THRESHOLD", 38.0))
+
+OCCUPANCY_DWELL_MINUTES = int(os.environ.get("OCCUPANCY_DWELL_MINUTES", 60))
+OCCUPANCY_REFRESH_SECONDS = float(os.environ.get("OCCUPANCY_REFRESH_SECONDS", 30))
+
+TIMELOG_EXPORT_CHUNK_SIZE = int(os.environ.get("TIMELOG_EXPORT_CHUNK_SIZE", 5000))
+
+TIMELOG_RETENTION_DAYS = int(os.environ.get("TIMELOG_RETENTION_DAYS", 60))
+TIMELOG_ARCHIVE_DIR = os.environ.get("TIMELOG_ARCHIVE_DIR", "archive")
+
+VERIFICATION_TTL_HOURS = int(os.environ.get("VERIFICATION_TTL_HOURS", 48))
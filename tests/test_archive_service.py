@@ -0,0 +1,73 @@
+import gzip
+import json
+import os
+import stat
+from datetime import date, datetime
+
+from bson import ObjectId
+
+import services.archive_service as archive
+
+def timelog(user_email, timestamp, room_number=16):
+  return {
+    '_id': ObjectId(),
+    'user_email': user_email,
+    'room_number': room_number,
+    'timestamp': timestamp
+  }
+
+def read(lines):
+  return [json.loads(line)['user_email'] for line in lines]
+
+def test__write_day__writes_sorted_gzip_ndjson(tmp_path):
+  archive.write_day(str(tmp_path), 16, date(2021, 9, 16), [
+    timelog("juan@gmail.com", datetime(2021, 9, 16, 9)),
+    timelog("ryan@gmail.com", datetime(2021, 9, 16, 8)),
+  ])
+
+  path = tmp_path / "2021" / "09" / "16" / "room-16.ndjson.gz"
+  with gzip.open(path, 'rt') as file:
+    records = [json.loads(line) for line in file]
+
+  assert [record['user_email'] for record in records] == ["ryan@gmail.com", "juan@gmail.com"]
+  assert records[0]['timestamp'] == "2021-09-16T08:00:00"
+
+def test__write_day__syncs_file_before_replace_and_directories_after(tmp_path, monkeypatch):
+  events = []
+  fsync, replace = archive.os.fsync, archive.os.replace
+  monkeypatch.setattr(archive.os, 'fsync', lambda fd: events.append(('fsync', stat.S_ISDIR(os.fstat(fd).st_mode)))
+    or fsync(fd))
+  monkeypatch.setattr(archive.os, 'replace', lambda src, dst: events.append(('replace', None)) or replace(src, dst))
+
+  archive.write_day(str(tmp_path), 16, date(2021, 9, 16), [timelog("ryan@gmail.com", datetime(2021, 9, 16, 8))])
+
+  # File, then the rename, then the day, month, year and root directories
+  assert events == [('fsync', False), ('replace', None)] + [('fsync', True)] * 4
+
+def test__write_day__merges_without_duplicates(tmp_path):
+  first = timelog("ryan@gmail.com", datetime(2021, 9, 16, 8))
+  archive.write_day(str(tmp_path), 16, date(2021, 9, 16), [first])
+
+  count = archive.write_day(str(tmp_path), 16, date(2021, 9, 16), [
+    first,
+    timelog("juan@gmail.com", datetime(2021, 9, 16, 7)),
+  ])
+
+  assert count == 2
+  assert list(tmp_path.glob("**/*.tmp")) == []
+
+def test__read_range__filters_partial_days_and_rooms(tmp_path):
+  root = str(tmp_path)
+  archive.write_day(root, 16, date(2021, 9, 16), [
+    timelog("early@gmail.com", datetime(2021, 9, 16, 6)),
+    timelog("ryan@gmail.com", datetime(2021, 9, 16, 12)),
+  ])
+  archive.write_day(root, 16, date(2021, 9, 17), [timelog("juan@gmail.com", datetime(2021, 9, 17, 12))])
+  archive.write_day(root, 17, date(2021, 9, 17), [timelog("maria@gmail.com", datetime(2021, 9, 17, 13))])
+  archive.write_day(root, 16, date(2021, 9, 18), [timelog("late@gmail.com", datetime(2021, 9, 18, 12))])
+
+  lines = archive.read_range(root, datetime(2021, 9, 16, 8), datetime(2021, 9, 18, 8))
+  assert read(lines) == ["ryan@gmail.com", "juan@gmail.com", "maria@gmail.com"]
+
+  lines = archive.read_range(root, datetime(2021, 9, 16), datetime(2021, 9, 19), room_numbers=[17])
+  assert read(lines) == ["maria@gmail.com"]
@@ -0,0 +1,218 @@
+import asyncio
+from datetime import date, datetime
+
+import numpy
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+import services.async_db_service as adb
+from exceptions import (EmailIsAlreadyTaken, RoomDoesNotExist,
+  UserDoesNotExist, VerificationItemDoesNotExist, InvalidField)
+
+@pytest.fixture
+def user():
+  return {
+    'email': "ryan@gmail.com",
+    'password': "password",
+    'first_name': "Ryan",
+    'last_name': "Dineros",
+    'contact_number': "09294137458",
+    'birthday': date(1996, 9, 16),
+    'address': "Quezon City"
+  }
+
+def timelog(user_email, timestamp, room_number=16):
+  return {
+    'user_email': user_email,
+    'room_number': room_number,
+    'timestamp': timestamp
+  }
+
+@pytest.fixture(autouse=True)
+def setup_db():
+  client = AsyncMongoMockClient()
+  adb.initialize_db(client)
+  asyncio.run(adb._collection(adb.User).create_index('email', unique=True))
+
+  yield
+
+  adb.close_db()
+
+def test__create_user__user_is_created(user):
+  async def scenario():
+    id = await adb.create_user(user)
+    return id, await adb.get_user_from_email(user['email'])
+
+  id, created = asyncio.run(scenario())
+
+  assert str(created['_id']) == id
+  assert created['birthday'] == datetime(1996, 9, 16)
+
+def test__create_user__raise_if_email_is_taken(user):
+  async def scenario():
+    await adb.create_user(user)
+    await adb.create_user(user)
+
+  with pytest.raises(EmailIsAlreadyTaken):
+    asyncio.run(scenario())
+
+def test__update_user__updates_user_and_encodes_face(user):
+  async def scenario():
+    id = await adb.create_user(user)
+    updated_id = await adb.update_user(user['email'], {'first_name': "Ramses Ryan", 'face_encoding': [0.5] * 128})
+    return id, updated_id, await adb.get_user_from_email(user['email'])
+
+  id, updated_id, updated = asyncio.run(scenario())
+
+  assert id == updated_id
+  assert updated['first_name'] == "Ramses Ryan"
+  assert numpy.allclose(adb.codec.from_document(updated), 0.5)
+
+def test__update_user__nonexistent_user_raises_exception():
+  with pytest.raises(UserDoesNotExist):
+    asyncio.run(adb.update_user("nobody@gmail.com", {'temp': 36.5}))
+
+def test__delete_user__nonexistent_user_raises_exception():
+  with pytest.raises(UserDoesNotExist):
+    asyncio.run(adb.delete_user("6123361c16cce88331c423b1"))
+
+def test__get_users_with_symptoms__returns_feverish_or_surveyed_users(user):
+  async def scenario():
+    for email, data in [("fever@gmail.com", {'temp': 38.5}), ("fine@gmail.com", {'temp': 36.5}),
+      ("cough@gmail.com", {'survey': ["cough"]})]:
+      await adb.create_user({**user, 'email': email, **data})
+    return await adb.get_users_with_symptoms()
+
+  users = asyncio.run(scenario())
+
+  assert sorted(user['email'] for user in users) == ["cough@gmail.com", "fever@gmail.com"]
+
+def test__update_user__maintains_has_symptoms_flag(user):
+  async def scenario():
+    await adb.create_user(user)
+    await adb.update_user(user['email'], {'temp': 38.5})
+    feverish = await adb.get_users_with_symptoms()
+    await adb.update_user(user['email'], {'temp': 36.5})
+    return feverish, await adb.get_users_with_symptoms()
+
+  feverish, recovered = asyncio.run(scenario())
+
+  assert [user['email'] for user in feverish] == ["ryan@gmail.com"]
+  assert recovered == []
+
+def test__get_timelogs__groups_logs_by_room():
+  async def scenario():
+    await adb.create_room({'number': 16, 'name': "My Room"})
+    await adb.create_room({'number': 2, 'name': "Empty Room"})
+    await adb.create_timelog(timelog("test2", datetime(2021, 9, 16, 9, 30)))
+    await adb.create_timelog(timelog("test1", datetime(2021, 9, 16, 8, 0)))
+
+    return {room: [log async for log in logs] async for room, logs in adb.get_timelogs()}
+
+  timelogs = asyncio.run(scenario())
+
+  assert list(timelogs) == [2, 16]
+  assert timelogs[2] == []
+  assert [log['user_email'] for log in timelogs[16]] == ["test1", "test2"]
+
+def test__get_room_timelogs_page__walks_pages_with_cursor():
+  async def scenario():
+    await adb.create_room({'number': 16, 'name': "My Room"})
+    for i in range(5):
+      await adb.create_timelog(timelog(f"test{i}", datetime(2021, 9, 16, 8, i // 2)))
+
+    seen = []
+    cursor = None
+    while True:
+      timelogs, cursor = await adb.get_room_timelogs_page(16, limit=2, cursor=cursor)
+      seen.extend(log['user_email'] for log in timelogs)
+      if cursor is None:
+        return seen
+
+  assert asyncio.run(scenario()) == [f"test{i}" for i in range(5)]
+
+def test__insert_timelogs__updates_hourly_rollups():
+  async def scenario():
+    await adb.insert_timelogs([
+      timelog("test1", datetime(2021, 9, 16, 8, 5)),
+      timelog("test2", datetime(2021, 9, 16, 8, 15)),
+    ])
+    await adb.create_timelog(timelog("test1", datetime(2021, 9, 16, 8, 45)))
+    return await adb.get_room_rollups(16)
+
+  rollups = asyncio.run(scenario())
+
+  assert len(rollups) == 1
+  assert rollups[0]['hour'] == datetime(2021, 9, 16, 8)
+  assert rollups[0]['visits'] == 3
+  assert sorted(rollups[0]['users']) == ["test1", "test2"]
+
+def test__get_room__nonexistent_room_raises_exception():
+  with pytest.raises(RoomDoesNotExist):
+    asyncio.run(adb.get_room(16))
+
+def test__delete_verification__returns_email_once():
+  async def scenario():
+    pk = await adb.create_verification("ryan@gmail.com")
+    email = await adb.delete_verification(pk)
+    await adb.delete_verification(pk)
+    return email
+
+  with pytest.raises(VerificationItemDoesNotExist):
+    asyncio.run(scenario())
+
+def test__iter_users__hides_password_and_encoding_by_default(user):
+  async def scenario():
+    await adb.create_user({**user, 'face_encoding': [0.5] * 128})
+    return [user async for user in adb.iter_users()]
+
+  users = asyncio.run(scenario())
+
+  assert users[0]['email'] == user['email']
+  assert not set(adb.USER_HIDDEN_FIELDS) & set(users[0])
+
+def test__iter_users__projects_requested_fields(user):
+  async def scenario():
+    await adb.create_user({**user, 'face_encoding': [0.5] * 128})
+    return [user async for user in adb.iter_users(['email', 'face_encoding'])]
+
+  users = asyncio.run(scenario())
+
+  assert set(users[0]) == {'_id', 'email', 'face_encoding'}
+  assert numpy.allclose(users[0]['face_encoding'], 0.5)
+
+def test__iter_users__rejects_password_field():
+  with pytest.raises(InvalidField):
+    adb.iter_users(['email', 'password'])
+
+def test__iter_users__pages_after_last_id(user):
+  async def scenario():
+    for i in range(5):
+      await adb.create_user({**user, 'email': f"user{i}@gmail.com"})
+
+    first = [user async for user in adb.iter_users(['email'], limit=3)]
+    rest = [user async for user in adb.iter_users(['email'], limit=3, after=str(first[-1]['_id']))]
+    return first, rest
+
+  first, rest = asyncio.run(scenario())
+
+  assert [user['email'] for user in first + rest] == [f"user{i}@gmail.com" for i in range(5)]
+
+def test__get_user_from_email__cache_is_invalidated_by_update(user, monkeypatch):
+  monkeypatch.setattr(adb.db.user_cache, 'ttl', 60)
+  adb.db.user_cache.clear()
+
+  async def scenario():
+    await adb.create_user(user)
+    await adb.get_user_from_email(user['email'])
+    cached = await adb.get_user_from_email(user['email'])
+    cached['first_name'] = "Mutated"
+    await adb.update_user(user['email'], {'temp': 37.5})
+    return await adb.get_user_from_email(user['email'])
+
+  hits = adb.db.user_cache.hits
+  updated = asyncio.run(scenario())
+
+  assert adb.db.user_cache.hits == hits + 1
+  assert updated['temp'] == 37.5
+  assert updated['first_name'] == "Ryan"
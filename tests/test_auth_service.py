@@ -0,0 +1,81 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+from fastapi.exceptions import HTTPException
+
+import settings
+import services.auth_service as auth
+
+@pytest.fixture(autouse=True)
+def fast_rounds(monkeypatch):
+  monkeypatch.setattr(settings, 'BCRYPT_ROUNDS', 4)
+
+class FakeUsers:
+  def __init__(self, user):
+    self.user = user
+    self.updates = []
+
+  async def get(self, email):
+    return self.user if email == self.user['email'] else None
+
+  async def update(self, email, user_data):
+    self.updates.append((email, user_data))
+    self.user.update(user_data)
+
+def test__generate_hashed_password__uses_configured_rounds():
+  hashed_password = auth.generate_hashed_password("password")
+
+  assert isinstance(hashed_password, str)
+  assert auth.get_hash_rounds(hashed_password) == 4
+  assert auth.verify_password("password", hashed_password)
+
+def test__verify_password_async__runs_in_pool():
+  hashed_password = auth.generate_hashed_password("password")
+
+  assert asyncio.run(auth.verify_password_async("password", hashed_password))
+  assert not asyncio.run(auth.verify_password_async("wrong", hashed_password))
+
+def test__authenticate_user_async__rehashes_when_rounds_change():
+  users = FakeUsers({'email': "ryan@gmail.com", 'password': auth.generate_hashed_password("password", rounds=5)})
+
+  user = asyncio.run(auth.authenticate_user_async(users.get, "ryan@gmail.com", "password", users.update))
+
+  assert user['email'] == "ryan@gmail.com"
+  assert len(users.updates) == 1
+  assert auth.get_hash_rounds(users.user['password']) == 4
+  assert auth.verify_password("password", users.user['password'])
+
+def test__authenticate_user_async__keeps_hash_when_rounds_match():
+  users = FakeUsers({'email': "ryan@gmail.com", 'password': auth.generate_hashed_password("password")})
+
+  asyncio.run(auth.authenticate_user_async(users.get, "ryan@gmail.com", "password", users.update))
+
+  assert users.updates == []
+
+def test__authenticate_user_async__rejects_wrong_password():
+  users = FakeUsers({'email': "ryan@gmail.com", 'password': auth.generate_hashed_password("password", rounds=5)})
+
+  assert not asyncio.run(auth.authenticate_user_async(users.get, "ryan@gmail.com", "wrong", users.update))
+  assert not asyncio.run(auth.authenticate_user_async(users.get, "nobody@gmail.com", "password", users.update))
+  assert users.updates == []
+
+def test__get_token_data__caches_decoded_token():
+  auth.token_cache.clear()
+  token = auth.create_access_token({'sub': "ryan@gmail.com"}, timedelta(minutes=5))
+  hits = auth.token_cache.hits
+
+  first = asyncio.run(auth.get_token_data(token))
+  second = asyncio.run(auth.get_token_data(token))
+
+  assert first.username == second.username == "ryan@gmail.com"
+  assert auth.token_cache.hits == hits + 1
+
+def test__get_token_data__does_not_cache_expired_token():
+  auth.token_cache.clear()
+  token = auth.create_access_token({'sub': "ryan@gmail.com"}, timedelta(seconds=-1))
+
+  with pytest.raises(HTTPException):
+    asyncio.run(auth.get_token_data(token))
+
+  assert len(auth.token_cache) == 0
@@ -0,0 +1,52 @@
+import time
+
+from services.cache import LRUCache
+
+def test__get__counts_hits_and_misses():
+  cache = LRUCache(maxsize=2, ttl=60)
+  cache.set('a', 1)
+
+  assert cache.get('a') == 1
+  assert cache.get('b') is None
+  assert cache.metrics()['hits'] == 1
+  assert cache.metrics()['misses'] == 1
+
+def test__set__evicts_least_recently_used():
+  cache = LRUCache(maxsize=2, ttl=60)
+  cache.set('a', 1)
+  cache.set('b', 2)
+  cache.get('a')
+  cache.set('c', 3)
+
+  assert cache.get('b') is None
+  assert cache.get('a') == 1
+  assert cache.metrics()['evictions'] == 1
+
+def test__get__expires_entries_after_ttl():
+  cache = LRUCache(maxsize=2, ttl=60)
+  cache.set('a', 1, ttl=0.01)
+  time.sleep(0.02)
+
+  assert cache.get('a') is None
+  assert len(cache) == 0
+
+def test__set__zero_ttl_disables_cache():
+  cache = LRUCache(maxsize=2, ttl=0)
+  cache.set('a', 1)
+
+  assert cache.get('a') is None
+
+def test__set__evicts_until_under_maxbytes():
+  cache = LRUCache(maxsize=10, ttl=60, maxbytes=10, sizeof=len)
+  cache.set('a', "aaaa")
+  cache.set('b', "bbbb")
+  cache.set('c', "cccc")
+
+  assert cache.get('a') is None
+  assert cache.metrics()['bytes'] == 8
+
+def test__set__skips_values_larger_than_maxbytes():
+  cache = LRUCache(maxsize=10, ttl=60, maxbytes=4, sizeof=len)
+  cache.set('a', "aaaaa")
+
+  assert len(cache) == 0
@@ -2,14 +2,15 @@ import json
 from datetime import date, datetime
 from main import update_user
 
+import numpy
 import pytest
 from mongoengine import connect, disconnect
 from mongoengine.errors import DoesNotExist
 
 import services.db_service as db
-from schemas import User, Room, Timelog
+from schemas import User, Room, Timelog, TimelogRollup
 from exceptions import (EmailIsAlreadyTaken, RoomDoesNotExist,
-  RoomHasDuplicateNumberOrName, UserDoesNotExist)
+  RoomHasDuplicateNumberOrName, UserDoesNotExist, InvalidCursor)
 
 disconnect()
 
@@ -21,7 +22,8 @@ def user():
     'first_name': "Ryan",
     'last_name': "Dineros",
     'contact_number': "09294137458",
-    'birthday': date(1996, 9, 16)
+    'birthday': date(1996, 9, 16),
+    'address': "Quezon City"
   }
 
 @pytest.fixture
@@ -31,10 +33,10 @@ def room():
     'name': "My Room"
   }
 
-def timelog(user_id, timestamp):
+def timelog(user_email, timestamp, room_number=16):
   return {
-    'user_id': user_id,
-    'room_number': 16,
+    'user_email': user_email,
+    'room_number': room_number,
     'timestamp': timestamp
   }
 
@@ -146,5 +148,291 @@ def test__get_timelogs__gets_all_timelogs_for_room(room, setup_db):
   timelogs = db.get_timelogs_from_room_number(timelog1['room_number'])
 
   assert len(timelogs) == 2
-  assert timelogs[0]['user_id'] == "test1"
-  assert timelogs[1]['user_id'] == "test2"
+  assert timelogs[0]['user_email'] == "test1"
+  assert timelogs[1]['user_email'] == "test2"
+
+def test__get_timelogs__groups_logs_by_room(room, setup_db):
+  db.create_room(room)
+  db.create_room({'number': 1, 'name': "Other Room"})
+  db.create_room({'number': 2, 'name': "Empty Room"})
+  db.create_timelog(timelog("test2", datetime(2021, 9, 16, 9, 30), room_number=16))
+  db.create_timelog(timelog("test1", datetime(2021, 9, 16, 8, 0), room_number=16))
+  db.create_timelog(timelog("test3", datetime(2021, 9, 16, 8, 0), room_number=1))
+  db.create_timelog(timelog("ghost", datetime(2021, 9, 16, 8, 0), room_number=99))
+
+  timelogs = {room: list(logs) for room, logs in db.get_timelogs()}
+
+  assert list(timelogs) == [1, 2, 16]
+  assert timelogs[2] == []
+  assert [log['user_email'] for log in timelogs[16]] == ["test1", "test2"]
+  assert timelogs[16][0]['timestamp'] == "2021-09-16T08:00:00"
+
+def test__get_timelogs__filters_by_time_and_room(room, setup_db):
+  db.create_room(room)
+  db.create_room({'number': 1, 'name': "Other Room"})
+  db.create_timelog(timelog("early", datetime(2021, 9, 15, 8, 0)))
+  db.create_timelog(timelog("late", datetime(2021, 9, 16, 8, 0)))
+  db.create_timelog(timelog("other", datetime(2021, 9, 16, 8, 0), room_number=1))
+
+  timelogs = {room: list(logs) for room, logs in
+    db.get_timelogs(since=datetime(2021, 9, 16), room_numbers=[16])}
+
+  assert list(timelogs) == [16]
+  assert [log['user_email'] for log in timelogs[16]] == ["late"]
+
+def test__timelog_reads__return_direction(room, setup_db):
+  db.create_room(room)
+  db.create_timelog({**timelog("ryan@gmail.com", datetime(2021, 9, 16, 8, 0)), 'direction': 'exit'})
+
+  grouped = {room: list(logs) for room, logs in db.get_timelogs()}
+  room_page, _ = db.get_room_timelogs_page(16, limit=10)
+  user_page, _ = db.get_user_timelogs_page("ryan@gmail.com", limit=10)
+
+  assert grouped[16][0]['direction'] == 'exit'
+  assert room_page[0]['direction'] == 'exit'
+  assert user_page[0]['direction'] == 'exit'
+
+def test__get_user_encodings__only_returns_enrolled_users(user, setup_db):
+  other_user = user.copy()
+  other_user['email'] = "ramses@yahoo.com"
+  db.create_user(other_user)
+
+  user['face_encoding'] = [0.1] * 128
+  id = db.create_user(user)
+
+  encodings = list(db.get_user_encodings())
+
+  assert len(encodings) == 1
+  assert encodings[0][:2] == (id, user['email'])
+  assert numpy.allclose(encodings[0][2], 0.1)
+
+def test__update_user__stores_face_encoding_as_binary(user, setup_db):
+  id = db.create_user(user)
+  db.update_user(user['email'], {'face_encoding': [0.25] * 128})
+
+  stored = User.objects.get(id=id)
+  assert len(stored.face_encoding_bin) == 512
+  assert stored.face_encoding == []
+
+def test__update_user__none_face_encoding_keeps_enrollment(user, setup_db):
+  user['face_encoding'] = [0.25] * 128
+  id = db.create_user(user)
+  db.update_user(user['email'], {'first_name': "Ramses", 'face_encoding': None})
+
+  assert len(User.objects.get(id=id).face_encoding_bin) == 512
+
+def test__migrate_face_encodings__converts_legacy_lists(user, setup_db):
+  for i in range(3):
+    legacy_user = user.copy()
+    legacy_user['email'] = f"user{i}@gmail.com"
+    User(**legacy_user, face_encoding=[float(i)] * 128).save()
+
+  migrated = db.migrate_face_encodings(batch_size=2)
+
+  assert migrated == 3
+  for i in range(3):
+    stored = User.objects.get(email=f"user{i}@gmail.com")
+    assert stored.face_encoding == []
+    assert stored.face_encoding_version == 1
+    assert numpy.array_equal(numpy.frombuffer(stored.face_encoding_bin, dtype='<f4'), [i] * 128)
+
+def test__get_room_timelogs_page__walks_pages_with_cursor(room, setup_db):
+  db.create_room(room)
+  timestamp = datetime(2021, 9, 16, 8, 0)
+  for i in range(5):
+    # Two logs share each timestamp so the cursor has to break ties on id
+    db.create_timelog(timelog(f"test{i}", timestamp.replace(minute=i // 2)))
+
+  seen = []
+  cursor = None
+  while True:
+    timelogs, cursor = db.get_room_timelogs_page(room['number'], limit=2, cursor=cursor)
+    seen.extend(log['user_email'] for log in timelogs)
+    if cursor is None:
+      break
+
+  assert seen == [f"test{i}" for i in range(5)]
+
+def test__get_user_timelogs_page__filters_by_user_and_range(setup_db):
+  db.create_timelog(timelog("ryan@gmail.com", datetime(2021, 9, 15, 8, 0)))
+  db.create_timelog(timelog("ryan@gmail.com", datetime(2021, 9, 16, 8, 0)))
+  db.create_timelog(timelog("other@gmail.com", datetime(2021, 9, 16, 8, 0)))
+
+  timelogs, cursor = db.get_user_timelogs_page("ryan@gmail.com", since=datetime(2021, 9, 16), limit=10)
+
+  assert cursor is None
+  assert [log['timestamp'] for log in timelogs] == [datetime(2021, 9, 16, 8, 0)]
+
+def test__get_user_timelogs_page__invalid_cursor_raises_exception(setup_db):
+  with pytest.raises(InvalidCursor):
+    db.get_user_timelogs_page("ryan@gmail.com", cursor="not-a-cursor")
+
+def test__timelog__indexes_cover_keyset_page_sort(setup_db):
+  Timelog.ensure_indexes()
+  index_keys = [index['key'] for index in Timelog._get_collection().index_information().values()]
+
+  # Equality prefix followed by the page sort, so pages come straight off the index
+  for prefix in ('room_number', 'user_email'):
+    assert [(prefix, 1)] + db.TIMELOG_PAGE_SORT in index_keys
+
+def test__user__symptoms_index_is_partial_and_keyed_for_pages(setup_db):
+  User.ensure_indexes()
+  indexes = [index for index in User._get_collection().index_information().values()
+    if index['key'] == [('has_symptoms', 1), ('_id', 1)]]
+
+  assert len(indexes) == 1
+  assert indexes[0]['partialFilterExpression'] == {'has_symptoms': True}
+
+def test__update_user__maintains_has_symptoms_flag(user, setup_db):
+  id = db.create_user(user)
+  assert User.objects.get(id=id).has_symptoms is False
+
+  db.update_user(user['email'], {'temp': 38.2})
+  assert User.objects.get(id=id).has_symptoms is True
+
+  db.update_user(user['email'], {'temp': 36.8})
+  assert User.objects.get(id=id).has_symptoms is False
+
+  db.update_user(user['email'], {'survey': ["cough"]})
+  assert User.objects.get(id=id).has_symptoms is True
+
+def test__get_users_with_symptoms__pages_without_hidden_fields(user, setup_db):
+  for i in range(3):
+    db.create_user({**user, 'email': f"fever{i}@gmail.com", 'temp': 39.0, 'face_encoding': [0.1] * 128})
+  db.create_user({**user, 'email': "fine@gmail.com", 'temp': 36.5})
+
+  first = db.get_users_with_symptoms(limit=2)
+  rest = db.get_users_with_symptoms(limit=2, after=str(first[-1]['_id']))
+
+  assert [user['email'] for user in first + rest] == [f"fever{i}@gmail.com" for i in range(3)]
+  assert not {'password', 'face_encoding_bin'} & set(first[0])
+
+def test__recompute_symptoms__applies_new_threshold(user, setup_db):
+  db.create_user({**user, 'email': "warm@gmail.com", 'temp': 37.6})
+  db.create_user({**user, 'email': "fever@gmail.com", 'temp': 38.5})
+  db.create_user({**user, 'email': "cough@gmail.com", 'survey': ["cough"]})
+
+  db.recompute_symptoms(threshold=37.5)
+
+  flagged = sorted(user.email for user in User.objects(has_symptoms=True))
+  assert flagged == ["cough@gmail.com", "fever@gmail.com", "warm@gmail.com"]
+
+  db.recompute_symptoms(threshold=39.0)
+
+  assert [user.email for user in User.objects(has_symptoms=True)] == ["cough@gmail.com"]
+
+def test__insert_timelogs__notifies_listeners_of_written_logs(setup_db):
+  seen = []
+  db.timelog_listeners.append(seen.extend)
+  try:
+    inserted, errors = db.insert_timelogs([
+      timelog("ryan@gmail.com", datetime(2021, 9, 16, 8)),
+      timelog("juan@gmail.com", datetime(2021, 9, 16, 9)),
+    ])
+    db.create_timelog(timelog("maria@gmail.com", datetime(2021, 9, 16, 10)))
+  finally:
+    db.timelog_listeners.remove(seen.extend)
+
+  assert inserted == 2 and errors == []
+  assert [log['user_email'] for log in seen] == ["ryan@gmail.com", "juan@gmail.com", "maria@gmail.com"]
+
+def test__get_recent_timelogs__returns_logs_since_in_order(setup_db):
+  db.insert_timelogs([
+    timelog("ryan@gmail.com", datetime(2021, 9, 16, 10)),
+    timelog("juan@gmail.com", datetime(2021, 9, 16, 9)),
+    timelog("maria@gmail.com", datetime(2021, 9, 16, 7)),
+  ])
+
+  logs = list(db.get_recent_timelogs(datetime(2021, 9, 16, 8)))
+
+  assert [log['user_email'] for log in logs] == ["juan@gmail.com", "ryan@gmail.com"]
+
+def test__insert_timelogs__updates_hourly_rollups(setup_db):
+  db.insert_timelogs([
+    timelog("ryan@gmail.com", datetime(2021, 9, 16, 8, 5)),
+    timelog("ryan@gmail.com", datetime(2021, 9, 16, 8, 40)),
+    timelog("juan@gmail.com", datetime(2021, 9, 16, 8, 50)),
+    timelog("juan@gmail.com", datetime(2021, 9, 16, 9, 10)),
+  ])
+  db.create_timelog(timelog("maria@gmail.com", datetime(2021, 9, 16, 9, 30)))
+
+  rollups = db.get_room_rollups(16)
+
+  assert [(r['hour'], r['visits'], sorted(r['users'])) for r in rollups] == [
+    (datetime(2021, 9, 16, 8), 3, ["juan@gmail.com", "ryan@gmail.com"]),
+    (datetime(2021, 9, 16, 9), 2, ["juan@gmail.com", "maria@gmail.com"]),
+  ]
+
+def test__rebuild_timelog_rollups__matches_incremental_rollups(setup_db):
+  db.insert_timelogs([
+    timelog("ryan@gmail.com", datetime(2021, 9, 16, 8, 5)),
+    timelog("juan@gmail.com", datetime(2021, 9, 16, 9, 10), room_number=17),
+    timelog("maria@gmail.com", datetime(2021, 9, 17, 9, 10)),
+  ])
+  expected = db.get_room_rollups(16) + db.get_room_rollups(17)
+  TimelogRollup._get_collection().update_many({}, {'$set': {'visits': 99}})
+
+  replayed = db.rebuild_timelog_rollups(batch_size=2)
+
+  assert replayed == 3
+  assert db.get_room_rollups(16) + db.get_room_rollups(17) == expected
+
+def test__rebuild_timelog_rollups__skips_exits_like_incremental_rollups(setup_db):
+  db.insert_timelogs([
+    timelog("ryan@gmail.com", datetime(2021, 9, 16, 8, 5)),
+    {**timelog("ryan@gmail.com", datetime(2021, 9, 16, 8, 50)), 'direction': 'exit'},
+    {**timelog("juan@gmail.com", datetime(2021, 9, 16, 9, 10)), 'direction': 'exit'},
+  ])
+  expected = db.get_room_rollups(16)
+
+  db.rebuild_timelog_rollups()
+
+  assert [(r['hour'], r['visits']) for r in expected] == [(datetime(2021, 9, 16, 8), 1)]
+  assert db.get_room_rollups(16) == expected
+
+def test__rebuild_timelog_rollups__keeps_archived_days(tmp_path, setup_db):
+  db.insert_timelogs([
+    timelog("ryan@gmail.com", datetime(2021, 9, 15, 8, 5)),
+    timelog("juan@gmail.com", datetime(2021, 9, 16, 9, 10)),
+  ])
+  db.archive_timelogs(datetime(2021, 9, 16), str(tmp_path))
+
+  replayed = db.rebuild_timelog_rollups()
+
+  assert replayed == 1
+  assert [(r['hour'], r['visits']) for r in db.get_room_rollups(16)] == [
+    (datetime(2021, 9, 15, 8), 1),
+    (datetime(2021, 9, 16, 9), 1),
+  ]
+
+def test__rebuild_timelog_rollups__leaves_open_hour_to_live_writes(setup_db):
+  db.create_timelog(timelog("ryan@gmail.com", datetime.utcnow()))
+  TimelogRollup._get_collection().update_many({}, {'$set': {'visits': 5}})
+
+  replayed = db.rebuild_timelog_rollups()
+
+  assert replayed == 0
+  assert [r['visits'] for r in db.get_room_rollups(16)] == [5]
+
+def test__rebuild_timelog_rollups__drops_rollups_without_logs(setup_db):
+  db.insert_timelogs([timelog("ryan@gmail.com", datetime(2021, 9, 16, 8, 5))])
+  TimelogRollup(room_number=16, hour=datetime(2021, 9, 16, 10), visits=3, users=["juan@gmail.com"]).save()
+
+  db.rebuild_timelog_rollups()
+
+  assert [r['hour'] for r in db.get_room_rollups(16)] == [datetime(2021, 9, 16, 8)]
+  assert "timelog_rollup_rebuild" not in TimelogRollup._get_collection().database.list_collection_names()
+
+def test__archive_timelogs__moves_old_logs_to_archive(tmp_path, setup_db):
+  db.insert_timelogs([
+    timelog("ryan@gmail.com", datetime(2021, 9, 15, 8)),
+    timelog("juan@gmail.com", datetime(2021, 9, 16, 9), room_number=17),
+    timelog("maria@gmail.com", datetime(2021, 9, 20, 10)),
+  ])
+
+  archived = db.archive_timelogs(datetime(2021, 9, 17), str(tmp_path), batch_size=1)
+
+  assert archived == 2
+  assert [log.user_email for log in Timelog.objects] == ["maria@gmail.com"]
+  assert (tmp_path / "2021" / "09" / "15" / "room-16.ndjson.gz").exists()
+  assert (tmp_path / "2021" / "09" / "16" / "room-17.ndjson.gz").exists()
@@ -0,0 +1,40 @@
+import numpy
+import pytest
+
+import services.encoding_codec as codec
+
+@pytest.fixture
+def encoding():
+  return numpy.random.default_rng(16).normal(size=128)
+
+def test__pack__is_512_bytes(encoding):
+  assert len(codec.pack(encoding)) == codec.ENCODING_BYTES == 512
+
+def test__unpack__is_zero_copy_view(encoding):
+  data = bytes(codec.pack(encoding))
+  unpacked = codec.unpack(data)
+
+  assert unpacked.dtype == numpy.float32
+  assert not unpacked.flags.owndata
+  assert numpy.allclose(unpacked, encoding, atol=1e-6)
+
+def test__unpack__rejects_unknown_version(encoding):
+  with pytest.raises(ValueError):
+    codec.unpack(bytes(codec.pack(encoding)), version=2)
+
+def test__pack__rejects_wrong_length():
+  with pytest.raises(ValueError):
+    codec.pack([0.1] * 127)
+
+def test__from_document__reads_both_formats(encoding):
+  binary_user = codec.to_fields(encoding)
+  legacy_user = {'face_encoding': encoding.tolist()}
+
+  assert numpy.allclose(codec.from_document(binary_user), codec.from_document(legacy_user))
+  assert codec.from_document({'face_encoding': []}) is None
+
+def test__to_api__returns_float_list(encoding):
+  user = codec.to_api({'email': "ryan@gmail.com", **codec.to_fields(encoding)})
+
+  assert 'face_encoding_bin' not in user
+  assert numpy.allclose(user['face_encoding'], encoding, atol=1e-6)
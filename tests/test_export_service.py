@@ -0,0 +1,91 @@
+import gzip
+from datetime import datetime
+
+import pyarrow
+import pytest
+
+import services.export_service as export
+
+def timelogs():
+  return [
+    {'user_email': "ryan@gmail.com", 'room_number': 16, 'timestamp': datetime(2021, 9, 16, 8)},
+    {'user_email': "juan@gmail.com", 'room_number': 16, 'timestamp': datetime(2021, 9, 16, 9), 'direction': 'exit'},
+    {'user_email': "ryan@gmail.com", 'room_number': 17, 'timestamp': datetime(2021, 9, 16, 10)},
+  ]
+
+def get_users(emails):
+  users = {"ryan@gmail.com": {'first_name': "Ryan", 'last_name': "Dineros", 'contact_number': "09294137458"}}
+  return {email: users[email] for email in emails if email in users}
+
+def test__chunked__splits_into_fixed_size_chunks():
+  assert [len(chunk) for chunk in export.chunked(range(5), 2)] == [2, 2, 1]
+
+def test__to_csv__writes_one_part_per_chunk():
+  parts = list(export.to_csv(export.chunked(timelogs(), 2), export.columns(False)))
+
+  assert len(parts) == 2
+  assert b"".join(parts).decode('utf-8').splitlines() == [
+    "timestamp,room_number,user_email,direction",
+    "2021-09-16T08:00:00,16,ryan@gmail.com,",
+    "2021-09-16T09:00:00,16,juan@gmail.com,exit",
+    "2021-09-16T10:00:00,17,ryan@gmail.com,",
+  ]
+
+def test__to_csv__empty_export_has_header():
+  assert b"".join(export.to_csv([], export.columns(False))) == b"timestamp,room_number,user_email,direction\r\n"
+
+def test__join_users__looks_up_each_chunk_once():
+  lookups = []
+  def lookup(emails):
+    lookups.append(emails)
+    return get_users(emails)
+
+  rows = [row for chunk in export.join_users(export.chunked(timelogs(), 2), lookup) for row in chunk]
+
+  assert lookups == [["juan@gmail.com", "ryan@gmail.com"], ["ryan@gmail.com"]]
+  assert rows[0]['contact_number'] == "09294137458"
+  assert rows[1]['first_name'] is None
+
+@pytest.mark.parametrize('header, expected', [
+  ("gzip, deflate, br", True),
+  ("deflate;q=1.0, gzip;q=0.5", True),
+  ("gzip;q=0", False),
+  ("gzip; q=0.000, identity", False),
+  ("*", True),
+  ("*;q=0.1, gzip;q=0", False),
+  ("identity", False),
+  ("", False),
+])
+def test__accepts_gzip__honours_q_values(header, expected):
+  assert export.accepts_gzip(header) is expected
+
+def test__gzipped__round_trips():
+  body = b"".join(export.gzipped(export.to_csv(export.chunked(timelogs(), 2), export.columns(False))))
+
+  assert gzip.decompress(body).startswith(b"timestamp,room_number")
+
+def test__to_arrow__streams_record_batches():
+  fields = export.columns(True)
+  chunks = export.join_users(export.chunked(timelogs(), 2), get_users)
+
+  table = pyarrow.ipc.open_stream(b"".join(export.to_arrow(chunks, fields))).read_all()
+
+  assert table.num_rows == 3
+  assert table.column('first_name').to_pylist() == ["Ryan", None, "Ryan"]
+
+def test__to_arrow__writes_one_record_batch_per_chunk():
+  fields = export.columns(False)
+
+  reader = pyarrow.ipc.open_stream(b"".join(export.to_arrow(export.chunked(timelogs(), 2), fields)))
+  batches = list(reader)
+
+  assert reader.schema == export.arrow_schema(fields)
+  assert [batch.num_rows for batch in batches] == [2, 1]
+  assert batches[0].column('timestamp').to_pylist() == [datetime(2021, 9, 16, 8), datetime(2021, 9, 16, 9)]
+  assert batches[0].column('direction').to_pylist() == [None, 'exit']
+
+def test__to_arrow__raises_without_pyarrow(monkeypatch):
+  monkeypatch.setattr(export, 'pyarrow', None)
+
+  with pytest.raises(export.ExportFormatUnavailable):
+    export.to_arrow([], export.columns(False))
@@ -0,0 +1,152 @@
+import numpy
+import pytest
+
+from services.face_gallery import FaceGallery, MappedGallery, QuantizedFaceGallery
+
+@pytest.fixture
+def encodings():
+  rng = numpy.random.default_rng(16)
+  return rng.normal(scale=0.1, size=(10, 128))
+
+@pytest.fixture(params=['memory', 'quantized', 'mapped'])
+def gallery(request, encodings, tmp_path):
+  if request.param == 'memory':
+    gallery = FaceGallery(capacity=2)
+  elif request.param == 'quantized':
+    # Fewer candidates than rows, so searches go through the int8 pass
+    gallery = QuantizedFaceGallery(capacity=2, rerank=3)
+  else:
+    gallery = MappedGallery(str(tmp_path / "gallery.bin"))
+  gallery.load((str(i), f"user{i}@gmail.com", encoding) for i, encoding in enumerate(encodings))
+  return gallery
+
+def test__load__grows_past_initial_capacity(gallery, encodings):
+  assert len(gallery) == len(encodings)
+
+def test__search__returns_closest_match_first(gallery, encodings):
+  matches = gallery.search(encodings[3], k=3)
+
+  assert len(matches) == 3
+  assert matches[0]['id'] == "3"
+  assert matches[0]['email'] == "user3@gmail.com"
+  assert matches[0]['distance'] == pytest.approx(0, abs=1e-3)
+  assert matches[0]['distance'] <= matches[1]['distance'] <= matches[2]['distance']
+
+def test__search__distances_match_brute_force(gallery, encodings):
+  probe = encodings[0] + 0.05
+  expected = numpy.linalg.norm(encodings - probe, axis=1)
+
+  matches = gallery.search(probe, k=len(encodings))
+
+  for match in matches:
+    assert match['distance'] == pytest.approx(expected[int(match['id'])], abs=1e-4)
+
+def test__upsert__replaces_existing_encoding(gallery, encodings):
+  gallery.upsert("3", "user3@gmail.com", encodings[7])
+
+  assert len(gallery) == len(encodings)
+  assert {match['id'] for match in gallery.search(encodings[7], k=2)} == {"3", "7"}
+
+def test__remove__keeps_remaining_rows_searchable(gallery, encodings):
+  assert gallery.remove("2")
+  assert not gallery.remove("2")
+
+  assert "2" not in gallery
+  assert gallery.search(encodings[9], k=1)[0]['id'] == "9"
+  assert gallery.search(encodings[2], k=1)[0]['id'] != "2"
+
+def test__upsert_many__adds_and_replaces_rows(gallery, encodings):
+  gallery.upsert_many([
+    ("0", "user0@gmail.com", encodings[9]),
+    ("new", "new@gmail.com", encodings[0]),
+    ("new", "new@gmail.com", encodings[1]),
+  ])
+
+  assert len(gallery) == len(encodings) + 1
+  assert gallery.search(encodings[9], k=2)[0]['distance'] == pytest.approx(0, abs=1e-3)
+  assert gallery.search(encodings[1], k=1)[0]['id'] in ("1", "new")
+  assert gallery.search(encodings[0], k=1)[0]['id'] != "new"
+
+def test__search__empty_gallery_returns_no_matches():
+  assert FaceGallery().search(numpy.zeros(128), k=5) == []
+
+def test__mapped_gallery__other_workers_see_new_generation(tmp_path, encodings):
+  path = str(tmp_path / "gallery.bin")
+  writer = MappedGallery(path)
+  reader = MappedGallery(path)
+  writer.load((str(i), f"user{i}@gmail.com", encoding) for i, encoding in enumerate(encodings[:5]))
+  generation = reader.generation
+
+  writer.upsert("9", "user9@gmail.com", encodings[9])
+
+  assert reader.generation == generation + 1
+  assert reader.search(encodings[9], k=1)[0]['id'] == "9"
+  assert list(tmp_path.glob("*.tmp")) == []
+
+def test__mapped_gallery__open_or_build_only_builds_once(tmp_path, encodings):
+  path = str(tmp_path / "gallery.bin")
+  entries = [(str(i), f"user{i}@gmail.com", encoding) for i, encoding in enumerate(encodings)]
+
+  assert MappedGallery(path).open_or_build(lambda: entries) == len(encodings)
+  generation = MappedGallery(path).generation
+  assert MappedGallery(path).open_or_build(lambda: entries) == len(encodings)
+  assert MappedGallery(path).generation == generation
+
+def test__mapped_gallery__open_or_build_rebuilds_stale_file(tmp_path, encodings):
+  path = str(tmp_path / "gallery.bin")
+  entries = [(str(i), f"user{i}@gmail.com", encoding) for i, encoding in enumerate(encodings)]
+  MappedGallery(path).open_or_build(lambda: entries[:5])
+
+  gallery = MappedGallery(path)
+  assert gallery.open_or_build(lambda: entries) == len(encodings)
+  assert gallery.generation == 2
+  assert gallery.search(encodings[9], k=1)[0]['id'] == "9"
+
+def test__mapped_gallery__open_or_build_replaces_unreadable_file(tmp_path, encodings):
+  path = tmp_path / "gallery.bin"
+  path.write_bytes(b"not a gallery" * 10)
+
+  assert MappedGallery(str(path)).open_or_build(lambda: [("0", "user0@gmail.com", encodings[0])]) == 1
+
+def test__mapped_gallery__check_reports_differences(tmp_path, encodings):
+  gallery = MappedGallery(str(tmp_path / "gallery.bin"))
+  gallery.load((str(i), f"user{i}@gmail.com", encoding) for i, encoding in enumerate(encodings[:3]))
+
+  report = gallery.check([
+    ("0", "user0@gmail.com", encodings[0]),
+    ("1", "user1@gmail.com", encodings[5]),
+    ("4", "user4@gmail.com", encodings[4]),
+  ])
+
+  assert report['missing'] == ["4"]
+  assert report['extra'] == ["2"]
+  assert report['mismatched'] == ["1"]
+
+def test__quantized_gallery__finds_true_neighbours_in_large_gallery():
+  rng = numpy.random.default_rng(24)
+  encodings = rng.normal(scale=0.1, size=(5000, 128)).astype(numpy.float32)
+  exact = FaceGallery()
+  quantized = QuantizedFaceGallery(rerank=32)
+  for gallery in (exact, quantized):
+    gallery.load((str(i), f"user{i}@gmail.com", encoding) for i, encoding in enumerate(encodings))
+
+  for probe in encodings[:50] + rng.normal(scale=0.02, size=(50, 128)):
+    expected = exact.search(probe, k=5)
+    found = quantized.search(probe, k=5)
+
+    assert [match['id'] for match in found] == [match['id'] for match in expected]
+    assert found[0]['distance'] == pytest.approx(expected[0]['distance'], abs=1e-4)
+
+def test__quantized_gallery__refits_as_upserts_grow_a_small_gallery():
+  rng = numpy.random.default_rng(24)
+  encodings = rng.normal(scale=0.1, size=(5000, 128)).astype(numpy.float32)
+  exact = FaceGallery()
+  quantized = QuantizedFaceGallery(rerank=32)
+  exact.load((str(i), f"user{i}@gmail.com", encoding) for i, encoding in enumerate(encodings))
+  quantized.load((str(i), f"user{i}@gmail.com", encoding) for i, encoding in enumerate(encodings[:2]))
+  for i, encoding in enumerate(encodings[2:], start=2):
+    quantized.upsert(str(i), f"user{i}@gmail.com", encoding)
+
+  for probe in encodings[:50] + rng.normal(scale=0.02, size=(50, 128)):
+    assert [match['id'] for match in quantized.search(probe, k=5)] == \
+      [match['id'] for match in exact.search(probe, k=5)]
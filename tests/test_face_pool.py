@@ -0,0 +1,64 @@
+import asyncio
+
+import numpy
+import pytest
+
+import services.face_pool as face_pool
+from services.cache import LRUCache
+from exceptions import FacePipelineIsBusy, CannotReadFace
+
+@pytest.fixture
+def fake_encoder(monkeypatch):
+  calls = []
+  def encode_image(data):
+    calls.append(data)
+    if data == b"no face":
+      raise CannotReadFace("Can't read face in image.")
+    return numpy.full(128, len(data), dtype=numpy.float64)
+
+  monkeypatch.setattr(face_pool.face_recog, 'encode_image', encode_image)
+  monkeypatch.setattr(face_pool, 'cache', LRUCache(16, 60, 16 * 1024, face_pool._entry_size))
+  return calls
+
+def test__run__returns_result_of_pipeline():
+  result = asyncio.run(face_pool.run(sum, [1, 2, 3]))
+
+  assert result == 6
+  assert face_pool.pending() == 0
+
+def test__run__raises_when_queue_is_full():
+  with pytest.raises(FacePipelineIsBusy):
+    asyncio.run(face_pool.run(sum, [1, 2, 3], max_queue=0))
+
+  assert face_pool.pending() == 0
+
+def test__start__warms_process_workers():
+  face_pool.start(workers=1)
+  try:
+    assert asyncio.run(face_pool.run(pow, 2, 10)) == 1024
+  finally:
+    face_pool.shutdown()
+
+def test__encode_image__caches_encoding_by_content(fake_encoder):
+  first = asyncio.run(face_pool.encode_image(b"same image"))
+  second = asyncio.run(face_pool.encode_image(b"same image"))
+
+  assert fake_encoder == [b"same image"]
+  assert second is first
+  assert not second.flags.writeable
+  assert face_pool.cache.metrics()['hits'] == 1
+
+def test__encode_image__caches_unreadable_faces(fake_encoder):
+  for _ in range(2):
+    with pytest.raises(CannotReadFace):
+      asyncio.run(face_pool.encode_image(b"no face"))
+
+  assert fake_encoder == [b"no face"]
+
+def test__encode_image__cache_is_bounded_by_bytes(fake_encoder):
+  for i in range(20):
+    asyncio.run(face_pool.encode_image(f"image {i}".encode()))
+
+  metrics = face_pool.cache.metrics()
+  assert metrics['bytes'] <= 16 * 1024
+  assert metrics['evictions'] > 0
@@ -0,0 +1,76 @@
+import io
+import os
+
+import numpy
+import pytest
+from PIL import Image
+
+import services.face_recog as face_recog
+from exceptions import CannotReadFace, HasMoreThanOneFace
+
+def image_bytes(size, format="JPEG", orientation=None):
+  buffer = io.BytesIO()
+  image = Image.new('RGB', size)
+  if orientation is None:
+    image.save(buffer, format)
+  else:
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    image.save(buffer, format, exif=exif)
+  return buffer.getvalue()
+
+def test__resize_image__fits_within_max_size_and_keeps_landscape_frames():
+  image = face_recog.resize_image(face_recog.decode_image(image_bytes((1600, 900))))
+
+  width, height = image.size
+  assert max(width, height) <= 500
+  assert width > height
+
+def test__resize_image__applies_exif_orientation():
+  # Orientation 6: stored landscape, shown rotated 90 degrees clockwise
+  image = face_recog.resize_image(face_recog.decode_image(image_bytes((1600, 900), orientation=6)))
+
+  width, height = image.size
+  assert max(width, height) <= 500
+  assert height > width
+
+def test__encode_image__raises_if_no_face(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+
+  with pytest.raises(CannotReadFace):
+    face_recog.encode_image(image_bytes((640, 480), "PNG"))
+
+  assert os.listdir(tmp_path) == []
+
+def test__compare_faces__uses_tolerance():
+  known = numpy.zeros(128)
+
+  assert face_recog.compare_faces(known, known + 0.01)
+  assert not face_recog.compare_faces(known, known + 0.1)
+
+def test__detect_faces__detects_on_downscaled_copy_and_maps_boxes_back(monkeypatch):
+  seen = []
+  def face_locations(image, number_of_times_to_upsample, model):
+    seen.append((image.shape, number_of_times_to_upsample, model))
+    return [(10, 60, 70, 20)]
+  monkeypatch.setattr(face_recog.fr, 'face_locations', face_locations)
+  profile = face_recog.PROFILE._replace(detector='hog', upsample=0, detect_size=100)
+
+  boxes = face_recog.detect_faces(numpy.zeros((400, 200, 3), dtype=numpy.uint8), profile)
+
+  assert seen == [((100, 50, 3), 0, 'hog')]
+  assert boxes == [(40, 200, 280, 80)]
+
+def test__detect_faces__keeps_small_images_at_full_size(monkeypatch):
+  seen = []
+  monkeypatch.setattr(face_recog.fr, 'face_locations', lambda image, **kwargs: seen.append(image.shape) or [])
+  profile = face_recog.PROFILE._replace(detect_size=500)
+
+  assert face_recog.detect_faces(numpy.zeros((400, 200, 3), dtype=numpy.uint8), profile) == []
+  assert seen == [(400, 200, 3)]
+
+def test__generate_face_encoding__raises_if_more_than_one_face(monkeypatch):
+  monkeypatch.setattr(face_recog, 'detect_faces', lambda image, profile: [(0, 1, 1, 0), (2, 3, 3, 2)])
+
+  with pytest.raises(HasMoreThanOneFace):
+    face_recog.generate_face_encoding(numpy.zeros((8, 8, 3), dtype=numpy.uint8))
@@ -0,0 +1,121 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import pytest
+from mongoengine import connect, disconnect
+
+import services.ingest_service as ingest
+import services.auth_service as auth
+from schemas import Timelog, User
+
+def timelog(user_email, minute=0):
+  return {
+    'user_email': user_email,
+    'room_number': 16,
+    'timestamp': datetime(2021, 9, 16, 8, minute).isoformat(),
+  }
+
+@pytest.fixture(autouse=True)
+def setup_db():
+  disconnect()
+  connect("mongoenginetest", host="mongomock://localhost")
+
+  yield
+
+  disconnect()
+
+def test__ingest_timelogs__inserts_in_chunks_and_reports_invalid_items():
+  items = [timelog(f"user{i}@gmail.com", i) for i in range(5)]
+  items.insert(2, {'user_email': "bad@gmail.com"})
+
+  report = ingest.ingest_timelogs(iter(items), chunk_size=2)
+
+  assert report['received'] == 6
+  assert report['inserted'] == 5
+  assert [error['index'] for error in report['errors']] == [2]
+  assert Timelog.objects.count() == 5
+
+def test__ingest_timelogs__replayed_batch_is_not_duplicated():
+  items = [timelog(f"user{i}@gmail.com", i) for i in range(3)]
+
+  first = ingest.ingest_timelogs(iter(items), idempotency_key="scanner-1:42")
+  replay = ingest.ingest_timelogs(iter(items), idempotency_key="scanner-1:42")
+
+  assert first['inserted'] == 3
+  assert replay['inserted'] == 0
+  assert replay['duplicates'] == 3
+  assert Timelog.objects.count() == 3
+
+def test__parse_ndjson__reports_malformed_lines():
+  body = "\n".join([json.dumps(timelog("ryan@gmail.com")), "{not json", ""]).encode('utf-8')
+
+  report = ingest.ingest_timelogs(ingest.parse_ndjson(body))
+
+  assert report['inserted'] == 1
+  assert report['errors'][0]['index'] == 1
+
+def test__parse_json_array__rejects_non_array():
+  with pytest.raises(ValueError):
+    ingest.parse_json_array(b'{"user_email": "ryan@gmail.com"}')
+
+def user(email):
+  return {
+    'email': email,
+    'password': "password",
+    'first_name': "Ryan",
+    'last_name': "Dineros",
+    'contact_number': "09294137458",
+    'birthday': "1996-09-16",
+    'address': "Quezon City"
+  }
+
+def test__parse_csv__drops_empty_cells():
+  body = b"email,first_name,temp\r\nryan@gmail.com,Ryan,\r\n"
+
+  assert list(ingest.parse_csv(body)) == [{'email': "ryan@gmail.com", 'first_name': "Ryan"}]
+
+def test__import_users__hashes_passwords_and_reports_duplicates_per_row():
+  items = [user(f"user{i}@gmail.com") for i in range(4)]
+  items.insert(1, {'email': "incomplete@gmail.com"})
+  items.append(user("user0@gmail.com"))
+
+  with ThreadPoolExecutor(max_workers=2) as executor:
+    report = ingest.import_users(iter(items), chunk_size=2, hash_executor=executor, rounds=4)
+
+  assert report['received'] == 6
+  assert report['inserted'] == 4
+  assert [error['index'] for error in report['errors']] == [1]
+  assert report['duplicates'] == [{'index': 5, 'email': "user0@gmail.com", 'error': "user0@gmail.com is already taken"}]
+
+  imported = User.objects.get(email="user2@gmail.com")
+  assert auth.verify_password("password", imported.password)
+  assert not imported.is_admin
+
+def test__import_users__reports_rows_the_document_rejects():
+  items = [user(f"user{i}@gmail.com") for i in range(3)]
+  items[1]['first_name'] = "R" * 51
+
+  with ThreadPoolExecutor(max_workers=2) as executor:
+    report = ingest.import_users(iter(items), chunk_size=3, hash_executor=executor, rounds=4)
+
+  assert report['received'] == 3
+  assert report['inserted'] == 2
+  assert report['errors'] == [{'index': 1, 'error': {'first_name': "String value is too long"}}]
+  assert sorted(User.objects.distinct('email')) == ["user0@gmail.com", "user2@gmail.com"]
+
+def test__import_users__hashes_in_shared_process_pool():
+  ingest.start(workers=1)
+  try:
+    report = ingest.import_users(iter([user("ryan@gmail.com")]), rounds=4)
+  finally:
+    ingest.shutdown()
+
+  assert report['inserted'] == 1
+  assert auth.get_hash_rounds(User.objects.get(email="ryan@gmail.com").password) == 4
+
+def test__import_users__hashes_inline_without_a_pool():
+  report = ingest.import_users(iter([user("ryan@gmail.com")]), rounds=4)
+
+  assert report['inserted'] == 1
+  assert auth.verify_password("password", User.objects.get(email="ryan@gmail.com").password)
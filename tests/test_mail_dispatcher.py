@@ -0,0 +1,157 @@
+import smtplib
+import socket
+import time
+from email.mime.text import MIMEText
+
+import pytest
+
+aiosmtpd_controller = pytest.importorskip("aiosmtpd.controller")
+
+import services.mail_service as mail
+from services.mail_dispatcher import MailDispatcher
+
+class RecordingHandler:
+  def __init__(self):
+    self.envelopes = []
+
+  async def handle_DATA(self, server, session, envelope):
+    self.envelopes.append(envelope)
+    return "250 OK"
+
+def free_port():
+  with socket.socket() as sock:
+    sock.bind(("127.0.0.1", 0))
+    return sock.getsockname()[1]
+
+def message(receiver):
+  message = MIMEText("Hi!")
+  message["Subject"] = "IQTrace Email Verification"
+  message["From"] = "iqtrace@gmail.com"
+  message["To"] = receiver
+  return message
+
+def wait_for(condition, timeout=5.0):
+  deadline = time.monotonic() + timeout
+  while not condition() and time.monotonic() < deadline:
+    time.sleep(0.01)
+  return condition()
+
+@pytest.fixture
+def smtp_server():
+  handler = RecordingHandler()
+  controller = aiosmtpd_controller.Controller(handler, hostname="127.0.0.1", port=free_port())
+  controller.start()
+
+  yield controller, handler
+
+  controller.stop()
+
+def connect_to(controller):
+  return lambda: mail.connect_smtp(controller.hostname, controller.port, use_ssl=False)
+
+def test__send__delivers_batch_over_one_connection(smtp_server):
+  controller, handler = smtp_server
+  dispatcher = MailDispatcher(connect_func=connect_to(controller), batch_size=10)
+  for i in range(5):
+    dispatcher.send(message(f"user{i}@gmail.com"))
+
+  dispatcher.start()
+  try:
+    assert wait_for(lambda: len(handler.envelopes) == 5)
+  finally:
+    dispatcher.stop()
+
+  assert sorted(envelope.rcpt_tos[0] for envelope in handler.envelopes) == [f"user{i}@gmail.com" for i in range(5)]
+  assert dispatcher.connections == 1
+  assert dispatcher.metrics()['sent'] == 5
+
+def test__send__retries_after_connection_failure(smtp_server):
+  controller, handler = smtp_server
+  attempts = []
+
+  def flaky_connect():
+    attempts.append(1)
+    if len(attempts) == 1:
+      raise smtplib.SMTPConnectError(421, "try again later")
+    return connect_to(controller)()
+
+  dispatcher = MailDispatcher(connect_func=flaky_connect, backoff=0.01)
+  dispatcher.start()
+  try:
+    dispatcher.send(message("ryan@gmail.com"))
+    assert wait_for(lambda: len(handler.envelopes) == 1)
+  finally:
+    dispatcher.stop()
+
+  assert dispatcher.retried == 1
+  assert dispatcher.failed == 0
+
+def test__send__gives_up_after_max_retries():
+  def refused():
+    raise ConnectionRefusedError("no smtp server")
+
+  dispatcher = MailDispatcher(connect_func=refused, max_retries=2, backoff=0.01)
+  dispatcher.start()
+  try:
+    dispatcher.send(message("ryan@gmail.com"))
+    assert wait_for(lambda: dispatcher.failed == 1)
+  finally:
+    dispatcher.stop()
+
+  assert dispatcher.retried == 2
+  assert dispatcher.sent == 0
+
+def test__build_verification_email__links_verification_id():
+  verification = mail.build_verification_email("ryan@gmail.com", "Ryan", "abc123")
+
+  assert verification["To"] == "ryan@gmail.com"
+  assert "/verification/abc123" in verification.as_string()
+
+def test__send__survives_unexpected_errors(smtp_server):
+  controller, handler = smtp_server
+  attempts = []
+
+  def broken_then_working():
+    attempts.append(1)
+    if len(attempts) == 1:
+      raise ValueError("bad smtp settings")
+    return connect_to(controller)()
+
+  dispatcher = MailDispatcher(connect_func=broken_then_working, backoff=0.01)
+  dispatcher.start()
+  try:
+    dispatcher.send(message("ryan@gmail.com"))
+    assert wait_for(lambda: len(handler.envelopes) == 1)
+  finally:
+    dispatcher.stop()
+
+  assert dispatcher.retried == 1
+
+def test__stop__spools_pending_retries_and_start_sends_them(smtp_server, tmp_path):
+  controller, handler = smtp_server
+  down = [True]
+
+  def connect():
+    if down[0]:
+      raise ConnectionRefusedError("no smtp server")
+    return connect_to(controller)()
+
+  dispatcher = MailDispatcher(connect_func=connect, backoff=60, spool_dir=str(tmp_path))
+  dispatcher.start()
+  dispatcher.send(message("ryan@gmail.com"))
+  assert wait_for(lambda: dispatcher.retried == 1)
+
+  dispatcher.stop()
+
+  assert dispatcher.metrics()['spooled'] == 1
+  assert len(list(tmp_path.glob("*.eml"))) == 1
+
+  down[0] = False
+  dispatcher.start()
+  try:
+    assert wait_for(lambda: len(handler.envelopes) == 1)
+  finally:
+    dispatcher.stop()
+
+  assert handler.envelopes[0].rcpt_tos == ["ryan@gmail.com"]
+  assert list(tmp_path.glob("*.eml")) == []
@@ -0,0 +1,291 @@
+import asyncio
+from datetime import date, datetime
+from types import SimpleNamespace
+
+import numpy
+import pyarrow
+import pytest
+from fastapi import HTTPException, Request
+from fastapi.testclient import TestClient
+from mongoengine import connect, disconnect
+from mongomock_motor import AsyncMongoMockClient
+
+import main
+import services.auth_service as auth
+import services.async_db_service as adb
+import services.db_service as db
+from exceptions import CannotReadFace, FacePipelineIsBusy, TimelogBufferIsFull
+from models import TokenData
+from schemas import Timelog, User
+from services.face_gallery import FaceGallery
+
+FACE = numpy.linspace(-0.2, 0.2, 128)
+OTHER_FACE = -FACE
+
+@pytest.fixture(autouse=True)
+def setup_db():
+  disconnect()
+  connect("mongoenginetest", host="mongomock://localhost")
+  adb.initialize_db(AsyncMongoMockClient())
+  db.user_cache.clear()
+
+  yield
+
+  adb.close_db()
+  disconnect()
+
+@pytest.fixture
+def client():
+  main.app.dependency_overrides[auth.get_token_data] = lambda: TokenData(username="admin@gmail.com")
+  yield TestClient(main.app)
+  main.app.dependency_overrides.clear()
+
+def test__import_users__rejects_oversized_body(client, monkeypatch):
+  monkeypatch.setattr(main.settings, 'USER_IMPORT_MAX_BYTES', 16)
+
+  response = client.post('/users/import', data=b"[" + b"{}, " * 10 + b"{}]",
+    headers={'content-type': "application/json"})
+
+  assert response.status_code == 413
+
+def test__read_capped_body__rejects_chunked_body_past_the_cap():
+  chunks = [b"[{}, ", b"{}, " * 10, b"{}]"]
+
+  async def receive():
+    chunk = chunks.pop(0)
+    return {'type': "http.request", 'body': chunk, 'more_body': bool(chunks)}
+
+  request = Request({'type': "http", 'method': "POST", 'headers': []}, receive)
+  with pytest.raises(HTTPException) as err:
+    asyncio.run(main.read_capped_body(request, 16))
+
+  assert err.value.status_code == 413
+
+def test__import_users__imports_body_under_the_cap(client):
+  response = client.post('/users/import', data=b"[{\"email\": \"incomplete@gmail.com\"}]",
+    headers={'content-type': "application/json"})
+
+  assert response.status_code == 200
+  assert response.json()['received'] == 1
+  assert [error['index'] for error in response.json()['errors']] == [0]
+
+def enroll(email="ryan@gmail.com", face_encoding=FACE):
+  user = {
+    'email': email,
+    'password': "password",
+    'first_name': "Ryan",
+    'last_name': "Dineros",
+    'contact_number': "09294137458",
+    'birthday': date(1996, 9, 16),
+    'address': "Quezon City",
+  }
+  if face_encoding is not None:
+    user['face_encoding'] = face_encoding.tolist()
+  asyncio.run(adb.create_user(user))
+
+def uploaded_face(monkeypatch, result):
+  async def encode_image(data):
+    if isinstance(result, Exception):
+      raise result
+    return result
+  monkeypatch.setattr(main.face_pool, 'encode_image', encode_image)
+
+def check_in(client, temp=36.5, email="ryan@gmail.com"):
+  return client.post('/checkin', params={'email': email, 'temp': temp, 'room_number': 16},
+    files={'file': ("face.jpg", b"jpeg", "image/jpeg")})
+
+def stored(document) -> list:
+  return asyncio.run(adb._collection(document).find({}).to_list(None))
+
+def test__check_in__records_temp_and_entry(client, monkeypatch):
+  enroll()
+  uploaded_face(monkeypatch, FACE)
+
+  response = check_in(client)
+
+  assert response.status_code == 200
+  assert response.json()['entry_allowed'] is True
+  assert [timelog['user_email'] for timelog in stored(Timelog)] == ["ryan@gmail.com"]
+  assert str(stored(Timelog)[0]['_id']) == response.json()['timelog_id']
+  assert stored(User)[0]['temp'] == 36.5
+
+def test__check_in__unknown_user_is_404(client, monkeypatch):
+  uploaded_face(monkeypatch, FACE)
+
+  assert check_in(client).status_code == 404
+
+def test__check_in__user_without_enrolled_face_is_400(client, monkeypatch):
+  enroll(face_encoding=None)
+  uploaded_face(monkeypatch, FACE)
+
+  assert check_in(client).status_code == 400
+
+def test__check_in__unreadable_image_is_400(client, monkeypatch):
+  enroll()
+  uploaded_face(monkeypatch, CannotReadFace("Cannot read face."))
+
+  assert check_in(client).status_code == 400
+
+def test__check_in__busy_face_pool_is_503(client, monkeypatch):
+  enroll()
+  uploaded_face(monkeypatch, FacePipelineIsBusy("Face pipeline is busy."))
+
+  assert check_in(client).status_code == 503
+  assert stored(Timelog) == []
+
+def test__check_in__full_timelog_buffer_is_503_with_nothing_written(client, monkeypatch):
+  def add(timelog):
+    raise TimelogBufferIsFull("Timelog buffer is full.")
+  monkeypatch.setattr(main, 'timelog_buffer', SimpleNamespace(is_running=True, add=add))
+  enroll()
+  uploaded_face(monkeypatch, FACE)
+
+  response = check_in(client)
+
+  assert response.status_code == 503
+  assert 'temp' not in stored(User)[0]
+
+def test__check_in__fever_records_temp_without_timelog(client, monkeypatch):
+  enroll()
+  uploaded_face(monkeypatch, FACE)
+
+  response = check_in(client, temp=39.0)
+
+  assert response.status_code == 200
+  assert response.json()['has_fever'] is True
+  assert response.json()['entry_allowed'] is False
+  assert response.json()['timelog_id'] is None
+  assert stored(Timelog) == []
+  assert stored(User)[0]['temp'] == 39.0
+
+def test__check_in__face_mismatch_writes_nothing(client, monkeypatch):
+  enroll()
+  uploaded_face(monkeypatch, OTHER_FACE)
+
+  response = check_in(client)
+
+  assert response.status_code == 200
+  assert response.json()['face_match'] is False
+  assert stored(Timelog) == []
+  assert 'temp' not in stored(User)[0]
+
+def test__rebuild_occupancy__registers_one_listener():
+  main.rebuild_occupancy()
+  main.rebuild_occupancy()
+
+  assert db.timelog_listeners.count(main.occupancy.record_many) == 1
+
+@pytest.mark.parametrize('params', [{'k': 0}, {'k': main.settings.IDENTIFY_MAX_MATCHES + 1}, {'tolerance': 0}])
+def test__identify_user__rejects_out_of_range_params(client, monkeypatch, params):
+  uploaded_face(monkeypatch, FACE)
+
+  response = client.post('/users/identify', params=params, files={'file': ("face.jpg", b"jpeg", "image/jpeg")})
+
+  assert response.status_code == 422
+
+@pytest.mark.parametrize('accept_encoding, encoding', [("gzip, deflate", "gzip"), ("gzip;q=0, deflate", None)])
+def test__export_timelogs__gzips_only_when_accepted(client, accept_encoding, encoding):
+  response = client.get('/timelog/export', headers={'accept-encoding': accept_encoding})
+
+  assert response.status_code == 200
+  assert response.headers.get('content-encoding') == encoding
+  assert response.text.startswith("timestamp,room_number")
+
+def test__export_timelogs__streams_arrow(client):
+  db.create_timelog({'user_email': "ryan@gmail.com", 'room_number': 16, 'timestamp': datetime(2021, 9, 16, 8)})
+
+  response = client.get('/timelog/export', params={'format': "arrow"}, headers={'accept-encoding': "identity"})
+
+  assert response.status_code == 200
+  assert response.headers['content-type'] == "application/vnd.apache.arrow.stream"
+  table = pyarrow.ipc.open_stream(response.content).read_all()
+  assert table.column('user_email').to_pylist() == ["ryan@gmail.com"]
+  assert table.column('room_number').to_pylist() == [16]
+
+def test__get_users_with_symptoms__walks_pages_with_next_cursor(client):
+  for i in range(3):
+    asyncio.run(adb.create_user({
+      'email': f"fever{i}@gmail.com", 'password': "password", 'first_name': "Ryan", 'last_name': "Dineros",
+      'contact_number': "09294137458", 'birthday': date(1996, 9, 16), 'address': "Quezon City", 'temp': 39.0,
+    }))
+
+  first = client.get('/users/active-symptoms', params={'limit': 2})
+  rest = client.get('/users/active-symptoms', params={'limit': 2, 'after': first.headers['x-next-cursor']})
+
+  assert [user['email'] for user in first.json()] == ["fever0@gmail.com", "fever1@gmail.com"]
+  assert [user['email'] for user in rest.json()] == ["fever2@gmail.com"]
+  assert 'x-next-cursor' not in rest.headers
+
+def test__create_timelogs__rejects_oversized_body(client, monkeypatch):
+  monkeypatch.setattr(main.settings, 'TIMELOG_BULK_MAX_BYTES', 64)
+  line = b'{"user_email": "ryan@gmail.com", "room_number": 16, "timestamp": "2021-09-16T08:00:00"}\n'
+
+  response = client.post('/timelog/bulk', data=line * 2, headers={'content-type': "application/x-ndjson"})
+
+  assert response.status_code == 413
+  assert stored(Timelog) == []
+
+PROFILE = {
+  'first_name': "Ryan", 'last_name': "Dineros", 'contact_number': "09294137458",
+  'birthday': "1996-09-16", 'address': "Quezon City",
+}
+
+@pytest.fixture
+def gallery(monkeypatch):
+  gallery = FaceGallery()
+  monkeypatch.setattr(main, 'gallery', gallery)
+  return gallery
+
+def test__register_user__adds_face_to_gallery(client, gallery):
+  response = client.post('/users/register', json={
+    'email': "ryan@gmail.com", 'password': "password", 'face_encoding': FACE.tolist(), **PROFILE})
+
+  assert response.status_code == 201
+  assert gallery.search(FACE, k=1)[0]['email'] == "ryan@gmail.com"
+
+def test__update_user__upserts_and_clears_gallery_face(client, gallery):
+  enroll(face_encoding=None)
+  body = {'email': "ryan@gmail.com", **PROFILE}
+
+  client.put('/users', params={'email': "ryan@gmail.com"}, json={**body, 'face_encoding': FACE.tolist()})
+  assert [match['email'] for match in gallery.search(FACE, k=1)] == ["ryan@gmail.com"]
+
+  client.put('/users', params={'email': "ryan@gmail.com"}, json={**body, 'face_encoding': []})
+  assert len(gallery) == 0
+
+def test__update_user__without_face_keeps_gallery_face(client, gallery):
+  enroll(face_encoding=None)
+  body = {'email': "ryan@gmail.com", **PROFILE}
+  client.put('/users', params={'email': "ryan@gmail.com"}, json={**body, 'face_encoding': FACE.tolist()})
+
+  client.put('/users', params={'email': "ryan@gmail.com"}, json=body)
+
+  assert len(gallery) == 1
+
+def test__import_users__adds_imported_faces_to_gallery(client, gallery):
+  users = [
+    {'email': "ryan@gmail.com", 'password': "password", 'face_encoding': FACE.tolist(), **PROFILE},
+    {'email': "juan@gmail.com", 'password': "password", **PROFILE},
+  ]
+
+  response = client.post('/users/import', json=users)
+
+  assert response.json()['inserted'] == 2
+  assert [match['email'] for match in gallery.search(FACE, k=5)] == ["ryan@gmail.com"]
+
+def test__timelog_endpoints__return_direction(client):
+  room = {'number': 16, 'name': "My Room"}
+  exit_log = {'user_email': "ryan@gmail.com", 'room_number': 16, 'timestamp': datetime(2021, 9, 16, 8), 'direction': 'exit'}
+  # The paged endpoints read through mongoengine, /timelog/all through the async client
+  db.create_room(room)
+  db.create_timelog(exit_log)
+  asyncio.run(adb.create_room(room))
+  asyncio.run(adb.create_timelog(exit_log))
+
+  room_logs = client.get('/rooms/16/timelogs').json()
+  user_logs = client.get('/users/timelogs', params={'email': "ryan@gmail.com"}).json()
+  all_logs = client.get('/timelog/all').json()
+
+  assert [log['direction'] for log in room_logs] == ['exit']
+  assert [log['direction'] for log in user_logs] == ['exit']
+  assert [log['direction'] for log in all_logs['16']] == ['exit']
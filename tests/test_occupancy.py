@@ -0,0 +1,94 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from services.occupancy import OccupancyTracker
+
+START = datetime(2021, 9, 16, 8)
+
+def timelog(user_email, room_number, minutes, direction=None):
+  return {
+    'user_email': user_email,
+    'room_number': room_number,
+    'timestamp': START + timedelta(minutes=minutes),
+    'direction': direction
+  }
+
+@pytest.fixture
+def tracker():
+  return OccupancyTracker(timedelta(minutes=60))
+
+def test__record_many__counts_users_per_room(tracker):
+  tracker.record_many([
+    timelog("ryan@gmail.com", 16, 0),
+    timelog("juan@gmail.com", 16, 5),
+    timelog("maria@gmail.com", 17, 10),
+  ])
+
+  assert tracker.counts(now=START + timedelta(minutes=15)) == {16: 2, 17: 1}
+
+def test__record__entry_moves_user_between_rooms(tracker):
+  tracker.record("ryan@gmail.com", 16, START)
+  tracker.record("ryan@gmail.com", 17, START + timedelta(minutes=5))
+
+  now = START + timedelta(minutes=10)
+  assert tracker.count(16, now=now) == 0
+  assert tracker.count(17, now=now) == 1
+
+def test__record__exit_removes_user(tracker):
+  tracker.record_many([
+    timelog("ryan@gmail.com", 16, 0, 'entry'),
+    timelog("ryan@gmail.com", 16, 20, 'exit'),
+  ])
+
+  assert tracker.counts(now=START + timedelta(minutes=30)) == {}
+
+def test__record__ignores_out_of_order_logs(tracker):
+  tracker.record("ryan@gmail.com", 17, START + timedelta(minutes=10))
+  tracker.record("ryan@gmail.com", 16, START)
+
+  assert tracker.counts(now=START + timedelta(minutes=15)) == {17: 1}
+
+def test__counts__expires_users_after_dwell_timeout(tracker):
+  tracker.record("ryan@gmail.com", 16, START)
+  tracker.record("juan@gmail.com", 16, START + timedelta(minutes=30))
+
+  assert tracker.count(16, now=START + timedelta(minutes=59)) == 2
+  assert tracker.count(16, now=START + timedelta(minutes=60)) == 1
+  assert tracker.count(16, now=START + timedelta(minutes=90)) == 0
+
+def test__counts__later_log_extends_presence(tracker):
+  tracker.record("ryan@gmail.com", 16, START)
+  tracker.record("ryan@gmail.com", 16, START + timedelta(minutes=45))
+
+  assert tracker.count(16, now=START + timedelta(minutes=90)) == 1
+
+def test__record__normalizes_aware_timestamps(tracker):
+  tracker.record("ryan@gmail.com", 16, datetime(2021, 9, 16, 16, tzinfo=timezone(timedelta(hours=8))))
+
+  assert tracker.count(16, now=START + timedelta(minutes=59)) == 1
+  assert tracker.count(16, now=START + timedelta(minutes=60)) == 0
+
+def test__rebuild__replaces_existing_state(tracker):
+  tracker.record("ryan@gmail.com", 16, START)
+
+  present = tracker.rebuild([timelog("juan@gmail.com", 17, 0)])
+
+  assert present == 1
+  assert tracker.counts(now=START) == {17: 1}
+
+def test__record__keeps_expiry_heap_bounded_without_queries(tracker):
+  for minute in range(1000):
+    tracker.record("ryan@gmail.com", 16, START + timedelta(minutes=minute))
+
+  assert len(tracker._expiries) <= 2 * len(tracker._presence) + 64
+  assert tracker.count(16, now=START + timedelta(minutes=1000)) == 1
+
+def test__counts__refreshes_from_load_func_when_stale():
+  loaded = [[timelog("ryan@gmail.com", 16, 0)], [timelog("juan@gmail.com", 17, 0)]]
+  tracker = OccupancyTracker(timedelta(minutes=60), refresh_interval=0.01, load_func=lambda since: loaded.pop(0))
+
+  assert tracker.counts(now=START) == {16: 1}
+  time.sleep(0.02)
+  assert tracker.counts(now=START) == {17: 1}
@@ -0,0 +1,63 @@
+from datetime import datetime, timedelta, timezone
+
+import services.rollup_service as rollup
+
+def rollup_doc(hour, visits, users):
+  return {'room_number': 16, 'hour': hour, 'visits': visits, 'users': users}
+
+def test__period_start__truncates_to_period():
+  timestamp = datetime(2021, 9, 16, 14, 35, 12)
+
+  assert rollup.period_start(timestamp, 'hour') == datetime(2021, 9, 16, 14)
+  assert rollup.period_start(timestamp, 'day') == datetime(2021, 9, 16)
+  assert rollup.period_start(timestamp, 'week') == datetime(2021, 9, 13)
+  assert rollup.period_start(timestamp, 'month') == datetime(2021, 9, 1)
+
+def test__hour_bucket__converts_aware_timestamps_to_utc():
+  timestamp = datetime(2021, 9, 16, 8, 30, tzinfo=timezone(timedelta(hours=8)))
+
+  assert rollup.hour_bucket(timestamp) == datetime(2021, 9, 16, 0)
+
+def test__rollup_updates__one_upsert_per_room_hour():
+  updates = rollup.rollup_updates([
+    {'user_email': "ryan@gmail.com", 'room_number': 16, 'timestamp': datetime(2021, 9, 16, 8, 5)},
+    {'user_email': "ryan@gmail.com", 'room_number': 16, 'timestamp': datetime(2021, 9, 16, 8, 45)},
+    {'user_email': "juan@gmail.com", 'room_number': 17, 'timestamp': datetime(2021, 9, 16, 8, 10)},
+  ])
+
+  assert len(updates) == 2
+  assert updates[0]._filter == {'room_number': 16, 'hour': datetime(2021, 9, 16, 8)}
+  assert updates[0]._doc == {'$inc': {'visits': 2}, '$addToSet': {'users': {'$each': ["ryan@gmail.com"]}}}
+
+def test__rollup_updates__skips_exit_logs():
+  updates = rollup.rollup_updates([
+    {'user_email': "ryan@gmail.com", 'room_number': 16, 'timestamp': datetime(2021, 9, 16, 8, 5), 'direction': 'entry'},
+    {'user_email': "ryan@gmail.com", 'room_number': 16, 'timestamp': datetime(2021, 9, 16, 8, 45), 'direction': 'exit'},
+    {'user_email': "juan@gmail.com", 'room_number': 17, 'timestamp': datetime(2021, 9, 16, 8, 10), 'direction': 'exit'},
+  ])
+
+  assert len(updates) == 1
+  assert updates[0]._filter == {'room_number': 16, 'hour': datetime(2021, 9, 16, 8)}
+  assert updates[0]._doc == {'$inc': {'visits': 1}, '$addToSet': {'users': {'$each': ["ryan@gmail.com"]}}}
+
+def test__summarize__merges_hours_into_days():
+  summary = rollup.summarize([
+    rollup_doc(datetime(2021, 9, 16, 8), 3, ["ryan@gmail.com", "juan@gmail.com"]),
+    rollup_doc(datetime(2021, 9, 16, 12), 5, ["ryan@gmail.com", "maria@gmail.com"]),
+    rollup_doc(datetime(2021, 9, 17, 9), 1, ["juan@gmail.com"]),
+  ], 'day')
+
+  assert summary == [
+    {'start': datetime(2021, 9, 16), 'visits': 8, 'unique_users': 3,
+      'peak_hour': datetime(2021, 9, 16, 12), 'peak_visits': 5},
+    {'start': datetime(2021, 9, 17), 'visits': 1, 'unique_users': 1,
+      'peak_hour': datetime(2021, 9, 17, 9), 'peak_visits': 1},
+  ]
+
+def test__summarize__weeks_start_on_monday():
+  summary = rollup.summarize([
+    rollup_doc(datetime(2021, 9, 19, 8), 1, ["ryan@gmail.com"]),
+    rollup_doc(datetime(2021, 9, 20, 8), 1, ["ryan@gmail.com"]),
+  ], 'week')
+
+  assert [bucket['start'] for bucket in summary] == [datetime(2021, 9, 13), datetime(2021, 9, 20)]
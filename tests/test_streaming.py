@@ -0,0 +1,15 @@
+import json
+
+import services.streaming as streaming
+
+def test__json_object_of_arrays__is_valid_json():
+  groups = [(1, iter([{'a': 1}, {'a': 2}])), (2, iter(()))]
+
+  body = "".join(streaming.json_object_of_arrays(groups))
+
+  assert json.loads(body) == {'1': [{'a': 1}, {'a': 2}], '2': []}
+
+def test__buffered__coalesces_small_parts():
+  chunks = list(streaming.buffered(["ab", "cd", "ef", "g"], chunk_size=4))
+
+  assert chunks == ["abcd", "efg"]
@@ -0,0 +1,113 @@
+import time
+from datetime import datetime
+
+import pytest
+
+from exceptions import TimelogBufferIsFull
+from services.timelog_buffer import TimelogBuffer
+
+def timelog(i):
+  return {'user_email': f"user{i}@gmail.com", 'room_number': 16, 'timestamp': datetime(2021, 9, 16, 8, 0)}
+
+class FakeInsert:
+  def __init__(self, fail=False, errors=()):
+    self.batches = []
+    self.fail = fail
+    self.errors = list(errors)
+
+  def __call__(self, timelogs):
+    if self.fail:
+      raise ConnectionError("mongo is down")
+    self.batches.append(timelogs)
+    return len(timelogs) - len(self.errors), self.errors
+
+def wait_for(condition, timeout=2.0):
+  deadline = time.monotonic() + timeout
+  while not condition() and time.monotonic() < deadline:
+    time.sleep(0.01)
+  return condition()
+
+def test__add__flushes_when_size_threshold_is_reached():
+  insert = FakeInsert()
+  buffer = TimelogBuffer(flush_size=3, flush_interval=60, max_size=100, insert_func=insert)
+  buffer.start()
+  try:
+    ids = [buffer.add(timelog(i)) for i in range(3)]
+
+    assert wait_for(lambda: len(insert.batches) == 1)
+    assert [str(log['id']) for log in insert.batches[0]] == ids
+  finally:
+    buffer.stop()
+
+def test__add__flushes_when_time_threshold_passes():
+  insert = FakeInsert()
+  buffer = TimelogBuffer(flush_size=100, flush_interval=0.05, max_size=100, insert_func=insert)
+  buffer.start()
+  try:
+    buffer.add(timelog(0))
+
+    assert wait_for(lambda: len(insert.batches) == 1)
+    assert buffer.metrics()['depth'] == 0
+    assert buffer.metrics()['flushed'] == 1
+  finally:
+    buffer.stop()
+
+def test__stop__flushes_pending_logs():
+  insert = FakeInsert()
+  buffer = TimelogBuffer(flush_size=100, flush_interval=60, max_size=100, insert_func=insert)
+  buffer.start()
+  buffer.add(timelog(0))
+  buffer.add(timelog(1))
+
+  buffer.stop()
+
+  assert sum(len(batch) for batch in insert.batches) == 2
+  assert not buffer.is_running
+
+def test__flush__keeps_logs_when_insert_fails():
+  buffer = TimelogBuffer(flush_size=100, flush_interval=60, max_size=100, insert_func=FakeInsert(fail=True))
+  buffer.add(timelog(0))
+
+  assert buffer.flush() == 0
+  assert len(buffer) == 1
+  assert buffer.metrics()['failed_flushes'] == 1
+
+def test__add__raises_when_buffer_is_full():
+  buffer = TimelogBuffer(flush_size=100, flush_interval=60, max_size=1, insert_func=FakeInsert())
+  buffer.add(timelog(0))
+
+  with pytest.raises(TimelogBufferIsFull):
+    buffer.add(timelog(1))
+
+def test__flush__counts_duplicate_and_rejected_logs():
+  insert = FakeInsert(errors=[(0, 11000, "duplicate key"), (2, 2, "document is invalid")])
+  buffer = TimelogBuffer(flush_size=100, flush_interval=60, max_size=100, insert_func=insert)
+  for i in range(3):
+    buffer.add(timelog(i))
+
+  assert buffer.flush() == 1
+  assert buffer.metrics()['duplicates'] == 1
+  assert buffer.metrics()['rejected'] == 1
+
+def test__stop__spills_unflushed_logs_and_start_restores_them(tmp_path):
+  spill_path = str(tmp_path / "spill.ndjson")
+  insert = FakeInsert(fail=True)
+  buffer = TimelogBuffer(flush_size=100, flush_interval=0.01, max_size=100, insert_func=insert,
+    spill_path=spill_path, shutdown_retries=2)
+  buffer.start()
+  ids = [buffer.add(timelog(i)) for i in range(2)]
+
+  buffer.stop()
+
+  assert len(buffer) == 0
+  assert buffer.metrics()['spilled'] == 2
+  assert buffer.metrics()['failed_flushes'] == 2
+
+  insert.fail = False
+  buffer.start()
+  buffer.stop()
+
+  restored = insert.batches[0]
+  assert [str(log['id']) for log in restored] == ids
+  assert restored[0]['timestamp'] == datetime(2021, 9, 16, 8, 0)
+  assert not (tmp_path / "spill.ndjson").exists()
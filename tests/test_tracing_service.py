@@ -0,0 +1,111 @@
+from datetime import datetime, timedelta
+
+import pytest
+from mongoengine import connect, disconnect
+
+import services.db_service as db
+import services.tracing_service as tracing
+
+WINDOW = timedelta(minutes=15)
+
+def log(user_email, room_number, hour, minute=0):
+  return {
+    'user_email': user_email,
+    'room_number': room_number,
+    'timestamp': datetime(2021, 9, 16, hour, minute),
+  }
+
+def sorted_logs(logs):
+  return sorted(logs, key=lambda log: (log['room_number'], log['timestamp']))
+
+@pytest.fixture
+def setup_db():
+  disconnect()
+  connect("mongoenginetest", host="mongomock://localhost")
+
+  yield
+
+  disconnect()
+
+def test__find_contacts__matches_logs_within_window():
+  index_logs = [log("index@gmail.com", 16, 8), log("index@gmail.com", 16, 13)]
+  room_logs = sorted_logs([
+    log("near@gmail.com", 16, 8, 10),
+    log("near@gmail.com", 16, 12, 50),
+    log("far@gmail.com", 16, 10),
+    log("edge@gmail.com", 16, 13, 15),
+  ])
+
+  contacts = tracing.find_contacts(index_logs, room_logs, WINDOW)
+
+  assert [contact['user_email'] for contact in contacts] == ["near@gmail.com", "edge@gmail.com"]
+  assert contacts[0]['overlaps'] == 2
+  assert contacts[0]['first_contact'] == datetime(2021, 9, 16, 8, 10)
+  assert contacts[0]['last_contact'] == datetime(2021, 9, 16, 12, 50)
+
+def test__find_contacts__ignores_other_rooms():
+  index_logs = [log("index@gmail.com", 16, 8)]
+  room_logs = sorted_logs([log("other@gmail.com", 1, 8), log("same@gmail.com", 16, 8, 5)])
+
+  contacts = tracing.find_contacts(index_logs, room_logs, WINDOW)
+
+  assert [(contact['user_email'], contact['rooms']) for contact in contacts] == [("same@gmail.com", [16])]
+
+def test__find_contacts__agrees_with_pairwise_check():
+  base = datetime(2021, 9, 16)
+  index_logs = [{'room_number': i % 3, 'timestamp': base + timedelta(minutes=37 * i)} for i in range(40)]
+  room_logs = sorted_logs([
+    {'user_email': f"user{i % 7}", 'room_number': i % 3, 'timestamp': base + timedelta(minutes=11 * i)}
+    for i in range(200)
+  ])
+
+  expected = {}
+  for other in room_logs:
+    if any(index['room_number'] == other['room_number'] and abs(index['timestamp'] - other['timestamp']) <= WINDOW
+      for index in index_logs):
+      expected[other['user_email']] = expected.get(other['user_email'], 0) + 1
+
+  contacts = tracing.find_contacts(index_logs, room_logs, WINDOW)
+
+  assert {contact['user_email']: contact['overlaps'] for contact in contacts} == expected
+
+def test__visit_windows__merges_overlapping_visits_per_room():
+  windows = tracing.visit_windows([
+    log("index@gmail.com", 16, 8, 20),
+    log("index@gmail.com", 16, 8),
+    log("index@gmail.com", 16, 10),
+    log("index@gmail.com", 17, 8),
+  ], WINDOW)
+
+  assert windows == [
+    (16, datetime(2021, 9, 16, 7, 45), datetime(2021, 9, 16, 8, 35)),
+    (16, datetime(2021, 9, 16, 9, 45), datetime(2021, 9, 16, 10, 15)),
+    (17, datetime(2021, 9, 16, 7, 45), datetime(2021, 9, 16, 8, 15)),
+  ]
+
+def test__trace_contacts__only_reads_logs_near_the_visits(setup_db, monkeypatch):
+  db.create_timelog(log("index@gmail.com", 16, 8))
+  db.create_timelog(log("edge@gmail.com", 16, 8, 15))
+  db.create_timelog(log("later@gmail.com", 16, 12))
+  read = []
+  iter_room_window_timelogs = db.iter_room_window_timelogs
+  def spy(windows, exclude_email=None):
+    logs = list(iter_room_window_timelogs(windows, exclude_email))
+    read.extend(log['user_email'] for log in logs)
+    return logs
+  monkeypatch.setattr(db, 'iter_room_window_timelogs', spy)
+
+  contacts = tracing.trace_contacts("index@gmail.com", datetime(2021, 9, 16), datetime(2021, 9, 17), WINDOW)
+
+  assert read == ["edge@gmail.com"]
+  assert [contact['user_email'] for contact in contacts] == ["edge@gmail.com"]
+
+def test__trace_contacts__reads_logs_from_db(setup_db):
+  db.create_timelog(log("index@gmail.com", 16, 8))
+  db.create_timelog(log("index@gmail.com", 16, 8, 5))
+  db.create_timelog(log("near@gmail.com", 16, 8, 20))
+  db.create_timelog(log("far@gmail.com", 16, 9))
+
+  contacts = tracing.trace_contacts("index@gmail.com", datetime(2021, 9, 16), datetime(2021, 9, 17), WINDOW)
+
+  assert [(contact['user_email'], contact['overlaps']) for contact in contacts] == [("near@gmail.com", 1)]